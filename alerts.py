@@ -0,0 +1,278 @@
+"""Saved-search alerts: match listing changes against subscriptions as they're stored
+
+Users save searches (make, model, year range, max price, location and a
+minimum price drop). Rather than running every saved search as a query
+after each run, searches are kept in an inverted index keyed by make,
+model and year bucket, and each new or repriced listing is checked only
+against the searches in its own buckets (plus the wildcard ones):
+
+    ('toyota', 'corolla', 402)  -> searches for Corolla 2010-2014
+    ('toyota', None, None)      -> searches for any Toyota, any year
+    (None, None, None)          -> searches on price or location only
+
+Matches are queued in the alerts table in the same transaction as the
+listings, then sent as one digest email per user, all over a single SMTP
+connection.
+"""
+import logging
+import smtplib
+from collections import defaultdict, namedtuple
+from email.mime.text import MIMEText
+from html import escape
+from itertools import product
+
+logger = logging.getLogger('CarTracker')
+
+SavedSearch = namedtuple('SavedSearch', ['id', 'email', 'name', 'make', 'model', 'year_min', 'year_max',
+                                         'max_price', 'location', 'min_drop_percent'])
+
+# Searches are indexed under every bucket of years they cover; ranges wider
+# than MAX_YEAR_BUCKETS buckets (or open-ended) go under the any-year key
+YEAR_BUCKET = 5
+MAX_YEAR_BUCKETS = 6
+
+# Listings shown per digest; the rest are counted
+DIGEST_LIMIT = 50
+
+ALERT_NEW = 'new'
+ALERT_PRICE_DROP = 'price_drop'
+
+
+def _key(value):
+    return value.strip().lower() if value else None
+
+
+def _year_bucket(year):
+    return year // YEAR_BUCKET if year else None
+
+
+def match(search, listing, previous_price=None):
+    """The alert a listing change raises for a search: ALERT_NEW, ALERT_PRICE_DROP or None
+
+    previous_price is None for a new listing.
+    """
+    if search.make and _key(search.make) != _key(listing.make):
+        return None
+    if search.model and _key(search.model) != _key(listing.model):
+        return None
+    if search.year_min is not None and (listing.year or 0) < search.year_min:
+        return None
+    if search.year_max is not None and (not listing.year or listing.year > search.year_max):
+        return None
+    if search.max_price is not None and not 0 < (listing.price or 0) <= search.max_price:
+        return None
+    if search.location and _key(search.location) not in (_key(listing.location) or ''):
+        return None
+
+    if previous_price is None:
+        return ALERT_NEW
+    if previous_price > 0 and listing.price < previous_price:
+        drop = (previous_price - listing.price) / previous_price * 100
+        if drop >= (search.min_drop_percent or 0):
+            return ALERT_PRICE_DROP
+    return None
+
+
+class SearchIndex:
+    """Saved searches keyed by (make, model, year bucket); None stands for any"""
+
+    def __init__(self, searches=()):
+        self.buckets = defaultdict(list)
+        self.size = 0
+        for search in searches:
+            self.add(search)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, search):
+        for bucket in self._year_buckets(search):
+            self.buckets[(_key(search.make), _key(search.model), bucket)].append(search)
+        self.size += 1
+
+    def _year_buckets(self, search):
+        if search.year_min is None or search.year_max is None:
+            return [None]
+        first, last = _year_bucket(search.year_min), _year_bucket(search.year_max)
+        if first is None or last - first >= MAX_YEAR_BUCKETS:
+            return [None]
+        return range(first, last + 1)
+
+    def candidates(self, listing):
+        """Searches that may match the listing; at most 8 dict lookups"""
+        keys = set(product((_key(listing.make), None), (_key(listing.model), None), (_year_bucket(listing.year), None)))
+        for key in keys:
+            yield from self.buckets.get(key, ())
+
+    def matches(self, listing, previous_price=None):
+        """(search, alert kind) for every search the listing change alerts"""
+        for search in self.candidates(listing):
+            kind = match(search, listing, previous_price)
+            if kind:
+                yield search, kind
+
+
+class AlertEngine:
+    """Matches stored listing changes against the saved searches and queues alerts"""
+
+    def __init__(self, metrics=None):
+        self.index = SearchIndex()
+        self.metrics = metrics
+
+    def load(self, conn):
+        """Rebuild the index from the saved_searches table"""
+        rows = conn.execute('''
+        SELECT id, email, name, make, model, year_min, year_max, max_price, location, min_drop_percent
+        FROM saved_searches
+        ''')
+        self.index = SearchIndex(SavedSearch(*row) for row in rows)
+        return len(self.index)
+
+    def queue(self, cursor, changes, today):
+        """Queue the alerts raised by a batch of stored changes, in the cursor's transaction
+
+        changes are (listing, car_id, previous_price) tuples, previous_price
+        being None for new listings. Returns the number of alerts queued.
+        """
+        if not len(self.index):
+            return 0
+        rows = []
+        for listing, car_id, previous_price in changes:
+            for search, kind in self.index.matches(listing, previous_price):
+                rows.append((search.id, car_id, kind, listing.price, previous_price, today))
+        # A listing already alerted at this price isn't alerted again
+        cursor.executemany('''
+        INSERT OR IGNORE INTO alerts (search_id, car_id, kind, price, previous_price, created)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+        if self.metrics and rows:
+            self.metrics.inc('alerts_queued_total', len(rows))
+        return len(rows)
+
+    def send_digests(self, conn, mailer, limit=DIGEST_LIMIT):
+        """Send every user their pending alerts as one email; returns digests sent
+
+        Alerts past a search's notified_id are pending. A car matching
+        several of a user's searches is listed once. Each user's searches
+        are marked notified as their digest goes out, so a failure part way
+        through doesn't send anyone the same alerts twice, and the alert
+        rows themselves are never rewritten.
+        """
+        emails = [row[0] for row in conn.execute('''
+        SELECT DISTINCT s.email FROM saved_searches s
+        WHERE EXISTS (SELECT 1 FROM alerts a WHERE a.search_id = s.id AND a.id > s.notified_id)
+        ORDER BY s.email
+        ''')]
+
+        sent = 0
+        with mailer:
+            for email in emails:
+                cars, last_id = conn.execute('''
+                SELECT COUNT(DISTINCT a.car_id), MAX(a.id) FROM saved_searches s
+                JOIN alerts a ON a.search_id = s.id AND a.id > s.notified_id
+                WHERE s.email = ?
+                ''', (email,)).fetchone()
+                rows = conn.execute('''
+                SELECT a.kind, a.price, MAX(a.previous_price), GROUP_CONCAT(DISTINCT s.name),
+                       c.title, c.year, c.mileage, c.location, c.website, c.url
+                FROM saved_searches s
+                JOIN alerts a ON a.search_id = s.id AND a.id > s.notified_id
+                JOIN cars c ON c.id = a.car_id
+                WHERE s.email = ? AND a.id <= ?
+                GROUP BY a.car_id, a.kind, a.price
+                ORDER BY a.kind, MIN(a.id)
+                LIMIT ?
+                ''', (email, last_id, limit)).fetchall()
+                try:
+                    mailer.send(email, f"{cars} listings matching your saved car searches",
+                                render_digest(rows, cars - len(rows)))
+                except (smtplib.SMTPException, OSError) as e:
+                    logger.error(f"Failed to send alert digest to {email}: {e}")
+                    continue
+                conn.execute('UPDATE saved_searches SET notified_id = ? WHERE email = ?', (last_id, email))
+                conn.commit()
+                sent += 1
+        if self.metrics and sent:
+            self.metrics.inc('alert_digests_total', sent)
+        logger.info(f"Sent {sent} alert digests")
+        return sent
+
+
+def render_digest(rows, more=0):
+    """HTML body of one user's digest"""
+    lines = ['<h2>Your saved searches</h2>', '<table>',
+             '<tr><th>Search</th><th>Car</th><th>Year</th><th>Mileage</th><th>Location</th><th>Price</th><th></th></tr>']
+    for kind, price, previous_price, names, title, year, mileage, location, website, url in rows:
+        if kind == ALERT_PRICE_DROP:
+            price_text = f'${price:,.0f} <s>${previous_price:,.0f}</s>'
+        else:
+            price_text = f'${price:,.0f} (new)'
+        lines.append(f'<tr><td>{escape(names or "")}</td><td>{escape(title or "")}</td><td>{year or ""}</td>'
+                     f'<td>{mileage or ""}</td><td>{escape(location or "")}</td><td>{price_text}</td>'
+                     f'<td><a href="{escape(url or "")}">{escape(website or "")}</a></td></tr>')
+    lines.append('</table>')
+    if more > 0:
+        lines.append(f'<p>And {more} more matches.</p>')
+    return '\n'.join(lines)
+
+
+class Mailer:
+    """Sends HTML emails, reusing one SMTP connection inside a with block
+
+    Outside a with block each send connects and quits on its own. A
+    connection the server dropped is reopened once before giving up.
+    """
+
+    def __init__(self, host, port, username=None, password=None, use_ssl=True, from_email=None, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.from_email = from_email or username
+        self.timeout = timeout
+        self.server = None
+        self.depth = 0
+        self.connections = 0
+
+    def _connect(self):
+        smtp = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        self.server = smtp(self.host, self.port, timeout=self.timeout)
+        if self.username and self.password:
+            self.server.login(self.username, self.password)
+        self.connections += 1
+
+    def _close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if not self.depth:
+            self._close()
+
+    def send(self, to_email, subject, html):
+        msg = MIMEText(html, 'html')
+        msg['Subject'] = subject
+        msg['From'] = self.from_email
+        msg['To'] = to_email
+        with self:
+            for attempt in range(2):
+                if self.server is None:
+                    self._connect()
+                try:
+                    self.server.send_message(msg)
+                    return
+                except smtplib.SMTPServerDisconnected:
+                    self.server = None
+                    if attempt:
+                        raise
@@ -0,0 +1,302 @@
+"""Columnar analytics store and market statistics
+
+The cars and prices tables are exported incrementally from the live SQLite
+database into a columnar store, with prices partitioned by scrape date:
+
+    analytics/
+        cars/part-000000000001.parquet
+        prices/date=2024-05-01/part-000000000001.parquet
+        export_state.json
+
+Statistics are computed with vectorized pandas operations over the store,
+so they never hold locks on the database the scraper is writing to.
+
+New rows are appended past the highest row id exported. Rows already
+exported can still change: history compaction and backfills rewrite price
+intervals in place, and schema migrations rewrite cars columns. Whatever
+changes them invalidates the date partitions (or the table) involved, and
+the next export rebuilds them from the database.
+"""
+import glob
+import json
+import logging
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('CarTracker')
+
+try:
+    import pyarrow  # noqa: F401
+    DEFAULT_FORMAT = 'parquet'
+except ImportError:
+    pyarrow = None
+    # Without pyarrow, partitions are stored as compressed pickled DataFrames
+    DEFAULT_FORMAT = 'pickle'
+
+EXTENSIONS = {'parquet': '.parquet', 'pickle': '.pkl.gz'}
+
+# Columns exported from each table; prices.date becomes the partition key
+CAR_COLUMNS = ['id', 'website', 'make', 'model', 'year', 'mileage', 'location', 'seller_type', 'first_seen']
+PRICE_COLUMNS = ['id', 'car_id', 'price', 'date']
+
+PRICE_DTYPES = {'id': 'int64', 'car_id': 'int64', 'price': 'float64', 'date': 'datetime64[ns]'}
+CAR_DTYPES = {'id': 'int64', 'year': 'int64', 'mileage': 'int64', 'first_seen': 'datetime64[ns]'}
+
+# String columns stored as categoricals, which keeps them small in memory
+CATEGORY_COLUMNS = ['website', 'make', 'model', 'location', 'seller_type']
+
+
+class ColumnarStore:
+    """Date-partitioned columnar copy of the cars and prices tables"""
+
+    def __init__(self, path='analytics', format=DEFAULT_FORMAT, chunk_size=200000, buffer_rows=5000000):
+        if format == 'parquet' and pyarrow is None:
+            raise ImportError("Writing Parquet requires pyarrow (pip install pyarrow)")
+        self.path = path
+        self.format = format
+        # Rows read from SQLite per query, so each read only holds its lock briefly
+        self.chunk_size = chunk_size
+        # Price rows held in memory before they are written out, one part
+        # per date; a backfill of years of history writes few large parts
+        self.buffer_rows = buffer_rows
+        self.state_path = os.path.join(path, 'export_state.json')
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {'cars': 0, 'prices': 0, 'stale': []}
+        with open(self.state_path) as f:
+            state = json.load(f)
+        state.setdefault('stale', [])
+        return state
+
+    def _save_state(self, state):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def invalidate(self, days):
+        """Have the next export rebuild the price partitions of days (ISO dates)
+
+        For price rows already exported that were changed or deleted. Call it
+        before committing the change: a rebuild of partitions that didn't
+        change after all is harmless, a missed one is not.
+        """
+        days = {str(day) for day in days}
+        if not days:
+            return
+        state = self._load_state()
+        state['stale'] = sorted(set(state['stale']) | days)
+        self._save_state(state)
+
+    def reset(self, table):
+        """Drop a table's exported rows, so the next export copies it afresh"""
+        state = self._load_state()
+        shutil.rmtree(os.path.join(self.path, table), ignore_errors=True)
+        state[table] = 0
+        if table == 'prices':
+            state['stale'] = []
+        self._save_state(state)
+
+    def _write(self, df, directory, first_id):
+        os.makedirs(directory, exist_ok=True)
+        # Named after the first row id, so re-exporting after a crash
+        # overwrites the same part instead of duplicating it
+        path = os.path.join(directory, f'part-{first_id:012d}{EXTENSIONS[self.format]}')
+        if self.format == 'parquet':
+            df.to_parquet(path, index=False)
+        else:
+            df.to_pickle(path, compression={'method': 'gzip', 'compresslevel': 1})
+
+    def _read(self, path):
+        if path.endswith(EXTENSIONS['parquet']):
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    def _parts(self, directory):
+        return sorted(path for path in glob.glob(os.path.join(directory, 'part-*'))
+                      if path.endswith(tuple(EXTENSIONS.values())))
+
+    def _chunks(self, conn, table, columns, after_id):
+        """Read the rows added since after_id, chunk_size rows per query"""
+        while True:
+            df = pd.read_sql_query(
+                f"SELECT {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                conn, params=(after_id, self.chunk_size))
+            if df.empty:
+                return
+            yield df
+            after_id = int(df['id'].iloc[-1])
+
+    def export(self, db_path):
+        """Rebuild the invalidated price partitions, then append the cars and prices added since the last export
+
+        Returns the number of new (cars, prices) rows.
+        """
+        state = self._load_state()
+        exported = {'cars': 0, 'prices': 0}
+        # Read-only, and every chunk is a separate short read
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        try:
+            if state['stale']:
+                self._rebuild_prices(conn, state)
+            for df in self._chunks(conn, 'cars', CAR_COLUMNS, state['cars']):
+                self._write(df, os.path.join(self.path, 'cars'), int(df['id'].iloc[0]))
+                state['cars'] = int(df['id'].iloc[-1])
+                exported['cars'] += len(df)
+
+            pending = []
+            for df in self._chunks(conn, 'prices', PRICE_COLUMNS, state['prices']):
+                pending.append(df)
+                if sum(len(chunk) for chunk in pending) >= self.buffer_rows:
+                    exported['prices'] += self._write_prices(pending, state)
+                    pending = []
+            if pending:
+                exported['prices'] += self._write_prices(pending, state)
+        finally:
+            conn.close()
+
+        os.makedirs(self.path, exist_ok=True)
+        self._save_state(state)
+        logger.info(f"Exported {exported['cars']} cars and {exported['prices']} prices to {self.path}")
+        return exported['cars'], exported['prices']
+
+    def _rebuild_prices(self, conn, state):
+        """Rewrite the stale date partitions from the rows exported so far"""
+        days = state['stale']
+        for i in range(0, len(days), 500):
+            chunk = days[i:i + 500]
+            df = pd.read_sql_query(
+                f"SELECT {', '.join(PRICE_COLUMNS)} FROM prices WHERE date IN ({','.join('?' * len(chunk))}) "
+                f"AND id <= ? ORDER BY id", conn, params=(*chunk, state['prices']))
+            for day in chunk:
+                shutil.rmtree(os.path.join(self.path, 'prices', f'date={day}'), ignore_errors=True)
+            for day, partition in df.groupby('date', sort=False):
+                partition_dir = os.path.join(self.path, 'prices', f'date={day}')
+                self._write(partition.drop(columns='date'), partition_dir, int(partition['id'].iloc[0]))
+        logger.info(f"Rebuilt {len(days)} analytics price partitions")
+        state['stale'] = []
+        # Saved now, so a failure later in the export doesn't rebuild them again
+        self._save_state(state)
+
+    def _write_prices(self, chunks, state):
+        df = pd.concat(chunks, ignore_index=True)
+        first_id = int(df['id'].iloc[0])
+        for day, partition in df.groupby('date', sort=False):
+            partition_dir = os.path.join(self.path, 'prices', f'date={day}')
+            self._write(partition.drop(columns='date'), partition_dir, first_id)
+        state['prices'] = int(df['id'].iloc[-1])
+        return len(df)
+
+    def partitions(self):
+        """Dates with exported prices, oldest first"""
+        return sorted(os.path.basename(path)[len('date='):]
+                      for path in glob.glob(os.path.join(self.path, 'prices', 'date=*')))
+
+    def load_cars(self):
+        parts = [self._read(path) for path in self._parts(os.path.join(self.path, 'cars'))]
+        cars = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=CAR_COLUMNS)
+        cars['first_seen'] = pd.to_datetime(cars['first_seen'])
+        return cars.astype({**CAR_DTYPES, **{column: 'category' for column in CATEGORY_COLUMNS}})
+
+    def load_prices(self, start=None, end=None):
+        """Load the price rows scraped between start and end (ISO dates, inclusive)
+
+        Only the partitions in the date range are read.
+        """
+        frames = []
+        for day in self.partitions():
+            if (start and day < str(start)) or (end and day > str(end)):
+                continue
+            for path in self._parts(os.path.join(self.path, 'prices', f'date={day}')):
+                part = self._read(path)
+                part['date'] = pd.Timestamp(day)
+                frames.append(part)
+        prices = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=PRICE_COLUMNS)
+        prices['date'] = pd.to_datetime(prices['date'])
+        return prices.astype(PRICE_DTYPES)
+
+
+class MarketStats:
+    """Vectorized market statistics over an exported price history
+
+    Prices are only recorded when they change, so a listing's history is
+    its first price, each price change and the dates they were seen.
+    """
+
+    def __init__(self, store, start=None, end=None):
+        self.cars = store.load_cars()
+        prices = store.load_prices(start, end)
+        self.history = self._summarize(prices)
+        self.listings = self.history.join(self.cars.set_index('id'), how='inner')
+
+    def _summarize(self, prices):
+        """One row per car: first and current price and when they were recorded"""
+        prices = prices.sort_values(['car_id', 'date', 'id'])
+        grouped = prices.groupby('car_id')
+        return pd.DataFrame({
+            'first_price': grouped['price'].first(),
+            'price': grouped['price'].last(),
+            'first_date': grouped['date'].first(),
+            'last_date': grouped['date'].last(),
+            'changes': grouped['price'].size() - 1,
+        })
+
+    def _priced(self):
+        return self.listings[self.listings['price'] > 0]
+
+    def price_percentiles(self, by=('make', 'model', 'year'), percentiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+        """Count, mean and percentiles of current prices per segment"""
+        grouped = self._priced().groupby(list(by), observed=True)['price']
+        quantiles = grouped.quantile(list(percentiles)).unstack()
+        quantiles.columns = [f'p{round(q * 100)}' for q in quantiles.columns]
+        stats = pd.DataFrame({'count': grouped.size(), 'mean': grouped.mean()}).join(quantiles)
+        return stats.rename(columns={'p50': 'median'}).reset_index()
+
+    def depreciation_curves(self, by=('make', 'model'), band_km=20000, max_km=300000):
+        """Median current price per mileage band, one curve per segment"""
+        listings = self._priced()
+        listings = listings[(listings['mileage'] > 0) & (listings['mileage'] <= max_km)]
+        bands = (listings['mileage'] // band_km * band_km).rename('mileage_band')
+        grouped = listings.groupby([*(listings[column] for column in by), bands], observed=True)['price']
+        return pd.DataFrame({'count': grouped.size(), 'median_price': grouped.median()}).reset_index()
+
+    def price_per_km(self, by=('make', 'model'), min_listings=10):
+        """Least-squares slope of current price against mileage per segment
+
+        A slope of -0.05 means a segment loses about 5 cents per km driven.
+        """
+        listings = self._priced()
+        listings = listings[listings['mileage'] > 0]
+        x = listings['mileage'].astype(float)
+        y = listings['price']
+        frame = pd.DataFrame({'x': x, 'y': y, 'xy': x * y, 'xx': x * x})
+        grouped = frame.groupby([listings[column] for column in by], observed=True)
+        means = grouped.mean()
+        variance = means['xx'] - means['x'] ** 2
+        slope = (means['xy'] - means['x'] * means['y']) / variance.where(variance > 0)
+        stats = pd.DataFrame({'count': grouped.size(), 'price_per_km': slope,
+                              'mean_mileage': means['x'], 'mean_price': means['y']})
+        return stats[stats['count'] >= min_listings].reset_index()
+
+    def days_on_market(self, by=('make', 'model')):
+        """Days from first seen to the last recorded price, per segment
+
+        Unchanged prices aren't recorded, so this is a lower bound for
+        listings whose price hasn't moved in a while. The database tracks when
+        listings disappear; see CarPriceTracker.get_days_on_market.
+        """
+        listings = self.listings
+        first_seen = listings['first_seen'].fillna(listings['first_date'])
+        days = (listings['last_date'] - np.minimum(first_seen, listings['first_date'])).dt.days
+        grouped = days.rename('days').to_frame().groupby([listings[column] for column in by], observed=True)
+        return pd.DataFrame({
+            'count': grouped.size(),
+            'median_days': grouped['days'].median(),
+            'p90_days': grouped['days'].quantile(0.9),
+        }).reset_index()
@@ -0,0 +1,304 @@
+"""Read-only HTTP/JSON query API over the tracker database
+
+    python api.py --db car_prices.db --port 8080
+
+Endpoints (GET):
+
+    /price-changes?days=1                  cars repriced in the last days
+    /average-prices?make=&model=           current prices per make, model and year
+    /days-on-market?make=&model=           time to sell per make and model
+    /deals?max_score=                      listings priced furthest below similar cars
+    /listings?make=&model=&year_min=&year_max=&max_price=&location=&website=&active=
+    /status                                data generation, pool and cache counters
+
+Lists are returned as {"rows": [...], "next": cursor}. Pass cursor=<next>
+with the same parameters for the following page, until next is null;
+limit sets the page size. Makes, models and locations can be spelled any
+way, as in CarPriceTracker.
+
+Requests are served on their own threads from a pool of read-only
+connections. The database is in WAL mode, so each request reads a
+consistent snapshot without blocking the scraper's writes or waiting for
+them. Responses are cached per query and parameters, tagged with the data
+generation they were read at (see queries.py): once ingestion bumps the
+generation, every cached response is stale at once.
+"""
+import argparse
+import base64
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from deals import DEAL_THRESHOLD
+from normalize import Normalizer
+from queries import (PAGE_KEYS, average_prices, best_deals, days_on_market, listings, price_changes,
+                     read_generation)
+
+logger = logging.getLogger('CarTracker')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+# Seconds a request waits for a free connection before a 503
+POOL_TIMEOUT = 10
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class ReadPool:
+    """Fixed pool of read-only connections to one database"""
+
+    def __init__(self, db_path, size=4):
+        self.size = size
+        self.connections = queue.Queue()
+        for _ in range(size):
+            # Transactions are begun explicitly, one snapshot per request
+            conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False,
+                                   isolation_level=None)
+            self.connections.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=POOL_TIMEOUT):
+        conn = self.connections.get(timeout=timeout)
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        for _ in range(self.size):
+            self.connections.get().close()
+
+
+class ResultCache:
+    """LRU cache of encoded responses, each valid for one data generation"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, body):
+        if not self.max_entries:
+            return
+        with self.lock:
+            self.entries[key] = (generation, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+def encode_cursor(path, key):
+    """Opaque cursor continuing an endpoint's results after a row's sort key"""
+    return base64.urlsafe_b64encode(json.dumps([path, key]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(path, cursor):
+    try:
+        cursor_path, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise BadRequest(f"Invalid cursor: {cursor}")
+    if cursor_path != path or not isinstance(key, list):
+        raise BadRequest(f"Cursor is not for {path}")
+    return key
+
+
+def _int(params, name, default=None):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+
+
+def _float(params, name, default=None):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be a number")
+
+
+class QueryAPI:
+    """Parses requests, runs the queries on pooled connections and caches the responses"""
+
+    def __init__(self, db_path, pool_size=4, cache_entries=1024):
+        self.pool = ReadPool(db_path, pool_size)
+        self.cache = ResultCache(cache_entries)
+        self.normalizer = Normalizer()
+        self.started = time.time()
+        self.requests = 0
+        self.routes = {
+            '/price-changes': (price_changes, self._days),
+            '/average-prices': (average_prices, self._make_model),
+            '/days-on-market': (days_on_market, self._make_model),
+            '/deals': (best_deals, self._deals),
+            '/listings': (listings, self._listings),
+        }
+
+    def _days(self, params):
+        days = _int(params, 'days', 1)
+        if days < 0:
+            raise BadRequest("days must not be negative")
+        return {'days': days}
+
+    def _make_model(self, params):
+        make, model = params.get('make') or None, params.get('model') or None
+        if make:
+            make, model = self.normalizer.canonical(make, model)
+        return {'make': make, 'model': model}
+
+    def _deals(self, params):
+        return {'max_score': _float(params, 'max_score', DEAL_THRESHOLD)}
+
+    def _listings(self, params):
+        args = self._make_model(params)
+        args.update(year_min=_int(params, 'year_min'), year_max=_int(params, 'year_max'),
+                    max_price=_float(params, 'max_price'), website=params.get('website') or None)
+        location = params.get('location')
+        args['location'] = self.normalizer.location(location) if location else None
+        active = params.get('active', '1')
+        if active not in ('0', '1', 'all'):
+            raise BadRequest("active must be 0, 1 or all")
+        args['active'] = None if active == 'all' else active == '1'
+        return args
+
+    def handle(self, path, params):
+        """(status, response body) of a GET request"""
+        self.requests += 1
+        if path == '/status':
+            return 200, json.dumps(self.status()).encode('utf-8')
+        if path not in self.routes:
+            return 404, json.dumps({'error': f"Unknown endpoint {path}"}).encode('utf-8')
+        query, parse = self.routes[path]
+        try:
+            args = parse(params)
+            limit = _int(params, 'limit', DEFAULT_LIMIT)
+            if not 0 < limit <= MAX_LIMIT:
+                raise BadRequest(f"limit must be between 1 and {MAX_LIMIT}")
+            after = decode_cursor(path, params['cursor']) if params.get('cursor') else None
+        except BadRequest as e:
+            return 400, json.dumps({'error': str(e)}).encode('utf-8')
+
+        key = (path, tuple(sorted(args.items())), limit, params.get('cursor'))
+        try:
+            with self.pool.connection() as conn:
+                # The generation and the rows are read from one snapshot
+                conn.execute('BEGIN')
+                try:
+                    generation = read_generation(conn)
+                    body = self.cache.get(key, generation)
+                    if body is None:
+                        # One row more than asked for says whether there is a next page
+                        rows = query(conn, **args, after=after, limit=limit + 1)
+                        next_cursor = None
+                        if len(rows) > limit:
+                            next_cursor = encode_cursor(path, PAGE_KEYS[query](rows[limit - 1]))
+                        body = json.dumps({'rows': rows[:limit], 'next': next_cursor,
+                                           'generation': generation}).encode('utf-8')
+                        self.cache.put(key, generation, body)
+                finally:
+                    conn.execute('COMMIT')
+        except queue.Empty:
+            return 503, json.dumps({'error': "All database connections are busy"}).encode('utf-8')
+        except sqlite3.Error as e:
+            logger.error(f"Error answering {path}: {e}")
+            return 500, json.dumps({'error': "Database error"}).encode('utf-8')
+        return 200, body
+
+    def status(self):
+        with self.pool.connection() as conn:
+            generation = read_generation(conn)
+        return {'generation': generation, 'uptime': round(time.time() - self.started, 1),
+                'requests': self.requests, 'pool_size': self.pool.size, 'cache': self.cache.stats()}
+
+    def close(self):
+        self.pool.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        status, body = self.server.api.handle(url.path.rstrip('/') or '/', dict(parse_qsl(url.query)))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"API {self.address_string()} {format % args}")
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server for a QueryAPI; one thread per request"""
+
+    daemon_threads = True
+
+    def __init__(self, db_path, host='127.0.0.1', port=8080, pool_size=4, cache_entries=1024):
+        self.api = QueryAPI(db_path, pool_size, cache_entries)
+        super().__init__((host, port), _Handler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve from a background thread, e.g. next to the scraper"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.api.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='car_prices.db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--pool', type=int, default=4, help='read-only database connections')
+    parser.add_argument('--cache', type=int, default=1024, help='cached responses (0 to disable)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    server = QueryServer(args.db, args.host, args.port, args.pool, args.cache)
+    logger.info(f"Query API serving {args.db} on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
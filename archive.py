@@ -0,0 +1,269 @@
+"""Archive of every fetched page, so listings can be re-extracted later
+
+Marketplaces change their markup without notice (OLX's hashed class names
+especially), and the days a selector was broken would otherwise be lost
+for good. Every page fetched is kept here, compressed and addressed by the
+SHA-256 of its body, so a page that didn't change is stored once however
+many days it was fetched:
+
+    index.db              captures: day, site, page, url -> body hash
+                          blobs: body hash -> segment, offset, length, codec
+    segments/000001.pack  compressed bodies, appended back to back
+    segments/000002.pack  started once the last one passes SEGMENT_BYTES
+
+Segments are append-only and only written under the index's write lock,
+so worker processes (on this host or others sharing the directory) can
+archive side by side. Bodies are compressed with zstd when the zstandard
+package is installed and gzip otherwise; the codec is kept per blob.
+
+parse_captures re-runs the extractors over archived pages in a process
+pool, which is what CarPriceTracker.reparse backfills from.
+"""
+import gzip
+import hashlib
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from history import day_number
+from pipeline import _init_parse_worker, parse_page
+
+try:
+    import zstandard
+    DEFAULT_CODEC = 'zstd'
+except ImportError:
+    zstandard = None
+    DEFAULT_CODEC = 'gzip'
+
+logger = logging.getLogger('CarTracker')
+
+# A new segment is started once the current one would grow past this
+SEGMENT_BYTES = 64 * 1024 * 1024
+ZSTD_LEVEL = 6
+
+# What capture() did with a page's body
+ARCHIVE_NEW = 'new'
+ARCHIVE_DUPLICATE = 'duplicate'
+
+
+def _compress(body, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, mtime=0)
+
+
+def _decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("Reading zstd archive segments requires zstandard (pip install zstandard)")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class PageArchive:
+    """Content-addressed store of fetched pages, packed into segment files"""
+
+    def __init__(self, path='page_archive', codec=DEFAULT_CODEC, segment_bytes=SEGMENT_BYTES):
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError("zstd compression requires zstandard (pip install zstandard)")
+        self.path = path
+        self.codec = codec
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, 'segments'), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(path, 'index.db'), timeout=60, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.executescript('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            segment INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS captures (
+            id INTEGER PRIMARY KEY,
+            day INTEGER NOT NULL,
+            site TEXT NOT NULL,
+            page INTEGER,
+            url TEXT NOT NULL,
+            hash TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_captures_day ON captures (day, site);
+        -- Latest capture of a URL, for pages answered with a 304
+        CREATE INDEX IF NOT EXISTS idx_captures_url ON captures (url, id);
+        ''')
+        # Open segment files for reading, by number
+        self.readers = {}
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'segments', f'{segment:06d}.pack')
+
+    def capture(self, site, page, url, body=None, day=None):
+        """Record that a page was fetched; returns ARCHIVE_NEW, ARCHIVE_DUPLICATE or None
+
+        body is the raw response body. Without one (a 304), the page is
+        recorded with the URL's last archived body; None is returned if
+        there isn't one.
+        """
+        day = day_number(day or date.today())
+        digest = hashlib.sha256(body).hexdigest() if body is not None else None
+        with self.lock:
+            # The write lock is held from the lookup to the append, so no
+            # other process can append to the segment at the same time
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if digest is None:
+                    row = self.conn.execute('SELECT hash FROM captures WHERE url = ? ORDER BY id DESC LIMIT 1',
+                                            (url,)).fetchone()
+                    if row is None:
+                        self.conn.execute('ROLLBACK')
+                        return None
+                    digest, status = row[0], ARCHIVE_DUPLICATE
+                elif self.conn.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest,)).fetchone():
+                    status = ARCHIVE_DUPLICATE
+                else:
+                    self._append(digest, body)
+                    status = ARCHIVE_NEW
+                self.conn.execute('INSERT INTO captures (day, site, page, url, hash) VALUES (?, ?, ?, ?, ?)',
+                                  (day, site, page, url, digest))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return status
+
+    def _append(self, digest, body):
+        data = _compress(body, self.codec)
+        segment = self.conn.execute('SELECT COALESCE(MAX(segment), 1) FROM blobs').fetchone()[0]
+        path = self._segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) + len(data) > self.segment_bytes:
+            segment += 1
+            path = self._segment_path(segment)
+        with open(path, 'ab') as f:
+            # Bytes left by a write whose index entry never committed are
+            # skipped rather than overwritten
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.conn.execute('''
+        INSERT INTO blobs (hash, segment, offset, length, codec, size) VALUES (?, ?, ?, ?, ?, ?)
+        ''', (digest, segment, offset, len(data), self.codec, len(body)))
+
+    def read(self, digest):
+        """The body stored under a hash, decoded as text"""
+        with self.lock:
+            row = self.conn.execute('SELECT segment, offset, length, codec FROM blobs WHERE hash = ?',
+                                    (digest,)).fetchone()
+            if row is None:
+                raise KeyError(digest)
+            segment, offset, length, codec = row
+            f = self.readers.get(segment)
+            if f is None:
+                f = self.readers[segment] = open(self._segment_path(segment), 'rb')
+            f.seek(offset)
+            data = f.read(length)
+        return _decompress(data, codec).decode('utf-8', errors='replace')
+
+    def captures(self, start, end=None, sites=None):
+        """(day, site, page, url, hash) of the pages fetched from start to end, inclusive
+
+        Only the last capture of a URL on a given day is returned, in day
+        order.
+        """
+        start = day_number(start)
+        end = day_number(end) if end is not None else start
+        rows = self.conn.execute('''
+        SELECT day, site, page, url, hash FROM captures
+        WHERE id IN (SELECT MAX(id) FROM captures WHERE day BETWEEN ? AND ? GROUP BY day, url)
+        ORDER BY day, id
+        ''', (start, end)).fetchall()
+        return [row for row in rows if sites is None or row[1] in sites]
+
+    def stats(self):
+        """Pages captured, distinct bodies, and their raw and compressed sizes"""
+        captures = self.conn.execute('SELECT COUNT(*) FROM captures').fetchone()[0]
+        blobs, size, stored = self.conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(length), 0) FROM blobs').fetchone()
+        return {'captures': captures, 'blobs': blobs, 'bytes': size, 'stored_bytes': stored}
+
+    def close(self):
+        with self.lock:
+            for f in self.readers.values():
+                f.close()
+            self.readers.clear()
+            self.conn.close()
+
+
+# Archive of a reparse worker process, opened once per process
+_archive = None
+
+
+def _init_reparse_worker(path, adapters):
+    global _archive
+    _archive = PageArchive(path)
+    _init_parse_worker(adapters)
+
+
+def reparse_blob(site, digest):
+    """Extract the listings of one archived page (runs in a reparse worker)"""
+    return parse_page(site, _archive.read(digest))
+
+
+def parse_captures(archive, captures, adapters, workers=None, window=64):
+    """Yield (capture, listings) for archived captures, in order
+
+    A body captured on several days is parsed once. Workers read and
+    decompress the bodies themselves, so only hashes and listings cross
+    process boundaries, and parsing runs at most window bodies ahead of
+    the caller. Pages that fail to parse are logged and skipped.
+    """
+    workers = min(4, os.cpu_count() or 1) if workers is None else workers
+    captures = [capture for capture in captures if capture[1] in adapters]
+    keys = [(site, digest) for _, site, _, _, digest in captures]
+    # Parsed bodies are dropped once no later capture needs them
+    remaining = Counter(keys)
+    bodies = list(remaining)
+    first = {body: i for i, body in enumerate(bodies)}
+    pool = None
+    if workers:
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_reparse_worker, initargs=(archive.path, adapters))
+    else:
+        _init_parse_worker(adapters)
+
+    futures = {}
+    parsed = {}
+    submitted = 0
+    try:
+        for capture, key in zip(captures, keys):
+            if pool:
+                while submitted < min(len(bodies), first[key] + window):
+                    futures[bodies[submitted]] = pool.submit(reparse_blob, *bodies[submitted])
+                    submitted += 1
+            if key not in parsed:
+                try:
+                    if pool:
+                        parsed[key] = futures.pop(key).result()[0]
+                    else:
+                        parsed[key] = parse_page(key[0], archive.read(key[1]))[0]
+                except Exception as e:
+                    logger.error(f"Error reparsing archived {key[0]} page {key[1][:12]}: {e}")
+                    parsed[key] = None
+            listings = parsed[key]
+            remaining[key] -= 1
+            if not remaining[key]:
+                del parsed[key]
+            if listings is not None:
+                yield capture, listings
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
@@ -0,0 +1,1360 @@
+"""Benchmarks for the car price tracker
+
+Run with:
+    python benchmark.py ingest --listings 5000
+    python benchmark.py fetch --pages 6 --latency 0.2
+    python benchmark.py queries --cars 200000 --prices-per-car 10
+    python benchmark.py parse --repeat 20
+    python benchmark.py cache --pages 6
+    python benchmark.py analytics --cars 200000 --prices-per-car 10
+    python benchmark.py dedupe --listings 30000
+    python benchmark.py workers --pages 40 --latency 0.2
+    python benchmark.py history --cars 200000 --prices-per-car 10
+    python benchmark.py alerts --searches 20000 --listings 20000
+    python benchmark.py archive --days 30 --pages 20
+    python benchmark.py dimensions --cars 200000
+    python benchmark.py api --cars 100000 --clients 8 --seconds 10
+    python benchmark.py scheduler --days 28
+
+Regression suite, one synthetic database per size, results saved as JSON:
+    python benchmark.py suite --sizes 10000 100000 1000000 --output bench_results.json
+    python benchmark.py compare baseline.json bench_results.json
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import resource
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import date, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from alerts import Mailer, SavedSearch, SearchIndex, match
+from api import QueryServer
+from archive import PageArchive
+from car_price_tracker import CarPriceTracker
+from fetcher import HostPolicy
+from history import day_number
+from normalize import Normalizer
+from report import LIVE_CARS
+from scheduler import Crawl, compare_policies
+from sites import SITE_ADAPTERS, ExtractionEngine, Listing
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+MAKES = ['Chevrolet', 'Toyota', 'Hyundai', 'Kia', 'Nissan', 'Mazda', 'Ford', 'Volkswagen', 'Suzuki', 'Renault']
+MODELS = ['Aveo', 'Corolla', 'Tucson', 'Sportage', 'Sentra', 'CX-5', 'Explorer', 'Gol', 'Vitara', 'Duster']
+LOCATIONS = ['Quito', 'Guayaquil', 'Cuenca', 'Ambato', 'Manta', 'Loja']
+
+
+def make_listings(count, seed=0, website='PatioTuerca'):
+    """Build a list of synthetic parsed listings"""
+    rng = random.Random(seed)
+    listings = []
+    for i in range(count):
+        make = rng.choice(MAKES)
+        model = rng.choice(MODELS)
+        listings.append(Listing(
+            website=website,
+            listing_id=f"{website.lower()}-{i}",
+            title=f"{make} {model}",
+            make=make,
+            model=model,
+            year=rng.randint(2005, 2024),
+            mileage=rng.randint(0, 250000),
+            location=rng.choice(LOCATIONS),
+            url=f"https://example.com/{website.lower()}/{i}",
+            seller_type='Unknown',
+            features="",
+            price=float(rng.randint(3000, 60000)),
+        ))
+    return listings
+
+
+def reprice(listings, fraction, seed=1):
+    """Return a copy of the listings with a fraction of prices changed"""
+    rng = random.Random(seed)
+    repriced = []
+    for listing in listings:
+        if rng.random() < fraction:
+            listing = listing._replace(price=listing.price - rng.randint(100, 2000))
+        repriced.append(listing)
+    return repriced
+
+
+def create_legacy_tables(conn):
+    """The cars and prices tables as they were before the schema migrations"""
+    conn.execute('''
+    CREATE TABLE cars (
+        id INTEGER PRIMARY KEY, listing_id TEXT, website TEXT, title TEXT, make TEXT,
+        model TEXT, year INTEGER, mileage INTEGER, location TEXT, url TEXT UNIQUE,
+        seller_type TEXT, features TEXT, first_seen DATE
+    )''')
+    conn.execute('''
+    CREATE TABLE prices (
+        id INTEGER PRIMARY KEY, car_id INTEGER, price REAL, date DATE,
+        FOREIGN KEY (car_id) REFERENCES cars (id)
+    )''')
+
+
+def legacy_store_data(db_path, website, listing_id, title, make, model, year, mileage, location, url, seller_type,
+                      features, price):
+    """store_data as it was before store_listings, kept to measure against"""
+    today = date.today()
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    result = None
+
+    try:
+        cursor.execute('SELECT id FROM cars WHERE url = ?', (url,))
+        car_result = cursor.fetchone()
+
+        if car_result:
+            car_id = car_result[0]
+            cursor.execute('''
+            SELECT price FROM prices
+            WHERE car_id = ?
+            ORDER BY date DESC LIMIT 1
+            ''', (car_id,))
+            last_price_result = cursor.fetchone()
+
+            if last_price_result and last_price_result[0] != price:
+                cursor.execute('''
+                INSERT INTO prices (car_id, price, date)
+                VALUES (?, ?, ?)
+                ''', (car_id, price, today))
+                result = 'updated'
+        else:
+            cursor.execute('''
+            INSERT INTO cars (listing_id, website, title, make, model, year, mileage, location, url, seller_type, features, first_seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (listing_id, website, title, make, model, year, mileage, location, url, seller_type, features, today))
+            car_id = cursor.lastrowid
+            cursor.execute('''
+            INSERT INTO prices (car_id, price, date)
+            VALUES (?, ?, ?)
+            ''', (car_id, price, today))
+            result = 'new'
+
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+
+    finally:
+        conn.close()
+
+    return result
+
+
+def bench_ingest(count, changed_fraction=0.2):
+    """Compare the original per-listing store_data against batched store_listings"""
+    first_run = make_listings(count)
+    second_run = reprice(first_run, changed_fraction)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Per-row path: one connection and one commit per listing, on the
+        # schema it was written for
+        db_path = os.path.join(tmp, 'per_row.db')
+        conn = sqlite3.connect(db_path)
+        create_legacy_tables(conn)
+        conn.close()
+        start = time.perf_counter()
+        for run in (first_run, second_run):
+            for listing in run:
+                legacy_store_data(db_path, **listing._asdict())
+        results['per_row'] = time.perf_counter() - start
+
+        # Batched path: one transaction per run
+        tracker = CarPriceTracker(db_path=os.path.join(tmp, 'batched.db'), cache_path=None)
+        start = time.perf_counter()
+        counts = [tracker.store_listings(run) for run in (first_run, second_run)]
+        results['batched'] = time.perf_counter() - start
+
+    rows = count * 2
+    print(f"Ingesting {count} listings twice ({changed_fraction:.0%} repriced on the second run)")
+    print(f"  new/updated per run: {counts}")
+    for name, elapsed in results.items():
+        print(f"  {name:10s} {elapsed:8.3f}s  {rows / elapsed:10.0f} listings/sec")
+    print(f"  speedup    {results['per_row'] / results['batched']:8.1f}x")
+    return results
+
+
+class FixtureServer:
+    """Local HTTP stand-in for a marketplace, serving recorded pages
+
+    Requests for ?page=N get fixtures/<prefix>_page<N>.html, cycling through
+    the recorded pages when N is larger than what was recorded. With etag
+    set, pages carry an ETag and conditional requests get a 304.
+    """
+
+    def __init__(self, prefix, latency=0.0, etag=True):
+        self.pages = sorted(
+            (os.path.join(FIXTURES_DIR, name) for name in os.listdir(FIXTURES_DIR)
+             if re.fullmatch(rf'{prefix}_page\d+\.html', name)),
+            key=lambda path: int(re.search(r'(\d+)\.html$', path).group(1)))
+        self.latency = latency
+        self.etag = etag
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def netloc(self):
+        return urlsplit(self.base_url).netloc
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    page = int(parse_qs(urlsplit(self.path).query).get('page', ['1'])[0])
+                    with open(server.pages[(page - 1) % len(server.pages)], 'rb') as f:
+                        body = f.read()
+                    time.sleep(server.latency)
+                    etag = f'"{hashlib.md5(body).hexdigest()}"'
+                    if server.etag and self.headers.get('If-None-Match') == etag:
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    if server.etag:
+                        self.send_header('ETag', etag)
+                    self.send_header('Content-Type', 'text/html; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fixture_tracker(db_path, servers, min_interval=0.0, max_concurrency=2, cache_path=None, analytics_path=None,
+                    job_queue=None, queue_workers=4):
+    """Build a tracker whose sites point at local fixture servers"""
+    return CarPriceTracker(
+        db_path=db_path,
+        cache_path=cache_path,
+        analytics_path=analytics_path,
+        metrics_file=None,
+        run_log=None,
+        job_queue=job_queue,
+        queue_workers=queue_workers,
+        site_urls={site: server.base_url + '/results?page={page}' for site, server in servers.items()},
+        host_policies={server.netloc: HostPolicy(min_interval, max_concurrency) for server in servers.values()},
+    )
+
+
+def bench_fetch(pages, latency, min_interval=0.0, max_concurrency=2):
+    """Compare one-site-at-a-time scraping against fetching all sites together"""
+    results = {}
+    with FixtureServer('patiotuerca', latency) as pt, FixtureServer('olx', latency) as olx:
+        servers = {'PatioTuerca': pt, 'OLX': olx}
+        with tempfile.TemporaryDirectory() as tmp:
+            # Sites one after the other, one request in flight per site
+            tracker = fixture_tracker(os.path.join(tmp, 'sequential.db'), servers, min_interval, 1)
+            start = time.perf_counter()
+            counts = [tracker.scrape_sites({site: pages}) for site in servers]
+            results['sequential'] = time.perf_counter() - start
+
+            tracker = fixture_tracker(os.path.join(tmp, 'concurrent.db'), servers, min_interval, max_concurrency)
+            start = time.perf_counter()
+            counts.append(tracker.scrape_sites({site: pages for site in servers}))
+            results['concurrent'] = time.perf_counter() - start
+
+        max_in_flight = {site: server.max_in_flight for site, server in servers.items()}
+
+    print(f"Fetching {pages} pages from each of {len(servers)} fixture sites ({latency * 1000:.0f}ms latency)")
+    print(f"  new/updated: {counts}")
+    print(f"  max requests in flight per host: {max_in_flight}")
+    for name, elapsed in results.items():
+        print(f"  {name:10s} {elapsed:8.3f}s  {pages * len(servers) / elapsed:8.1f} pages/sec")
+    return results
+
+
+# Change queries as they were before the latest_prices table, kept to
+# measure against. The old get_price_changes referenced p.car_id from inside
+# a derived table, which SQLite rejects, so the correlated lookup is moved
+# to a WHERE clause here; the per-row cost is the same.
+LEGACY_QUERIES = {
+    'get_price_changes': '''
+        SELECT c.id, c.title, c.make, c.model, c.year, c.url,
+               p1.price as current_price,
+               p2.price as previous_price,
+               ((p1.price - p2.price) / p2.price * 100) as price_change_percent
+        FROM cars c
+        JOIN prices p1 ON c.id = p1.car_id
+        JOIN (
+            SELECT car_id, MAX(date) as max_date
+            FROM prices
+            GROUP BY car_id
+        ) latest ON p1.car_id = latest.car_id AND p1.date = latest.max_date
+        JOIN (
+            SELECT p.car_id, p.price
+            FROM prices p
+            WHERE p.date = (
+                SELECT MAX(date) FROM prices
+                WHERE car_id = p.car_id
+                AND date < (SELECT MAX(date) FROM prices GROUP BY car_id HAVING car_id = p.car_id)
+            )
+        ) p2 ON c.id = p2.car_id
+        WHERE p1.price != p2.price
+        ORDER BY price_change_percent
+    ''',
+    'get_average_prices': '''
+        SELECT c.make, c.model, c.year,
+               AVG(p.price) as avg_price,
+               MIN(p.price) as min_price,
+               MAX(p.price) as max_price,
+               COUNT(*) as count
+        FROM cars c
+        JOIN (
+            SELECT car_id, MAX(date) as max_date
+            FROM prices
+            GROUP BY car_id
+        ) latest ON c.id = latest.car_id
+        JOIN prices p ON latest.car_id = p.car_id AND latest.max_date = p.date
+        GROUP BY c.make, c.model, c.year ORDER BY c.make, c.model, c.year
+    ''',
+}
+
+
+def build_history_db(db_path, cars, prices_per_car, days=3 * 365, seed=0):
+    """Write a pre-migration database with a synthetic price history
+
+    Every car gets prices_per_car price changes spread over the last `days`
+    days, so the prices table holds cars * prices_per_car rows.
+    """
+    rng = random.Random(seed)
+    today = date.today()
+    conn = sqlite3.connect(db_path)
+    create_legacy_tables(conn)
+
+    def car_rows():
+        for car_id in range(1, cars + 1):
+            make = rng.choice(MAKES)
+            model = rng.choice(MODELS)
+            first_seen = today - timedelta(days=rng.randint(prices_per_car, days))
+            yield (car_id, str(car_id), 'PatioTuerca', f"{make} {model}", make, model,
+                   rng.randint(2005, 2024), rng.randint(0, 250000), rng.choice(LOCATIONS),
+                   f"https://example.com/car/{car_id}", 'Unknown', "", first_seen)
+
+    def price_rows():
+        for car_id in range(1, cars + 1):
+            price = float(rng.randint(3000, 60000))
+            offsets = sorted(rng.sample(range(days), prices_per_car), reverse=True)
+            for offset in offsets:
+                yield (car_id, price, today - timedelta(days=offset))
+                price = max(price - rng.randint(100, 1500), 500.0)
+
+    conn.executemany('INSERT INTO cars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', car_rows())
+    conn.executemany('INSERT INTO prices (car_id, price, date) VALUES (?, ?, ?)', price_rows())
+    conn.commit()
+    conn.close()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_queries(cars, prices_per_car, legacy=False):
+    """Time the change queries and the schema migration on a synthetic history"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'history.db')
+        _, results['build'] = timed(build_history_db, db_path, cars, prices_per_car)
+
+        if legacy:
+            conn = sqlite3.connect(db_path)
+            for name, query in LEGACY_QUERIES.items():
+                _, results[f'legacy {name}'] = timed(lambda: conn.execute(query).fetchall())
+            conn.close()
+
+        tracker, results['migration'] = timed(CarPriceTracker, db_path=db_path, cache_path=None)
+        _, results['get_price_changes'] = timed(tracker.get_price_changes, days=3650)
+        _, results['get_price_changes (1 day)'] = timed(tracker.get_price_changes, days=1)
+        _, results['get_average_prices'] = timed(tracker.get_average_prices)
+        _, results['get_average_prices (make)'] = timed(tracker.get_average_prices, make='Toyota')
+        _, results['score_deals'] = timed(tracker.score_deals)
+        _, results['score_deals (nothing new)'] = timed(tracker.score_deals)
+        _, results['generate_report'] = timed(tracker.generate_report, os.path.join(tmp, 'report.html'))
+        _, results['generate_report (unchanged)'] = timed(tracker.generate_report, os.path.join(tmp, 'report.html'))
+
+    print(f"{cars} cars, {cars * prices_per_car} price rows")
+    for name, elapsed in results.items():
+        print(f"  {name:30s} {elapsed:8.3f}s")
+    return results
+
+
+# The same questions asked of the old prices table and of price_history;
+# {day} is a day number, {date} the same day as a date string
+HISTORY_QUERIES = {
+    'car history': (
+        'SELECT price, date FROM prices WHERE car_id = ? ORDER BY date, id',
+        'SELECT price_cents, start_day, end_day FROM price_history WHERE car_id = ? ORDER BY start_day, id',
+    ),
+    'prices as of a day': (
+        """SELECT car_id, price FROM (
+               SELECT car_id, price, ROW_NUMBER() OVER (PARTITION BY car_id ORDER BY date DESC, id DESC) as newest
+               FROM prices WHERE date <= '{date}'
+           ) WHERE newest = 1""",
+        """SELECT car_id, price_cents FROM price_history
+           WHERE start_day <= {day} AND (end_day > {day} OR end_day IS NULL)""",
+    ),
+    'changes in 30 days': (
+        "SELECT COUNT(*) FROM prices WHERE date > date('{date}', '-30 days')",
+        'SELECT COUNT(*) FROM price_history WHERE start_day > {day} - 30',
+    ),
+}
+
+
+def bench_history(cars, prices_per_car, lookups=2000):
+    """File size and query times of the price history before and after the interval format"""
+    results = {}
+    rng = random.Random(3)
+    car_ids = [rng.randint(1, cars) for _ in range(lookups)]
+    as_of = date.today() - timedelta(days=200)
+
+    def run_queries(conn, schema):
+        index = 0 if schema == 'prices' else 1
+        for name, queries in HISTORY_QUERIES.items():
+            query = queries[index].format(day=day_number(as_of), date=as_of.isoformat())
+            if '?' in query:
+                _, elapsed = timed(lambda: [conn.execute(query, (car_id,)).fetchall() for car_id in car_ids])
+            else:
+                _, elapsed = timed(lambda: conn.execute(query).fetchall())
+            results[(schema, name)] = elapsed
+
+    def size(path):
+        """Bytes taken by the price history table and its indexes"""
+        conn = sqlite3.connect(path)
+        conn.execute('VACUUM')
+        used = conn.execute('''
+        SELECT SUM(pgsize) FROM dbstat
+        WHERE name IN ('prices', 'price_history', 'idx_prices_car_date', 'idx_price_history_car')
+        ''').fetchone()[0]
+        conn.close()
+        return used
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'history.db')
+        build_history_db(db_path, cars, prices_per_car)
+        conn = sqlite3.connect(db_path)
+        # The old schema's own index, as created by the first migration
+        conn.execute('CREATE INDEX idx_prices_car_date ON prices (car_id, date)')
+        conn.commit()
+        conn.close()
+        results[('prices', 'size')] = size(db_path)
+        conn = sqlite3.connect(db_path)
+        run_queries(conn, 'prices')
+        conn.close()
+
+        tracker, results[('price_history', 'migration')] = timed(
+            CarPriceTracker, db_path=db_path, cache_path=None, analytics_path=None, metrics_file=None, run_log=None)
+        results[('price_history', 'size')] = size(db_path)
+        conn = sqlite3.connect(db_path)
+        run_queries(conn, 'price_history')
+        conn.close()
+
+        removed, results[('retention', 'compaction')] = timed(tracker.compact_history, force=True)
+        results[('retention', 'size')] = size(db_path)
+
+    print(f"{cars} cars, {cars * prices_per_car} price changes over 3 years, {lookups} car lookups")
+    for (schema, name), value in results.items():
+        if name == 'size':
+            print(f"  {schema:14s} {'history size':22s} {value / 1024 / 1024:8.1f} MB")
+        else:
+            print(f"  {schema:14s} {name:22s} {value:8.3f}s")
+    print(f"  retention merged away {removed} intervals")
+    return results
+
+
+def bench_analytics(cars, prices_per_car):
+    """Time the columnar export and the market statistics on a synthetic history"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'history.db')
+        build_history_db(db_path, cars, prices_per_car)
+        tracker = CarPriceTracker(db_path=db_path, cache_path=None, analytics_path=os.path.join(tmp, 'analytics'))
+
+        _, results['export (full)'] = timed(tracker.export_analytics)
+        _, results['export (nothing new)'] = timed(tracker.export_analytics)
+        stats, results['load'] = timed(tracker.market_stats)
+        _, results['price_percentiles'] = timed(stats.price_percentiles)
+        _, results['depreciation_curves'] = timed(stats.depreciation_curves)
+        _, results['price_per_km'] = timed(stats.price_per_km)
+        _, results['days_on_market'] = timed(stats.days_on_market)
+        start = (date.today() - timedelta(days=90)).isoformat()
+        _, results['load (last 90 days)'] = timed(tracker.market_stats, start=start)
+
+    print(f"{cars} cars, {cars * prices_per_car} price rows")
+    for name, elapsed in results.items():
+        print(f"  {name:30s} {elapsed:8.3f}s")
+    return results
+
+
+def bench_dedupe(count, duplicate_fraction=0.3, seed=5):
+    """Link OLX copies of PatioTuerca listings and measure accuracy
+
+    A copy has no mileage (like real OLX cards) and a price within 4% of
+    the original.
+    """
+    rng = random.Random(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tracker = CarPriceTracker(db_path=os.path.join(tmp, 'dedupe.db'), cache_path=None, analytics_path=None)
+        originals = make_listings(count, seed=1)
+        tracker.store_listings(originals)
+        _, results['resolve (one site)'] = timed(tracker.resolve_duplicates)
+
+        copied = rng.sample(originals, int(count * duplicate_fraction))
+        copies = [listing._replace(website='OLX', url=listing.url + '?olx', mileage=0,
+                                   price=round(listing.price * rng.uniform(0.96, 1.04)))
+                  for listing in copied]
+        # Unrelated OLX listings, to catch false matches
+        others = [listing._replace(website='OLX', url=listing.url + '?other', mileage=0)
+                  for listing in make_listings(len(copied), seed=2)]
+        tracker.store_listings(copies + others)
+        _, results['resolve (new site)'] = timed(tracker.resolve_duplicates)
+
+        conn = sqlite3.connect(tracker.db_path)
+        ids = dict(conn.execute('SELECT url, id FROM cars'))
+        entities = dict(conn.execute('SELECT car_id, entity_id FROM listing_entities'))
+        conn.close()
+        found = sum(1 for listing in copied
+                    if entities[ids[listing.url + '?olx']] == ids[listing.url])
+        linked = sum(1 for car_id, entity_id in entities.items() if car_id != entity_id)
+
+    print(f"{count} listings, {len(copied)} copied to another site")
+    for name, elapsed in results.items():
+        print(f"  {name:30s} {elapsed:8.3f}s")
+    print(f"  recall {found / len(copied):.1%}, precision {found / linked if linked else 0:.1%}")
+    return results
+
+
+def bench_cache(pages, latency=0.05):
+    """Repeat a scrape against unchanged fixture pages with the response cache on"""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, etag in (('etag', True), ('body hash', False)):
+            with FixtureServer('patiotuerca', latency, etag) as pt, FixtureServer('olx', latency, etag) as olx:
+                servers = {'PatioTuerca': pt, 'OLX': olx}
+                tracker = fixture_tracker(os.path.join(tmp, f'{name}.db'), servers,
+                                          cache_path=os.path.join(tmp, f'{name}_cache.db'))
+                for run in ('first run', 'second run'):
+                    tracker.cache.reset_stats()
+                    _, elapsed = timed(tracker.scrape_sites, {site: pages for site in servers})
+                    results[(name, run)] = dict(tracker.cache.stats, elapsed=elapsed)
+                tracker.fetcher.close()
+
+    print(f"Scraping {pages} pages per site twice with unchanged pages")
+    for (name, run), stats in results.items():
+        print(f"  {name:10s} {run:11s} {stats['elapsed']:6.3f}s  not modified {stats['not_modified']:3d}  "
+              f"unchanged {stats['unchanged']:3d}  misses {stats['misses']:3d}  "
+              f"saved {stats['bytes_saved'] / 1024:7.0f} KB")
+    return results
+
+
+def bench_workers(pages, latency, worker_counts=(1, 2, 4), min_interval=0.0, max_concurrency=4):
+    """Scrape through the job queue with a growing number of worker processes
+
+    Checks that the per-host concurrency limit holds across all workers.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in worker_counts:
+            with FixtureServer('patiotuerca', latency) as pt, FixtureServer('olx', latency) as olx:
+                servers = {'PatioTuerca': pt, 'OLX': olx}
+                tracker = fixture_tracker(os.path.join(tmp, f'{workers}.db'), servers, min_interval, max_concurrency,
+                                          job_queue=os.path.join(tmp, f'{workers}_jobs.db'), queue_workers=workers)
+                totals, elapsed = timed(tracker.scrape_sites, {site: pages for site in servers})
+                results[workers] = {
+                    'elapsed': elapsed,
+                    'pages_per_sec': pages * len(servers) / elapsed,
+                    'new': sum(new for new, _ in totals.values()),
+                    'max_in_flight': max(server.max_in_flight for server in servers.values()),
+                }
+
+    print(f"Scraping {pages} pages from each of 2 fixture sites through the job queue "
+          f"({latency * 1000:.0f}ms latency, at most {max_concurrency} requests per host)")
+    for workers, result in results.items():
+        print(f"  {workers} workers  {result['elapsed']:7.3f}s  {result['pages_per_sec']:7.1f} pages/sec  "
+              f"new {result['new']:5d}  max in flight per host {result['max_in_flight']}")
+    return results
+
+
+class SmtpStandIn:
+    """Local SMTP server that accepts every message and keeps it
+
+    Speaks just enough SMTP for smtplib without TLS or auth; messages are
+    kept as (sender, recipients, data) and connections are counted.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                with stand_in.lock:
+                    stand_in.connections += 1
+                sender, recipients = None, []
+                self.reply('220 localhost SMTP stand-in')
+                for line in self.rfile:
+                    command = line.decode('utf-8', 'replace').strip()
+                    verb = command[:4].upper()
+                    if verb in ('EHLO', 'HELO'):
+                        self.reply('250 localhost')
+                    elif verb == 'MAIL':
+                        sender, recipients = command[10:], []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        recipients.append(command[8:])
+                        self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        for data_line in self.rfile:
+                            if data_line in (b'.\r\n', b'.\n'):
+                                break
+                            data.append(data_line)
+                        with stand_in.lock:
+                            stand_in.messages.append((sender, recipients, b''.join(data)))
+                        self.reply('250 OK')
+                    elif verb in ('RSET', 'NOOP'):
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Command not implemented')
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_searches(count, users, seed=7):
+    """Build synthetic saved searches spread over users"""
+    rng = random.Random(seed)
+    searches = []
+    for i in range(count):
+        year_min = rng.choice([None, rng.randint(2005, 2022)])
+        searches.append(SavedSearch(
+            id=i + 1,
+            email=f"user{rng.randrange(users)}@example.com",
+            name=f"search {i + 1}",
+            make=rng.choice(MAKES) if rng.random() < 0.9 else None,
+            model=rng.choice(MODELS) if rng.random() < 0.8 else None,
+            year_min=year_min,
+            year_max=year_min + rng.randint(0, 6) if year_min else None,
+            max_price=float(rng.randint(5000, 40000)) if rng.random() < 0.7 else None,
+            location=rng.choice(LOCATIONS) if rng.random() < 0.3 else None,
+            min_drop_percent=rng.choice([None, 5, 10]),
+        ))
+    return searches
+
+
+def bench_alerts(searches, listings, users=500):
+    """Saved-search matching through the index vs checking every search, and digest delivery"""
+    saved = make_searches(searches, users)
+    first_run = make_listings(listings)
+    second_run = reprice(first_run, 0.2)
+    results = {}
+
+    index, results['build index'] = timed(SearchIndex, saved)
+    changes = [(listing, None) for listing in first_run] + \
+              [(listing, old.price) for listing, old in zip(second_run, first_run) if listing.price != old.price]
+
+    def with_index():
+        return sum(1 for listing, previous in changes for _ in index.matches(listing, previous))
+
+    def scan_all():
+        return sum(1 for listing, previous in changes for search in saved if match(search, listing, previous))
+
+    indexed, results['match (index)'] = timed(with_index)
+    scanned, results['match (every search)'] = timed(scan_all)
+    assert indexed == scanned, (indexed, scanned)
+
+    with tempfile.TemporaryDirectory() as tmp, SmtpStandIn() as smtp:
+        tracker = CarPriceTracker(db_path=os.path.join(tmp, 'alerts.db'), cache_path=None, analytics_path=None,
+                                  metrics_file=None, run_log=None, smtp_host='127.0.0.1', smtp_port=smtp.port,
+                                  smtp_user='tracker@example.com', smtp_password=None, smtp_ssl=False)
+        _, results['ingest (no searches)'] = timed(tracker.store_listings, first_run[:listings // 2])
+        conn = sqlite3.connect(tracker.db_path)
+        conn.executemany('''
+        INSERT INTO saved_searches (id, email, name, make, model, year_min, year_max, max_price, location,
+                                    min_drop_percent)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', saved)
+        conn.commit()
+        tracker.load_saved_searches()
+        _, results['ingest (with searches)'] = timed(tracker.store_listings, first_run[listings // 2:])
+        tracker.store_listings(second_run)
+        queued = conn.execute('SELECT COUNT(*) FROM alerts').fetchone()[0]
+        conn.close()
+
+        digests, results['digests (end to end)'] = timed(tracker.send_alert_digests)
+        messages = [(recipients[0], data.decode('utf-8', 'replace')) for _, recipients, data in smtp.messages]
+
+        # Resend the same emails over one connection, then one connection each
+        mailer = Mailer('127.0.0.1', smtp.port, 'tracker@example.com', use_ssl=False)
+
+        def send_all():
+            for email, body in messages:
+                mailer.send(email, "Saved search alerts", body)
+
+        def send_pooled():
+            with mailer:
+                send_all()
+
+        connections = smtp.connections
+        _, results['send (pooled)'] = timed(send_pooled)
+        pooled_connections = smtp.connections - connections
+        _, results['send (connection each)'] = timed(send_all)
+        single_connections = smtp.connections - connections - pooled_connections
+
+    print(f"{searches} saved searches, {len(changes)} listing changes ({users} users)")
+    print(f"  matches: {indexed}, alerts queued: {queued}, digests sent: {digests}")
+    for name, elapsed in results.items():
+        print(f"  {name:30s} {elapsed:8.3f}s")
+    print(f"  match speedup {results['match (every search)'] / results['match (index)']:.1f}x, "
+          f"SMTP connections pooled {pooled_connections} vs {single_connections}")
+    return results
+
+
+def fixture_pages(prefix):
+    """Read the recorded pages for one site"""
+    pages = []
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if re.fullmatch(rf'{prefix}_page\d+\.html', name):
+            with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+                pages.append(f.read())
+    return pages
+
+
+def bench_parse(repeat=20):
+    """Parse throughput over the recorded pages, per site and backend"""
+    configs = {
+        'bs4 html.parser, full page': dict(backend='bs4', features='html.parser', strain=False),
+        'bs4 lxml, cards only': dict(backend='bs4', features='lxml', strain=True),
+        'lxml xpath': dict(backend='lxml'),
+    }
+    results = {}
+    for site, adapter in SITE_ADAPTERS.items():
+        pages = fixture_pages(site.lower())
+        for name, options in configs.items():
+            engine = ExtractionEngine(adapter, **options)
+            start = time.perf_counter()
+            parsed = 0
+            for _ in range(repeat):
+                for html in pages:
+                    parsed += sum(1 for _ in engine.extract(html))
+            elapsed = time.perf_counter() - start
+            results[(site, name)] = parsed / elapsed
+            print(f"  {site:12s} {name:28s} {parsed / elapsed:10.0f} listings/sec  "
+                  f"{len(pages) * repeat / elapsed:8.1f} pages/sec")
+    return results
+
+
+def make_archive_days(days, pages, changed_fraction=0.5, seed=11):
+    """Yield (day, site, page, html) for `days` days of `pages` pages per site
+
+    Pages are the recorded ones with their listing URLs made unique per
+    page number. Each day, changed_fraction of the pages get new prices and
+    the rest are served exactly as the day before.
+    """
+    rng = random.Random(seed)
+    base = {}
+    for site in SITE_ADAPTERS:
+        recorded = fixture_pages(site.lower())
+        for page in range(1, pages + 1):
+            base[(site, page)] = recorded[(page - 1) % len(recorded)].replace('href="', f'href="/p{page}')
+    current = dict(base)
+    start = date.today() - timedelta(days=days)
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        for key, html in base.items():
+            if offset and rng.random() < changed_fraction:
+                cut = rng.randint(1, 9) * 100
+                current[key] = re.sub(r'\$ ([\d,]+)',
+                                      lambda m: f"$ {max(0, int(m.group(1).replace(',', '')) - cut):,}", html)
+            yield day, key[0], key[1], current[key]
+
+
+def bench_archive(days, pages, changed_fraction=0.5, workers=(0, 2)):
+    """Archive size and write time vs one file per page, and reparse throughput"""
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = PageArchive(os.path.join(tmp, 'archive'))
+        files_dir = os.path.join(tmp, 'files')
+        os.makedirs(files_dir)
+        raw = 0
+        archive_seconds = files_seconds = 0.0
+        count = 0
+        for day, site, page, html in make_archive_days(days, pages, changed_fraction):
+            body = html.encode('utf-8')
+            raw += len(body)
+            count += 1
+            url = f'https://{site.lower()}.example/results?page={page}'
+            _, elapsed = timed(archive.capture, site, page, url, body, day)
+            archive_seconds += elapsed
+            start = time.perf_counter()
+            with open(os.path.join(files_dir, f'{site}-{page}-{day}.html.gz'), 'wb') as f:
+                f.write(gzip.compress(body))
+            files_seconds += time.perf_counter() - start
+
+        def disk_usage(directory):
+            total = 0
+            for root, _, names in os.walk(directory):
+                total += sum(os.stat(os.path.join(root, name)).st_blocks * 512 for name in names)
+            return total
+
+        stats = archive.stats()
+        # Closing checkpoints the index's write-ahead log into the file
+        archive.close()
+        print(f"Archived {count} page fetches ({raw / 1024 / 1024:.1f} MB) over {days} days, "
+              f"{changed_fraction:.0%} of pages changing daily")
+        print(f"  one gzip file per fetch  {len(os.listdir(files_dir)):7d} files  "
+              f"{disk_usage(files_dir) / 1024 / 1024:8.2f} MB on disk  {files_seconds / count * 1000:6.2f}ms/page")
+        print(f"  packed, by content hash  {stats['blobs']:7d} blobs  "
+              f"{disk_usage(os.path.join(tmp, 'archive')) / 1024 / 1024:8.2f} MB on disk  "
+              f"{archive_seconds / count * 1000:6.2f}ms/page  ({archive.codec}, "
+              f"{stats['bytes'] / max(stats['stored_bytes'], 1):.1f}x compression)")
+
+        first = date.today() - timedelta(days=days)
+        last = date.today() - timedelta(days=1)
+        for count_workers in workers:
+            db_path = os.path.join(tmp, f'reparse-{count_workers}.db')
+            tracker = CarPriceTracker(db_path=db_path, cache_path=None, analytics_path=None, metrics_file=None,
+                                      run_log=None, archive_path=os.path.join(tmp, 'archive'))
+            totals, elapsed = timed(tracker.reparse, first, last, workers=count_workers)
+            tracker.archive.close()
+            conn = sqlite3.connect(db_path)
+            cars, prices = conn.execute('SELECT (SELECT COUNT(*) FROM cars), (SELECT COUNT(*) FROM price_history)').fetchone()
+            conn.close()
+            print(f"  reparse, {count_workers} workers  {elapsed:7.2f}s  {count / elapsed:8.1f} pages/sec  "
+                  f"{cars} cars, {prices} price intervals")
+
+
+# get_average_prices as it was before cars had dimension ids
+TEXT_AVERAGE_PRICES = f'''
+    SELECT c.make, c.model, c.year, AVG(p.price), MIN(p.price), MAX(p.price), COUNT(*)
+    FROM cars c
+    JOIN latest_prices p ON c.id = p.car_id
+    LEFT JOIN listing_entities le ON le.car_id = c.id
+    WHERE {LIVE_CARS}
+    GROUP BY c.make, c.model, c.year ORDER BY c.make, c.model, c.year
+'''
+
+
+def make_title_variants(count, seed=3):
+    """Listing titles written the ways sellers write them: case, dashes, accents, typos and trims"""
+    rng = random.Random(seed)
+    titles = []
+    for _ in range(count):
+        make = rng.choice(MAKES)
+        model = rng.choice(MODELS)
+        style = rng.randrange(5)
+        if style == 1:
+            make, model = make.upper(), model.lower()
+        elif style == 2:
+            model = model.replace('-', '')
+        elif style == 3 and len(make) > 4:
+            i = rng.randrange(1, len(make) - 1)
+            make = make[:i] + make[i + 1:]
+        elif style == 4:
+            model += rng.choice([' 1.6', ' Sport', ' 4x4', ' Full'])
+        titles.append(f"{make} {model}")
+    return titles
+
+
+def bench_dimensions(cars, prices_per_car, titles=200000, repeat=3):
+    """Aggregates grouped on make/model text vs dimension ids, and the title normalization memo"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'history.db')
+        build_history_db(db_path, cars, prices_per_car)
+        tracker, migration = timed(CarPriceTracker, db_path=db_path, cache_path=None, analytics_path=None,
+                                   metrics_file=None, run_log=None, archive_path=None)
+        conn = sqlite3.connect(db_path)
+        text = best_of(repeat, lambda: conn.execute(TEXT_AVERAGE_PRICES).fetchall())
+        conn.close()
+        ids = best_of(repeat, tracker.get_average_prices)
+        make_ids = best_of(repeat, tracker.get_average_prices, make='toyota')
+        print(f"{cars} cars, migrated to dimension ids in {migration:.2f}s")
+        print(f"  average prices, GROUP BY text  {text:8.3f}s")
+        print(f"  average prices, GROUP BY ids   {ids:8.3f}s")
+        print(f"  average prices, one make       {make_ids:8.3f}s")
+
+    variants = make_title_variants(titles)
+    normalizer = Normalizer()
+    _, uncached = timed(lambda: [normalizer._title(title) for title in variants])
+    _, cached = timed(lambda: [normalizer.title(title) for title in variants])
+    info = normalizer.title.cache_info()
+    canonical = {normalizer.title(title)[0] for title in variants}
+    print(f"{titles} titles, {len({title.split()[0] for title in variants})} spellings of "
+          f"{len(canonical)} makes after normalization")
+    print(f"  normalize, no memo   {titles / uncached:10.0f} titles/sec")
+    print(f"  normalize, LRU memo  {titles / cached:10.0f} titles/sec  "
+          f"({info.hits / (info.hits + info.misses):.1%} hits, {info.currsize} entries)")
+
+
+def api_requests(seed=11):
+    """Dashboard-like requests, as (api path, params, equivalent tracker call)"""
+    mix = [('/average-prices', {}, lambda tracker: tracker.get_average_prices()),
+           ('/days-on-market', {}, lambda tracker: tracker.get_days_on_market()),
+           ('/price-changes', {'days': 30}, lambda tracker: tracker.get_price_changes(30)[:100]),
+           ('/deals', {}, lambda tracker: tracker.get_deals(100))]
+    for make in MAKES:
+        mix.append(('/average-prices', {'make': make}, lambda tracker, make=make: tracker.get_average_prices(make)))
+    return random.Random(seed).sample(mix, len(mix))
+
+
+def run_clients(clients, seconds, request):
+    """Call request(client, i) from client threads for a while; returns latencies"""
+    latencies = [[] for _ in range(clients)]
+    deadline = time.perf_counter() + seconds
+
+    def client(number):
+        i = number
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            request(number, i)
+            latencies[number].append(time.perf_counter() - start)
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latency for client_latencies in latencies for latency in client_latencies)
+
+
+def bench_api(cars, prices_per_car=3, clients=8, seconds=10, pool_size=4, write_interval=0.5, batch=500):
+    """Requests/sec of the query API under concurrent clients, against calling the tracker directly
+
+    The last run keeps a writer storing batches of repriced listings, each
+    of which bumps the generation and so invalidates the cache.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'history.db')
+        build_history_db(db_path, cars, prices_per_car)
+        tracker = CarPriceTracker(db_path=db_path, cache_path=None, analytics_path=None, metrics_file=None,
+                                  run_log=None, archive_path=None)
+        tracker.score_deals()
+        mix = api_requests()
+        print(f"{cars} cars, {clients} clients, {seconds}s per run, {len(mix)} distinct requests")
+
+        def report(name, latencies, extra=''):
+            count = len(latencies)
+            print(f"  {name:28s} {count / seconds:8.1f} req/s  p50 {latencies[count // 2] * 1000:7.1f}ms  "
+                  f"p95 {latencies[int(count * 0.95)] * 1000:7.1f}ms{extra}")
+
+        report('direct tracker calls', run_clients(clients, seconds, lambda _, i: mix[i % len(mix)][2](tracker)))
+
+        for name, cache_entries, writer in (('api, no cache', 0, False), ('api, cached', 1024, False),
+                                            ('api, cached, while ingesting', 1024, True)):
+            server = QueryServer(db_path, port=0, pool_size=pool_size, cache_entries=cache_entries)
+            server.start()
+            sessions = [requests.Session() for _ in range(clients)]
+
+            def request(client, i):
+                path, params, _ = mix[i % len(mix)]
+                response = sessions[client].get(server.url + path, params=params)
+                response.raise_for_status()
+
+            stop = threading.Event()
+            writes = []
+
+            def ingest():
+                listings = make_listings(batch, seed=3)
+                while not stop.wait(write_interval):
+                    listings = reprice(listings, 0.5, seed=len(writes))
+                    writes.append(timed(tracker.store_listings, listings)[1])
+
+            ingester = threading.Thread(target=ingest)
+            if writer:
+                ingester.start()
+            latencies = run_clients(clients, seconds, request)
+            stop.set()
+            if writer:
+                ingester.join()
+            cache = server.api.cache.stats()
+            lookups = cache['hits'] + cache['misses']
+            extra = f"  cache hits {cache['hits'] / lookups:.0%}" if cache_entries and lookups else ''
+            if writes:
+                extra += f"  ({len(writes)} writes of {batch}, slowest {max(writes) * 1000:.0f}ms)"
+            report(name, latencies, extra)
+            for session in sessions:
+                session.close()
+            server.stop()
+
+
+# Metric names end in their unit, which also says which direction is better
+LOWER_IS_BETTER = ('_s', '_mb')
+HIGHER_IS_BETTER = ('_per_sec',)
+
+
+# Changes per hour on page 1 of each synthetic site, how many pages it has,
+# and how much slower each page is than the one before
+CRAWL_SITES = {'OLX': (6.0, 14, 0.6), 'PatioTuerca': (2.0, 8, 0.7), 'Carmudi': (0.5, 4, 0.8)}
+
+
+def poisson(rng, mean):
+    count, limit, product = 0, pow(2.718281828459045, -mean), rng.random()
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+def make_crawl_history(days, seed=13):
+    """Every page of CRAWL_SITES crawled hourly for days: the ground truth replays draw from
+
+    Changes are Poisson, three times as frequent by day as by night.
+    """
+    rng = random.Random(seed)
+    start = (int(time.time()) // 86400 - days) * 86400
+    crawls = []
+    for hour in range(days * 24):
+        now = start + hour * 3600
+        daytime = 1.5 if 8 <= time.localtime(now).tm_hour < 22 else 0.5
+        for site, (rate, pages, decay) in CRAWL_SITES.items():
+            for page in range(1, pages + 2):
+                if page > pages:
+                    crawls.append(Crawl(now, site, page, 0, 0))
+                else:
+                    crawls.append(Crawl(now, site, page, 20, poisson(rng, rate * decay ** (page - 1) * daytime)))
+    return crawls
+
+
+def bench_scheduler(days, budgets=(None,)):
+    """Fresh changes caught per request: the fixed daily crawl vs the adaptive planner, replayed"""
+    crawls, generate = timed(make_crawl_history, days)
+    print(f"{days} days of hourly crawls of {len(CRAWL_SITES)} sites: {len(crawls)} pages, "
+          f"{sum(crawl.changes for crawl in crawls)} changes (generated in {generate:.1f}s)")
+    for budget in budgets:
+        (budget, results), elapsed = timed(compare_policies, crawls, budget)
+        print(f"Budget {budget} requests/day (replayed in {elapsed:.1f}s)")
+        for result in results:
+            print(f"  {result['policy']:>12}  {result['requests_per_day']:6.0f} req/day  "
+                  f"{result['changes']:7.0f} changes  {result['fresh_changes']:7.0f} fresh  "
+                  f"{result['fresh_per_request']:6.2f} fresh/req  {result['avg_delay_hours']:5.1f}h delay")
+
+
+def best_of(repeat, func, *args, **kwargs):
+    """Fastest of `repeat` timed calls"""
+    return min(timed(func, *args, **kwargs)[1] for _ in range(repeat))
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_suite_size(size, prices_per_car=3, pages=6, latency=0.05, repeat=3, write_listings=5000):
+    """All suite metrics for one database size; run in its own process so peak memory is per size"""
+    metrics = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'history.db')
+        _, metrics['build_db_s'] = timed(build_history_db, db_path, size, prices_per_car)
+
+        with FixtureServer('patiotuerca', latency) as pt, FixtureServer('olx', latency) as olx:
+            servers = {'PatioTuerca': pt, 'OLX': olx}
+            tracker, metrics['migrate_s'] = timed(
+                fixture_tracker, db_path, servers, cache_path=os.path.join(tmp, 'http_cache.db'),
+                analytics_path=os.path.join(tmp, 'analytics'))
+
+            report_file = os.path.join(tmp, 'daily', 'report.html')
+            (new, updated), metrics['run_daily_job_s'] = timed(
+                tracker.run_daily_job, max_pages=pages, stop_fraction=None, report_file=report_file, sweep=False)
+
+        fetch = tracker.pipeline_stats['fetch']
+        store = tracker.pipeline_stats['store']
+        scrape_wall = fetch['processed'] / fetch['per_sec'] if fetch['per_sec'] else 0.0
+        metrics['pages_per_sec'] = fetch['per_sec']
+        metrics['listings_per_sec'] = (new + updated) / scrape_wall if scrape_wall else 0.0
+        store_busy = store['avg_latency'] * store['processed']
+        metrics['pipeline_store_listings_per_sec'] = (new + updated) / store_busy if store_busy else 0.0
+
+        # Batched writes of fresh listings into the full-size database
+        listings = [listing._replace(url=listing.url + '?bench') for listing in make_listings(write_listings, seed=7)]
+        _, elapsed = timed(tracker.store_listings, listings)
+        metrics['db_write_listings_per_sec'] = write_listings / elapsed
+
+        metrics['get_price_changes_s'] = best_of(repeat, tracker.get_price_changes, days=1)
+        metrics['get_price_changes_all_s'] = best_of(repeat, tracker.get_price_changes, days=3650)
+        metrics['get_average_prices_s'] = best_of(repeat, tracker.get_average_prices)
+        metrics['get_average_prices_make_s'] = best_of(repeat, tracker.get_average_prices, make='Toyota')
+
+        report_file = os.path.join(tmp, 'report', 'report.html')
+        _, metrics['generate_report_full_s'] = timed(tracker.generate_report, report_file)
+        metrics['generate_report_unchanged_s'] = best_of(repeat, tracker.generate_report, report_file)
+        tracker.fetcher.close()
+
+    metrics['peak_memory_mb'] = peak_memory_mb()
+    return metrics
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(sizes, output, pages=6, latency=0.05, prices_per_car=3):
+    """Run the regression suite at each size and save the results as JSON"""
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pages': pages,
+            'latency': latency,
+            'prices_per_car': prices_per_car,
+        },
+        'sizes': {},
+    }
+    for size in sizes:
+        print(f"Running suite with {size} listings...", flush=True)
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'suite-size', '--size', str(size), '--pages', str(pages),
+             '--latency', str(latency), '--prices-per-car', str(prices_per_car)],
+            capture_output=True, text=True, check=True)
+        metrics = json.loads(child.stdout.strip().splitlines()[-1])
+        results['sizes'][str(size)] = metrics
+        for name, value in metrics.items():
+            print(f"  {name:35s} {value:12.3f}")
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    return results
+
+
+def compare_results(baseline_path, current_path, threshold=0.1):
+    """Print metric changes between two suite runs; returns the regressions"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    regressions = []
+    print(f"{baseline['meta'].get('revision')} -> {current['meta'].get('revision')}")
+    for size, metrics in current['sizes'].items():
+        old_metrics = baseline['sizes'].get(size)
+        if not old_metrics:
+            continue
+        print(f"{size} listings")
+        for name, value in metrics.items():
+            old = old_metrics.get(name)
+            if not old:
+                continue
+            change = (value - old) / old
+            worse = change > threshold if name.endswith(LOWER_IS_BETTER) else (
+                -change > threshold if name.endswith(HIGHER_IS_BETTER) else False)
+            flag = '  REGRESSION' if worse else ''
+            print(f"  {name:35s} {old:12.3f} {value:12.3f} {change:+8.1%}{flag}")
+            if worse:
+                regressions.append((size, name, old, value))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help='per-row vs batched ingestion')
+    ingest.add_argument('--listings', type=int, default=5000)
+    ingest.add_argument('--changed', type=float, default=0.2)
+
+    fetch = subparsers.add_parser('fetch', help='sequential vs concurrent fetching from fixture servers')
+    fetch.add_argument('--pages', type=int, default=6)
+    fetch.add_argument('--latency', type=float, default=0.2)
+    fetch.add_argument('--min-interval', type=float, default=0.0)
+    fetch.add_argument('--concurrency', type=int, default=2)
+
+    queries = subparsers.add_parser('queries', help='change queries on a synthetic price history')
+    queries.add_argument('--cars', type=int, default=200000)
+    queries.add_argument('--prices-per-car', type=int, default=10)
+    queries.add_argument('--legacy', action='store_true',
+                         help='also time the pre-migration queries (quadratic, keep the DB small)')
+
+    parse = subparsers.add_parser('parse', help='listing extraction throughput over recorded pages')
+    parse.add_argument('--repeat', type=int, default=20)
+
+    cache = subparsers.add_parser('cache', help='repeat scrapes through the response cache')
+    cache.add_argument('--pages', type=int, default=6)
+    cache.add_argument('--latency', type=float, default=0.05)
+
+    analytics = subparsers.add_parser('analytics', help='columnar export and market statistics')
+    analytics.add_argument('--cars', type=int, default=200000)
+    analytics.add_argument('--prices-per-car', type=int, default=10)
+
+    dedupe = subparsers.add_parser('dedupe', help='cross-site duplicate detection')
+    dedupe.add_argument('--listings', type=int, default=30000)
+
+    history = subparsers.add_parser('history', help='price history size and queries, old vs interval format')
+    history.add_argument('--cars', type=int, default=200000)
+    history.add_argument('--prices-per-car', type=int, default=10)
+
+    workers = subparsers.add_parser('workers', help='job queue throughput by number of worker processes')
+    workers.add_argument('--pages', type=int, default=40)
+    workers.add_argument('--latency', type=float, default=0.2)
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    workers.add_argument('--min-interval', type=float, default=0.0)
+    workers.add_argument('--concurrency', type=int, default=4)
+
+    alerts = subparsers.add_parser('alerts', help='saved-search matching and alert digests via a local SMTP server')
+    alerts.add_argument('--searches', type=int, default=20000)
+    alerts.add_argument('--listings', type=int, default=20000)
+    alerts.add_argument('--users', type=int, default=500)
+
+    archive = subparsers.add_parser('archive', help='page archive size vs one file per page, and reparse speed')
+    archive.add_argument('--days', type=int, default=30)
+    archive.add_argument('--pages', type=int, default=20)
+    archive.add_argument('--changed', type=float, default=0.5)
+    archive.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+
+    dimensions = subparsers.add_parser('dimensions', help='aggregates on make/model text vs ids, and title normalization')
+    dimensions.add_argument('--cars', type=int, default=200000)
+    dimensions.add_argument('--prices-per-car', type=int, default=3)
+    dimensions.add_argument('--titles', type=int, default=200000)
+
+    api = subparsers.add_parser('api', help='query API load test: requests/sec under concurrent clients')
+    api.add_argument('--cars', type=int, default=100000)
+    api.add_argument('--prices-per-car', type=int, default=3)
+    api.add_argument('--clients', type=int, default=8)
+    api.add_argument('--seconds', type=float, default=10)
+    api.add_argument('--pool', type=int, default=4)
+
+    scheduler = subparsers.add_parser('scheduler', help='fixed daily vs adaptive crawling, replayed over a synthetic history')
+    scheduler.add_argument('--days', type=int, default=28)
+    scheduler.add_argument('--budgets', type=int, nargs='+', default=[None],
+                           help='requests per day (defaults to what the daily crawl spends)')
+
+    suite = subparsers.add_parser('suite', help='regression suite over synthetic databases, saved as JSON')
+    suite.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    suite.add_argument('--output', default='bench_results.json')
+    suite.add_argument('--pages', type=int, default=6)
+    suite.add_argument('--latency', type=float, default=0.05)
+    suite.add_argument('--prices-per-car', type=int, default=3)
+
+    suite_size = subparsers.add_parser('suite-size', help='one suite size, printed as JSON (used by suite)')
+    suite_size.add_argument('--size', type=int, required=True)
+    suite_size.add_argument('--pages', type=int, default=6)
+    suite_size.add_argument('--latency', type=float, default=0.05)
+    suite_size.add_argument('--prices-per-car', type=int, default=3)
+
+    compare = subparsers.add_parser('compare', help='compare two suite result files')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='relative change counted as a regression')
+
+    args = parser.parse_args()
+    if args.command == 'ingest':
+        bench_ingest(args.listings, args.changed)
+    elif args.command == 'fetch':
+        bench_fetch(args.pages, args.latency, args.min_interval, args.concurrency)
+    elif args.command == 'queries':
+        bench_queries(args.cars, args.prices_per_car, args.legacy)
+    elif args.command == 'parse':
+        bench_parse(args.repeat)
+    elif args.command == 'cache':
+        bench_cache(args.pages, args.latency)
+    elif args.command == 'analytics':
+        bench_analytics(args.cars, args.prices_per_car)
+    elif args.command == 'dedupe':
+        bench_dedupe(args.listings)
+    elif args.command == 'history':
+        bench_history(args.cars, args.prices_per_car)
+    elif args.command == 'workers':
+        bench_workers(args.pages, args.latency, args.workers, args.min_interval, args.concurrency)
+    elif args.command == 'alerts':
+        bench_alerts(args.searches, args.listings, args.users)
+    elif args.command == 'archive':
+        bench_archive(args.days, args.pages, args.changed, args.workers)
+    elif args.command == 'dimensions':
+        bench_dimensions(args.cars, args.prices_per_car, args.titles)
+    elif args.command == 'api':
+        bench_api(args.cars, args.prices_per_car, args.clients, args.seconds, args.pool)
+    elif args.command == 'scheduler':
+        bench_scheduler(args.days, args.budgets)
+    elif args.command == 'suite':
+        bench_suite(args.sizes, args.output, args.pages, args.latency, args.prices_per_car)
+    elif args.command == 'suite-size':
+        print(json.dumps(run_suite_size(args.size, args.prices_per_car, args.pages, args.latency)))
+    elif args.command == 'compare':
+        if compare_results(args.baseline, args.current, args.threshold):
+            sys.exit(1)
@@ -1,13 +1,32 @@
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
 import time
 import sqlite3
-from datetime import datetime
-import smtplib
-from email.mime.text import MIMEText
+import argparse
+from datetime import date, datetime
 import schedule
 import logging
+from contextlib import contextmanager, nullcontext
+from itertools import groupby
+from urllib.parse import urlsplit
+
+from alerts import AlertEngine, Mailer
+from archive import PageArchive, parse_captures
+from analytics import ColumnarStore, MarketStats
+from checkpoints import (ResumeState, finish_run, resume_run, run_totals, start_run, step_done,
+                         unfinished_run)
+from deals import DEAL_THRESHOLD, DealScorer
+from dedupe import DuplicateResolver, normalize as normalize_text
+from distributed import Coordinator
+from fetcher import DEFAULT_HEADERS, FetchEngine, ResponseCache
+from history import (COMPACT_EVERY_DAYS, RETENTION_TIERS, compact_history, day_date, day_number, merge_observation,
+                     to_cents)
+from metrics import MetricsRegistry, append_run_summary, profiled
+from normalize import Dimensions, Normalizer
+from pipeline import Pipeline
+from queries import average_prices, best_deals, bump_generation, days_on_market, price_changes
+from report import ReportBuilder
+from scheduler import (DAILY_BUDGET, HISTORY_DAYS, ChangeRates, CrawlPlanner, compare_policies, load_crawls,
+                       prune_crawls)
+from sites import SITE_ADAPTERS, ExtractionEngine, Listing
 
 # Setup logging
 logging.basicConfig(level=logging.INFO,
@@ -15,18 +34,124 @@ logging.basicConfig(level=logging.INFO,
                     filename='car_tracker.log')
 logger = logging.getLogger('CarTracker')
 
+# Keep IN (...) lookups under SQLite's bound-parameter limit
+SQLITE_MAX_VARIABLES = 900
+
+# Daily runs page through each site until most of a page is already known
+DAILY_MAX_PAGES = 20
+DAILY_STOP_FRACTION = 0.8
+
+# Port of the /metrics endpoint in daemon mode
+METRICS_PORT = 9108
+
+# A listing missing from this many complete passes over its site is delisted
+DELIST_AFTER_RUNS = 2
+# Every few days the daily run walks each site to the end, so every live
+# listing is seen and missing ones can be counted
+SWEEP_EVERY_DAYS = 7
+SWEEP_MAX_PAGES = 200
+
+# With a crawl budget, pages are fetched as often as they change instead
+# (see scheduler.py), replanned this often
+CRAWL_TICK_MINUTES = 60
+
+class KnownListings:
+    """In-memory index of known listing URLs and their latest price
+    
+    Loaded once per run, so checking whether a listing is new costs a dict
+    lookup rather than a query. URLs are keyed by their hash to keep the
+    index small with millions of listings.
+    """
+    
+    def __init__(self, rows=()):
+        self.prices = {hash(url): price for url, price in rows}
+    
+    def __len__(self):
+        return len(self.prices)
+    
+    def unchanged_fraction(self, listings):
+        """Fraction of listings already known at the same price"""
+        if not listings:
+            return 0.0
+        unchanged = sum(1 for listing in listings if self.prices.get(hash(listing.url)) == listing.price)
+        return unchanged / len(listings)
+    
+    def update(self, listings):
+        for listing in listings:
+            self.prices[hash(listing.url)] = listing.price
+
 class CarPriceTracker:
-    def __init__(self, db_path='car_prices.db'):
+    def __init__(self, db_path='car_prices.db', site_urls=None, host_policies=None,
+                 cache_path='http_cache.db', cache_max_bytes=100 * 1024 * 1024, parse_workers=None,
+                 analytics_path='analytics', metrics_file='car_tracker.prom', run_log='car_tracker_runs.jsonl',
+                 job_queue=None, queue_workers=4, retention_tiers=RETENTION_TIERS,
+                 delist_after_runs=DELIST_AFTER_RUNS, smtp_host='smtp.gmail.com', smtp_port=465,
+                 smtp_user='your_email@gmail.com', smtp_password='your_app_password', smtp_ssl=True,
+                 archive_path='page_archive', crawl_budget=None):
         self.db_path = db_path
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept-Language': 'es-ES,es;q=0.9,en;q=0.8'
-        }
+        self.headers = dict(DEFAULT_HEADERS)
+        self.sites = dict(SITE_ADAPTERS)
+        self.site_urls = {name: adapter.page_url for name, adapter in self.sites.items()}
+        self.site_urls.update(site_urls or {})
+        self.extractors = {name: ExtractionEngine(adapter) for name, adapter in self.sites.items()}
+        
+        # Be respectful with the websites: requests per host are spaced out and capped
+        policies = {urlsplit(adapter.page_url).netloc: adapter.host_policy for adapter in self.sites.values()}
+        policies.update(host_policies or {})
+        
+        # Conditional requests let unchanged pages skip parsing and storage
+        self.cache = ResponseCache(cache_path, cache_max_bytes) if cache_path else None
+        # Every page fetched, kept so listings can be re-extracted (None to disable)
+        self.archive = PageArchive(archive_path) if archive_path else None
+        
+        # Counters and timings of every run; rewritten to metrics_file and
+        # summarized as a JSON line in run_log after each daily job
+        self.metrics = MetricsRegistry()
+        self.metrics_file = metrics_file
+        self.run_log = run_log
+        self.last_run = None
+        
+        self.fetcher = FetchEngine(headers=self.headers, policies=policies, cache=self.cache, metrics=self.metrics,
+                                   archive=self.archive)
+        
+        # Parse worker processes per run (0 parses in the main process, as
+        # do runs of only a few pages)
+        self.parse_workers = parse_workers
+        
+        # With a job queue path, runs are scraped by worker processes sharing
+        # that queue (queue_workers started locally, plus any on other hosts)
+        self.job_queue = job_queue
+        self.queue_workers = queue_workers
+        self.pipeline_stats = {}
+        
+        # Columnar copy of the history for market statistics (None to disable)
+        self.analytics = ColumnarStore(analytics_path) if analytics_path else None
+        self.deal_scorer = DealScorer()
+        self.duplicate_resolver = DuplicateResolver()
+        # Downsampling of old price history (None keeps every price)
+        self.retention_tiers = retention_tiers
+        # Complete runs a listing can be missing from before it counts as delisted
+        self.delist_after_runs = delist_after_runs
+        
+        # Configure with your email settings (for Gmail, use an app password)
+        self.mailer = Mailer(smtp_host, smtp_port, smtp_user, smtp_password, use_ssl=smtp_ssl)
+        # Saved searches matched against every stored change
+        self.alerts = AlertEngine(self.metrics)
+        # Canonical make, model and location names, and their integer ids
+        self.normalizer = Normalizer()
+        self.dimensions = Dimensions()
+        # Requests per day across sites when crawling adaptively (None keeps
+        # the fixed daily crawl)
+        self.crawl_budget = crawl_budget
         self.initialize_db()
+        self.load_saved_searches()
         
     def initialize_db(self):
         """Create the database and tables if they don't exist"""
         conn = sqlite3.connect(self.db_path)
+        # Readers (reports, the query API) work from a snapshot and never
+        # block the writer, nor wait for it
+        conn.execute('PRAGMA journal_mode = WAL')
         cursor = conn.cursor()
         
         # Create cars table
@@ -60,217 +185,534 @@ class CarPriceTracker:
         ''')
         
         conn.commit()
+        self.migrate_db(conn)
+        self.dimensions.load(conn)
         conn.close()
         logger.info("Database initialized")
     
-    def scrape_patiotuerca(self, max_pages=3):
-        """Scrape data from PatioTuerca"""
-        new_listings = 0
-        updated_prices = 0
+    def migrate_db(self, conn):
+        """Bring the database schema up to date, one version at a time"""
+        migrations = [
+            self._migrate_latest_prices,
+            self._migrate_deal_scores,
+            self._migrate_listing_entities,
+            self._migrate_cars_make_index,
+            self._migrate_price_history,
+            self._migrate_listing_lifecycle,
+            self._migrate_saved_searches,
+            self._migrate_run_checkpoints,
+            self._migrate_dimensions,
+            self._migrate_generation,
+            self._migrate_page_crawls,
+        ]
+        cursor = conn.cursor()
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
         
-        try:
-            for page in range(1, max_pages + 1):
-                url = f"https://ecuador.patiotuerca.com/usados?page={page}"
-                response = requests.get(url, headers=self.headers)
-                
-                if response.status_code != 200:
-                    logger.error(f"Failed to get page {page} from PatioTuerca. Status code: {response.status_code}")
-                    continue
-                
-                soup = BeautifulSoup(response.text, 'html.parser')
-                car_listings = soup.select('div.listing-card')
-                
-                for listing in car_listings:
-                    try:
-                        # Extract listing details
-                        listing_id = listing.get('id', '')
-                        title_elem = listing.select_one('h2.listing-card__title')
-                        title = title_elem.text.strip() if title_elem else ""
-                        
-                        # Extract URL
-                        url_elem = listing.select_one('a.listing-card__link')
-                        url = "https://ecuador.patiotuerca.com" + url_elem['href'] if url_elem else ""
-                        
-                        # Extract price
-                        price_elem = listing.select_one('span.listing-card__price')
-                        price_text = price_elem.text.strip() if price_elem else "0"
-                        # Remove currency symbol and commas
-                        price = float(''.join(filter(lambda x: x.isdigit() or x == '.', price_text)) or 0)
-                        
-                        # Extract details
-                        details = listing.select('span.listing-card__characteristics')
-                        year = 0
-                        mileage = 0
-                        location = ""
-                        
-                        if len(details) >= 1:
-                            year_text = details[0].text.strip()
-                            year = int(year_text) if year_text.isdigit() else 0
-                        
-                        if len(details) >= 2:
-                            mileage_text = ''.join(filter(lambda x: x.isdigit(), details[1].text.strip()))
-                            mileage = int(mileage_text) if mileage_text.isdigit() else 0
-                        
-                        if len(details) >= 3:
-                            location = details[2].text.strip()
-                        
-                        # Parse make and model from title
-                        make = ""
-                        model = ""
-                        if title:
-                            parts = title.split(' ', 1)
-                            make = parts[0]
-                            model = parts[1] if len(parts) > 1 else ""
-                        
-                        # Store data in database
-                        result = self.store_data('PatioTuerca', listing_id, title, make, model, year, mileage, location, url, 'Unknown', "", price)
-                        if result == 'new':
-                            new_listings += 1
-                        elif result == 'updated':
-                            updated_prices += 1
-                    
-                    except Exception as e:
-                        logger.error(f"Error processing listing: {e}")
-                
-                # Be respectful with the website
-                time.sleep(2)
+        for target in range(version + 1, len(migrations) + 1):
+            logger.info(f"Migrating database to schema version {target}")
+            # Analytics tables a migration invalidates, dropped only once it commits
+            self.stale_exports = []
+            try:
+                cursor.execute('BEGIN')
+                migrations[target - 1](cursor)
+                cursor.execute(f'PRAGMA user_version = {target}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            for table in self.stale_exports:
+                if self.analytics:
+                    self.analytics.reset(table)
         
-        except Exception as e:
-            logger.error(f"Error scraping PatioTuerca: {e}")
+        if version < 5 <= len(migrations):
+            # Return the space of the dropped prices table to the filesystem
+            logger.info("Compacting database file after the price history migration")
+            conn.execute('VACUUM')
+    
+    def _migrate_latest_prices(self, cursor):
+        """Schema version 1: indexes and the latest_prices table"""
+        # Price history is always read per car in date order
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_prices_car_date ON prices (car_id, date)')
+        
+        # Current and previous price of every car, kept up to date by
+        # store_listings so the change queries never scan the history
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS latest_prices (
+            car_id INTEGER PRIMARY KEY,
+            price REAL,
+            date DATE,
+            previous_price REAL,
+            previous_date DATE,
+            FOREIGN KEY (car_id) REFERENCES cars (id)
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_latest_prices_date ON latest_prices (date)')
+        
+        # Backfill from the existing history
+        cursor.execute('''
+        INSERT OR REPLACE INTO latest_prices (car_id, price, date, previous_price, previous_date)
+        SELECT car_id, price, date, previous_price, previous_date
+        FROM (
+            SELECT car_id, price, date,
+                   LAG(price) OVER history as previous_price,
+                   LAG(date) OVER history as previous_date,
+                   ROW_NUMBER() OVER (PARTITION BY car_id ORDER BY date DESC, id DESC) as newest
+            FROM prices
+            WINDOW history AS (PARTITION BY car_id ORDER BY date, id)
+        )
+        WHERE newest = 1
+        ''')
+    
+    def _migrate_deal_scores(self, cursor):
+        """Add the deal scoring tables; they are filled by score_deals"""
+        # Fitted price model of each make/model segment
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deal_segments (
+            make TEXT,
+            model TEXT,
+            listings INTEGER,
+            intercept REAL,
+            age_coef REAL,
+            km_coef REAL,
+            resid_std REAL,
+            price_id INTEGER,
+            PRIMARY KEY (make, model)
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deal_scores (
+            car_id INTEGER PRIMARY KEY,
+            score REAL,
+            expected_price REAL,
+            FOREIGN KEY (car_id) REFERENCES cars (id)
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_deal_scores_score ON deal_scores (score)')
+    
+    def _migrate_listing_entities(self, cursor):
+        """Add the cross-site duplicate links; they are filled by resolve_duplicates"""
+        # entity_id is the id of the first listing of the same car, or the
+        # car's own id if it isn't listed anywhere else
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS listing_entities (
+            car_id INTEGER PRIMARY KEY,
+            entity_id INTEGER,
+            make_key TEXT,
+            year INTEGER,
+            mileage_band INTEGER,
+            similarity REAL,
+            FOREIGN KEY (car_id) REFERENCES cars (id)
+        )
+        ''')
+        # Blocking index for candidate lookups
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_listing_entities_block
+        ON listing_entities (make_key, year, mileage_band)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listing_entities_entity ON listing_entities (entity_id)')
+    
+    def _migrate_cars_make_index(self, cursor):
+        """Index cars by make, so each per-make report page reads only its own rows in order"""
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cars_make ON cars (make, model, year)')
+    
+    def _migrate_price_history(self, cursor):
+        """Schema version 5: price intervals in integer days and cents (see history.py)"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS price_history (
+            id INTEGER PRIMARY KEY,
+            car_id INTEGER NOT NULL,
+            start_day INTEGER NOT NULL,
+            end_day INTEGER,
+            price_cents INTEGER NOT NULL,
+            FOREIGN KEY (car_id) REFERENCES cars (id)
+        )
+        ''')
+        # Each price runs until the car's next one; 2440587.5 is the julian day of 1970-01-01
+        cursor.execute('''
+        INSERT INTO price_history (id, car_id, start_day, end_day, price_cents)
+        SELECT id, car_id, day, LEAD(day) OVER (PARTITION BY car_id ORDER BY day, id),
+               CAST(ROUND(price * 100) AS INTEGER)
+        FROM (SELECT id, car_id, price, CAST(julianday(date) - 2440587.5 AS INTEGER) as day FROM prices)
+        ORDER BY id
+        ''')
+        cursor.execute('DROP INDEX IF EXISTS idx_prices_car_date')
+        cursor.execute('DROP TABLE prices')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_price_history_car ON price_history (car_id, start_day)')
+        
+        # Readers of the old table keep working
+        cursor.execute('''
+        CREATE VIEW prices AS
+        SELECT id, car_id, price_cents / 100.0 as price, date(start_day * 86400, 'unixepoch') as date
+        FROM price_history
+        ''')
+        
+        # When periodic maintenance such as history compaction last ran
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance (
+            task TEXT PRIMARY KEY,
+            last_run DATE
+        )
+        ''')
+    
+    def _migrate_listing_lifecycle(self, cursor):
+        """Schema version 6: when listings were last seen, and whether they are still listed"""
+        cursor.execute('ALTER TABLE cars ADD COLUMN last_seen DATE')
+        # Complete runs in a row the listing was missing from
+        cursor.execute('ALTER TABLE cars ADD COLUMN missed_runs INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('ALTER TABLE cars ADD COLUMN active INTEGER NOT NULL DEFAULT 1')
+        # Day the listing was marked sold or delisted
+        cursor.execute('ALTER TABLE cars ADD COLUMN delisted DATE')
+        cursor.execute('''
+        UPDATE cars SET last_seen = COALESCE(
+            (SELECT lp.date FROM latest_prices lp WHERE lp.car_id = cars.id), first_seen)
+        ''')
+        
+        # Report and search queries only look at live inventory, so they get
+        # indexes over just that; deal fitting keeps using idx_cars_make
+        cursor.execute('CREATE INDEX idx_cars_active_make ON cars (make, model, year) WHERE active = 1')
+        cursor.execute('CREATE INDEX idx_cars_active_website ON cars (website) WHERE active = 1')
+        cursor.execute('CREATE INDEX idx_cars_delisted ON cars (make, model) WHERE active = 0')
+        
+        # URLs scraped during the current run
+        cursor.execute('CREATE TABLE IF NOT EXISTS seen_urls (url TEXT PRIMARY KEY) WITHOUT ROWID')
+    
+    def _migrate_saved_searches(self, cursor):
+        """Schema version 7: saved searches and the alerts queued for them (see alerts.py)"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS saved_searches (
+            id INTEGER PRIMARY KEY,
+            email TEXT NOT NULL,
+            name TEXT,
+            make TEXT,
+            model TEXT,
+            year_min INTEGER,
+            year_max INTEGER,
+            max_price REAL,
+            location TEXT,
+            min_drop_percent REAL,
+            created DATE,
+            -- Alerts up to this id have been emailed
+            notified_id INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_saved_searches_email ON saved_searches (email)')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY,
+            search_id INTEGER NOT NULL,
+            car_id INTEGER NOT NULL,
+            kind TEXT,
+            price REAL,
+            previous_price REAL,
+            created DATE,
+            UNIQUE (search_id, car_id, price),
+            FOREIGN KEY (search_id) REFERENCES saved_searches (id),
+            FOREIGN KEY (car_id) REFERENCES cars (id)
+        )
+        ''')
+        # Pending alerts of a search are those past its notified_id
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_alerts_search ON alerts (search_id)')
+    
+    def _migrate_run_checkpoints(self, cursor):
+        """Schema version 8: daily runs and the pages they finished (see checkpoints.py)"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            id INTEGER PRIMARY KEY,
+            started TIMESTAMP,
+            finished TIMESTAMP,
+            -- running, ok or abandoned
+            status TEXT,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            -- JSON of the options the run was started with
+            options TEXT,
+            -- JSON list of the steps done
+            steps TEXT NOT NULL DEFAULT '[]'
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS run_pages (
+            run_id INTEGER NOT NULL,
+            site TEXT NOT NULL,
+            page INTEGER NOT NULL,
+            status TEXT,
+            stop TEXT,
+            new_listings INTEGER NOT NULL DEFAULT 0,
+            updated_prices INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (run_id, site, page)
+        ) WITHOUT ROWID
+        ''')
+    
+    def _migrate_dimensions(self, cursor):
+        """Schema version 9: canonical makes, models and locations with integer ids (see normalize.py)"""
+        cursor.execute('CREATE TABLE IF NOT EXISTS makes (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS models (
+            id INTEGER PRIMARY KEY,
+            make_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            UNIQUE (make_id, name),
+            FOREIGN KEY (make_id) REFERENCES makes (id)
+        )
+        ''')
+        cursor.execute('CREATE TABLE IF NOT EXISTS locations (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        for column in ('make_id', 'model_id', 'location_id'):
+            cursor.execute(f'ALTER TABLE cars ADD COLUMN {column} INTEGER')
+        
+        # Existing cars get canonical make and model names as well as the
+        # ids; the location text is kept as the site wrote it
+        rows = cursor.execute('SELECT id, title, make, model, location FROM cars').fetchall()
+        names = [self.normalizer.title(title or f"{make or ''} {model or ''}") + (self.normalizer.location(location),)
+                 for _, title, make, model, location in rows]
+        ids = Dimensions().ids(cursor, names)
+        cursor.executemany('''
+        UPDATE cars SET make = ?, model = ?, make_id = ?, model_id = ?, location_id = ? WHERE id = ?
+        ''', [(make, model, *car_ids, row[0]) for row, (make, model, _), car_ids in zip(rows, names, ids)])
         
-        return new_listings, updated_prices
+        # Duplicate blocks and deal segments were keyed on the old names
+        cursor.execute('''
+        SELECT le.car_id, c.make FROM listing_entities le JOIN cars c ON c.id = le.car_id
+        ''')
+        cursor.executemany('UPDATE listing_entities SET make_key = ? WHERE car_id = ?',
+                           [(normalize_text(make), car_id) for car_id, make in cursor.fetchall()])
+        cursor.execute('DELETE FROM deal_scores')
+        cursor.execute('DELETE FROM deal_segments')
+        # Saved searches are matched against the canonical names from now on
+        searches = cursor.execute('SELECT id, make, model FROM saved_searches WHERE make IS NOT NULL').fetchall()
+        cursor.executemany('UPDATE saved_searches SET make = ?, model = ? WHERE id = ?',
+                           [(*self.normalizer.canonical(make, model), search_id) for search_id, make, model in searches])
+        cursor.execute('CREATE INDEX idx_cars_active_dims ON cars (make_id, model_id, year) WHERE active = 1')
+        cursor.execute('CREATE INDEX idx_cars_dims ON cars (make_id, model_id)')
+        # Cars already exported to the analytics store carry the old names
+        self.stale_exports.append('cars')
+    
+    def _migrate_generation(self, cursor):
+        """Schema version 10: a counter bumped whenever the data behind the queries changes (see queries.py)"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+        ''')
+        cursor.execute('INSERT OR IGNORE INTO generation (id, value) VALUES (1, 0)')
+    
+    def _migrate_page_crawls(self, cursor):
+        """Schema version 11: every page fetched and what it turned up, for crawl scheduling"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS page_crawls (
+            id INTEGER PRIMARY KEY,
+            crawled REAL NOT NULL,
+            site TEXT NOT NULL,
+            page INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            listings INTEGER,
+            new_listings INTEGER NOT NULL DEFAULT 0,
+            updated_prices INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_page_crawls_crawled ON page_crawls (crawled)')
+    
+    def scrape_patiotuerca(self, max_pages=3):
+        """Scrape data from PatioTuerca"""
+        return self.scrape_sites({'PatioTuerca': max_pages})['PatioTuerca']
     
     def scrape_olx(self, max_pages=3):
         """Scrape data from OLX Ecuador"""
-        new_listings = 0
-        updated_prices = 0
+        return self.scrape_sites({'OLX': max_pages})['OLX']
+    
+    def scrape_sites(self, max_pages, stop_fraction=None, sweep=False, run_id=None, lifecycle=True):
+        """Fetch pages from several sites in parallel and store their listings
         
-        try:
-            for page in range(1, max_pages + 1):
-                url = f"https://www.olx.com.ec/autos_c378?page={page}"
-                response = requests.get(url, headers=self.headers)
-                
-                if response.status_code != 200:
-                    logger.error(f"Failed to get page {page} from OLX. Status code: {response.status_code}")
-                    continue
-                
-                soup = BeautifulSoup(response.text, 'html.parser')
-                car_listings = soup.select('li.EIR5N')
-                
-                for listing in car_listings:
-                    try:
-                        # Extract listing details
-                        listing_id = listing.get('data-id', '')
-                        
-                        # Extract title
-                        title_elem = listing.select_one('h2.fTGKY')
-                        title = title_elem.text.strip() if title_elem else ""
-                        
-                        # Extract URL
-                        url_elem = listing.select_one('a.fhlkh')
-                        url = url_elem['href'] if url_elem else ""
-                        if url and not url.startswith('http'):
-                            url = "https://www.olx.com.ec" + url
-                        
-                        # Extract price
-                        price_elem = listing.select_one('span.PXdHY')
-                        price_text = price_elem.text.strip() if price_elem else "0"
-                        # Remove currency symbol and commas
-                        price = float(''.join(filter(lambda x: x.isdigit() or x == '.', price_text)) or 0)
-                        
-                        # Parse details
-                        details_elems = listing.select('span.zLvFQ')
-                        year = 0
-                        mileage = 0
-                        location = ""
-                        
-                        # Find the year
-                        for detail in details_elems:
-                            text = detail.text.strip()
-                            if text.isdigit() and 1950 <= int(text) <= datetime.now().year:
-                                year = int(text)
-                                break
-                        
-                        # Location is usually the last detail
-                        if details_elems:
-                            location = details_elems[-1].text.strip()
-                        
-                        # Parse make and model from title
-                        make = ""
-                        model = ""
-                        if title:
-                            parts = title.split(' ', 1)
-                            make = parts[0]
-                            model = parts[1] if len(parts) > 1 else ""
-                        
-                        # Store data
-                        result = self.store_data('OLX', listing_id, title, make, model, year, mileage, location, url, 'Unknown', "", price)
-                        if result == 'new':
-                            new_listings += 1
-                        elif result == 'updated':
-                            updated_prices += 1
-                    
-                    except Exception as e:
-                        logger.error(f"Error processing OLX listing: {e}")
-                
-                # Be respectful with rate limits
-                time.sleep(3)
+        max_pages maps site name to the number of pages to fetch, or to a
+        list of the pages to fetch (see crawl_plan). Pages go
+        through the fetch -> parse -> normalize -> store pipeline, so parsing
+        and storage run while other fetches are still in flight. Returns
+        {site: (new_listings, updated_prices)}.
         
-        except Exception as e:
-            logger.error(f"Error scraping OLX: {e}")
+        With stop_fraction set, each site is paged through until a page where
+        at least that fraction of listings is already known at the same
+        price; max_pages is then only a hard cap and may be None, not a list.
+        
+        With sweep set, each site is paged through to its last page (or
+        max_pages), parsing pages unchanged since the last run too, so every
+        live listing is seen.
+        
+        With a job_queue set, pages are fetched and parsed by worker
+        processes through the queue instead, and this process only writes.
         
-        return new_listings, updated_prices
+        With the run_id of a daily run, every page stored is checkpointed
+        under it, pages stored by an earlier attempt of the run are skipped,
+        and the totals cover every attempt.
+        
+        Every page fetched is logged in page_crawls with what it turned up.
+        Afterwards the listings seen are marked live, and listings missing
+        from sites that were paged through to the end count a missed run
+        (see update_lifecycle). Without lifecycle, as for the scheduled crawl
+        ticks that fetch only some pages, listings seen are just marked live;
+        missed runs and the seen listings of an interrupted daily run are
+        left to the daily run.
+        """
+        if self.job_queue:
+            runner = Coordinator(self, self.job_queue, workers=self.queue_workers)
+        else:
+            runner = Pipeline(self, parse_workers=self.parse_workers)
+        # A resumed run keeps what its earlier attempts saw
+        if run_id is None and lifecycle:
+            self.reset_seen()
+        self.load_saved_searches()
+        try:
+            totals = runner.run(max_pages, stop_fraction, sweep, run_id, lifecycle)
+        finally:
+            self.pipeline_stats = runner.summary()
+        if not lifecycle:
+            return totals
+        # A list of pages with gaps left listings unseen, wherever it ended
+        complete = {site for site in runner.complete_sites()
+                    if isinstance(max_pages[site], int) or max_pages[site] is None
+                    or sorted(max_pages[site]) == list(range(1, len(max_pages[site]) + 1))}
+        self.update_lifecycle(complete, run_id)
+        if run_id is not None:
+            totals = self.run_totals(run_id, max_pages)
+        return totals
     
-    def store_data(self, website, listing_id, title, make, model, year, mileage, location, url, seller_type, features, price):
-        """Store car data and price in the database"""
-        today = datetime.now().date()
+    def resume_state(self, run_id, sites):
+        """What earlier attempts of a daily run already scraped (see checkpoints.ResumeState)"""
+        if run_id is None:
+            return ResumeState(sites=sites)
         conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        result = None
+        try:
+            return ResumeState(conn, run_id, sites)
+        finally:
+            conn.close()
+    
+    def run_totals(self, run_id, sites):
+        """{site: (new_listings, updated_prices)} stored by a daily run so far"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            totals = run_totals(conn, run_id)
+        finally:
+            conn.close()
+        return {site: totals.get(site, (0, 0)) for site in sites}
+    
+    def unfinished_run(self):
+        """(run_id, options, steps done) of a daily run that didn't finish, or None"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return unfinished_run(conn)
+        finally:
+            conn.close()
+    
+    def reset_seen(self):
+        """Forget the listings seen by an earlier, possibly interrupted, run"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute('DELETE FROM seen_urls')
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def record_seen(self, conn, listings, lifecycle=True):
+        """Note the listings scraped this run, in the connection's current transaction
+        
+        Without lifecycle (see scrape_sites) they are marked live right away,
+        leaving seen_urls to the daily run.
+        """
+        if lifecycle:
+            conn.executemany('INSERT OR IGNORE INTO seen_urls (url) VALUES (?)',
+                             [(listing.url,) for listing in listings])
+            return
+        today = datetime.now().date()
+        cursor = conn.executemany('''
+        UPDATE cars SET last_seen = ?, missed_runs = 0, active = 1, delisted = NULL
+        WHERE url = ? AND NOT (last_seen IS ? AND missed_runs = 0 AND active = 1)
+        ''', [(today, listing.url, str(today)) for listing in listings])
+        if cursor.rowcount > 0:
+            bump_generation(cursor)
+    
+    def update_lifecycle(self, complete_sites=(), run_id=None):
+        """Apply the run's seen listings to last_seen, missed_runs and active
+        
+        Listings seen this run are marked live. On the complete_sites, which
+        the run paged through to the end, live listings that weren't seen
+        count a missed run, and after delist_after_runs in a row are marked
+        delisted. Each step is one statement against seen_urls rather than an
+        update per listing. Returns (seen, delisted).
         
+        With a run_id, the daily run's scrape step is checkpointed in the
+        same transaction, so a resumed run never counts a missed run twice.
+        """
+        conn = sqlite3.connect(self.db_path)
         try:
-            # Check if car exists
-            cursor.execute('SELECT id FROM cars WHERE url = ?', (url,))
-            car_result = cursor.fetchone()
-            
-            if car_result:
-                # Car exists, get its ID
-                car_id = car_result[0]
+            today = datetime.now().date()
+            cursor = conn.cursor()
+            delisted = 0
+            with self.metrics.timer('db_transaction_seconds', operation='lifecycle'):
+                seen = cursor.execute('''
+                UPDATE cars SET last_seen = ?, missed_runs = 0, active = 1, delisted = NULL
+                WHERE url IN (SELECT url FROM seen_urls)
+                ''', (today,)).rowcount
                 
-                # Check if price has changed
-                cursor.execute('''
-                SELECT price FROM prices 
-                WHERE car_id = ? 
-                ORDER BY date DESC LIMIT 1
-                ''', (car_id,))
-                
-                last_price_result = cursor.fetchone()
-                
-                if last_price_result and last_price_result[0] != price:
-                    # Price has changed, insert new price
+                for site in sorted(complete_sites):
                     cursor.execute('''
-                    INSERT INTO prices (car_id, price, date) 
-                    VALUES (?, ?, ?)
-                    ''', (car_id, price, today))
-                    result = 'updated'
-            else:
-                # New car, insert into cars table
-                cursor.execute('''
-                INSERT INTO cars (listing_id, website, title, make, model, year, mileage, location, url, seller_type, features, first_seen) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (listing_id, website, title, make, model, year, mileage, location, url, seller_type, features, today))
+                    UPDATE cars SET missed_runs = missed_runs + 1
+                    WHERE website = ? AND active = 1 AND url NOT IN (SELECT url FROM seen_urls)
+                    ''', (site,))
+                    count = cursor.execute('''
+                    UPDATE cars SET active = 0, delisted = ?
+                    WHERE website = ? AND active = 1 AND missed_runs >= ?
+                    ''', (today, site, self.delist_after_runs)).rowcount
+                    self.metrics.inc('listings_delisted_total', count, site=site)
+                    delisted += count
                 
-                car_id = cursor.lastrowid
-                
-                # Insert initial price
-                cursor.execute('''
-                INSERT INTO prices (car_id, price, date) 
-                VALUES (?, ?, ?)
-                ''', (car_id, price, today))
-                
-                result = 'new'
+                cursor.execute('DELETE FROM seen_urls')
+                bump_generation(cursor)
+                if run_id is not None:
+                    step_done(conn, run_id, 'scrape')
+                conn.commit()
             
-            conn.commit()
+            logger.info(f"Listing lifecycle: {seen} listings seen, {delisted} delisted "
+                        f"(complete sites: {', '.join(sorted(complete_sites)) or 'none'})")
+            return seen, delisted
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error updating listing lifecycle: {e}")
+            return 0, 0
+        finally:
+            conn.close()
+    
+    def load_known_listings(self):
+        """Load every known listing URL and its latest price in one query"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute('''
+            SELECT c.url, lp.price
+            FROM cars c
+            JOIN latest_prices lp ON lp.car_id = c.id
+            ''')
+            return KnownListings(rows)
+        finally:
+            conn.close()
+    
+    def store_data(self, website, listing_id, title, make, model, year, mileage, location, url, seller_type, features, price):
+        """Store car data and price in the database"""
+        listing = Listing(website, listing_id, title, make, model, year, mileage, location, url, seller_type, features, price)
+        return self.store_listings([listing], return_results=True)[0]
+    
+    def store_listings(self, listings, return_results=False):
+        """Store a batch of parsed listings in a single transaction
+        
+        Returns (new_listings, updated_prices), or the per-listing results
+        ('new', 'updated' or None) when return_results is set.
+        """
+        results = [None] * len(listings)
+        if not listings:
+            return results if return_results else (0, 0)
+        
+        conn = sqlite3.connect(self.db_path)
+        
+        try:
+            with self.metrics.timer('db_transaction_seconds', operation='store'):
+                results = self.write_listings(conn, listings)
+                conn.commit()
         
         except Exception as e:
             logger.error(f"Database error: {e}")
@@ -279,295 +721,801 @@ class CarPriceTracker:
         finally:
             conn.close()
         
-        return result
+        if return_results:
+            return results
+        return results.count('new'), results.count('updated')
     
-    def get_price_changes(self, days=1):
-        """Get cars with price changes in the last X days"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+    def normalize_listings(self, listings):
+        """Listings with canonical make and model, and the (make, model, location) names of each"""
+        normalized, names = [], []
+        for listing in listings:
+            make, model = self.normalizer.title(listing.title or f"{listing.make} {listing.model}")
+            normalized.append(listing._replace(make=make, model=model))
+            names.append((make, model, self.normalizer.location(listing.location)))
+        return normalized, names
+    
+    def write_listings(self, conn, listings):
+        """Write a batch of listings in the connection's current transaction
         
+        Returns the per-listing results ('new', 'updated' or None). Errors are
+        raised; committing or rolling back is up to the caller.
+        """
         today = datetime.now().date()
+        results = [None] * len(listings)
+        cursor = conn.cursor()
+        listings, names = self.normalize_listings(listings)
         
-        cursor.execute('''
-        SELECT c.id, c.title, c.make, c.model, c.year, c.url, 
-               p1.price as current_price, 
-               p2.price as previous_price,
-               ((p1.price - p2.price) / p2.price * 100) as price_change_percent
-        FROM cars c
-        JOIN prices p1 ON c.id = p1.car_id
-        JOIN (
-            SELECT car_id, MAX(date) as max_date
-            FROM prices
-            GROUP BY car_id
-        ) latest ON p1.car_id = latest.car_id AND p1.date = latest.max_date
-        JOIN (
-            SELECT p.car_id, p.price
-            FROM prices p
-            JOIN (
-                SELECT car_id, MAX(date) as max_date
-                FROM prices
-                WHERE date < (SELECT MAX(date) FROM prices GROUP BY car_id HAVING car_id = p.car_id)
-                GROUP BY car_id
-            ) previous ON p.car_id = previous.car_id AND p.date = previous.max_date
-        ) p2 ON c.id = p2.car_id
-        WHERE p1.price != p2.price
-        AND julianday(p1.date) - julianday(?) <= ?
-        ORDER BY price_change_percent
-        ''', (today, days))
-        
-        results = cursor.fetchall()
-        conn.close()
+        # Look up the cars we already know about and their last price
+        known = {}
+        urls = list({listing.url for listing in listings})
+        for i in range(0, len(urls), SQLITE_MAX_VARIABLES):
+            chunk = urls[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'''
+            SELECT c.url, c.id, lp.price
+            FROM cars c
+            LEFT JOIN latest_prices lp ON lp.car_id = c.id
+            WHERE c.url IN ({placeholders})
+            ''', chunk)
+            for url, car_id, last_price in cursor.fetchall():
+                known[url] = (car_id, last_price)
+        
+        # Work out what changed. A batch may repeat a url, so keep track
+        # of the last price we are about to write as we go.
+        new_cars = []
+        new_names = []
+        new_prices = {}
+        price_rows = []
+        # url -> (listing, car_id, price before this batch) for alert matching
+        changes = {}
+        new_listings = {}
+        for i, listing in enumerate(listings):
+            url = listing.url
+            price = listing.price
+            if url in known:
+                car_id, last_price = known[url]
+                if last_price is not None and last_price != price:
+                    price_rows.append((car_id, price))
+                    known[url] = (car_id, price)
+                    changes[url] = (listing, car_id, changes[url][2] if url in changes else last_price)
+                    results[i] = 'updated'
+            elif url in new_prices:
+                new_listings[url] = listing
+                if new_prices[url][-1] != price:
+                    new_prices[url].append(price)
+                    results[i] = 'updated'
+            else:
+                new_listings[url] = listing
+                new_cars.append((listing.listing_id, listing.website, listing.title,
+                                 listing.make, listing.model, listing.year,
+                                 listing.mileage, listing.location, url,
+                                 listing.seller_type, listing.features, today, today))
+                new_names.append(names[i])
+                new_prices[url] = [price]
+                results[i] = 'new'
+        
+        repriced = {car_id for car_id, _ in price_rows}
+        if new_cars:
+            cursor.executemany('''
+            INSERT INTO cars (listing_id, website, title, make, model, year, mileage, location, url, seller_type, features, first_seen, last_seen,
+                              make_id, model_id, location_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [car + ids for car, ids in zip(new_cars, self.dimensions.ids(cursor, new_names))])
+            
+            # Fetch the ids assigned to the new cars
+            new_urls = list(new_prices)
+            for i in range(0, len(new_urls), SQLITE_MAX_VARIABLES):
+                chunk = new_urls[i:i + SQLITE_MAX_VARIABLES]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT url, id FROM cars WHERE url IN ({placeholders})', chunk)
+                for url, car_id in cursor.fetchall():
+                    price_rows.extend((car_id, price) for price in new_prices[url])
+                    changes[url] = (new_listings[url], car_id, None)
+        
+        if price_rows:
+            day = day_number(today)
+            # Close the current interval of repriced cars. A car repriced
+            # twice in this batch gets its earlier price closed right away.
+            last_row = {car_id: i for i, (car_id, _) in enumerate(price_rows)}
+            cursor.executemany('''
+            UPDATE price_history SET end_day = ? WHERE car_id = ? AND end_day IS NULL
+            ''', [(day, car_id) for car_id in repriced])
+            cursor.executemany('''
+            INSERT INTO price_history (car_id, start_day, end_day, price_cents)
+            VALUES (?, ?, ?, ?)
+            ''', [(car_id, day, None if last_row[car_id] == i else day, to_cents(price))
+                  for i, (car_id, price) in enumerate(price_rows)])
+            
+            # Rows are applied in order, so a car repriced twice in one
+            # batch still ends up with the right previous price
+            cursor.executemany('''
+            INSERT INTO latest_prices (car_id, price, date)
+            VALUES (?, ?, ?)
+            ON CONFLICT (car_id) DO UPDATE SET
+                previous_price = latest_prices.price,
+                previous_date = latest_prices.date,
+                price = excluded.price,
+                date = excluded.date
+            ''', [(car_id, price, today) for car_id, price in price_rows])
+        
+        self.alerts.queue(cursor, changes.values(), today)
+        if changes:
+            bump_generation(cursor)
+        return results
+    
+    def backfill_listings(self, conn, listings, day):
+        """Merge listings seen on a past day into cars and the price history
         
-        return [dict(row) for row in results]
+        Runs in the connection's current transaction, like write_listings,
+        but dates everything to day and fits prices in between the ones
+        already recorded (see history.merge_observation). No alerts are
+        raised for the past. The analytics price partitions of the days
+        whose intervals changed are invalidated (see ColumnarStore.invalidate).
+        Returns the per-listing results ('new', 'updated' or None).
+        """
+        day_no = day_number(day)
+        day = day_date(day_no)
+        results = [None] * len(listings)
+        cursor = conn.cursor()
+        listings, names = self.normalize_listings(listings)
+        # The last listing of a url wins
+        last = {listing.url: i for i, listing in enumerate(listings) if listing.url}
+        
+        known = {}
+        intervals = {}
+        urls = list(last)
+        for i in range(0, len(urls), SQLITE_MAX_VARIABLES):
+            chunk = urls[i:i + SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            for url, car_id, last_seen in cursor.execute(f'''
+            SELECT url, id, last_seen FROM cars WHERE url IN ({placeholders})
+            ''', chunk).fetchall():
+                known[url] = (car_id, last_seen)
+                intervals[car_id] = []
+            car_ids = [known[url][0] for url in chunk if url in known]
+            placeholders = ','.join('?' * len(car_ids))
+            for car_id, *interval in cursor.execute(f'''
+            SELECT car_id, id, start_day, end_day, price_cents FROM price_history
+            WHERE car_id IN ({placeholders})
+            ORDER BY car_id, start_day, id
+            ''', car_ids):
+                intervals[car_id].append(tuple(interval))
+        
+        new_cars = [listings[i] for url, i in last.items() if url not in known]
+        new_ids = self.dimensions.ids(cursor, [names[i] for url, i in last.items() if url not in known])
+        cursor.executemany('''
+        INSERT INTO cars (listing_id, website, title, make, model, year, mileage, location, url, seller_type, features, first_seen, last_seen,
+                          make_id, model_id, location_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(listing.listing_id, listing.website, listing.title, listing.make, listing.model, listing.year,
+               listing.mileage, listing.location, listing.url, listing.seller_type, listing.features, day, day, *ids)
+              for listing, ids in zip(new_cars, new_ids)])
+        for i in range(0, len(new_cars), SQLITE_MAX_VARIABLES):
+            chunk = [listing.url for listing in new_cars[i:i + SQLITE_MAX_VARIABLES]]
+            placeholders = ','.join('?' * len(chunk))
+            for url, car_id in cursor.execute(f'SELECT url, id FROM cars WHERE url IN ({placeholders})', chunk):
+                known[url] = (car_id, None)
+                intervals[car_id] = []
+        new_urls = {listing.url for listing in new_cars}
+        
+        deleted, updated, inserted, current = [], [], [], []
+        # Start days of the intervals changed, deleted or added
+        touched = set()
+        for url, i in last.items():
+            car_id, last_seen = known[url]
+            old = intervals[car_id]
+            new = merge_observation(old, day_no, to_cents(listings[i].price),
+                                    latest=last_seen is None or str(day) >= last_seen)
+            if new == old:
+                continue
+            results[i] = 'new' if url in new_urls else 'updated'
+            before = {interval[0]: interval for interval in old}
+            kept = {interval[0] for interval in new}
+            deleted.extend((interval_id,) for interval_id in before if interval_id not in kept)
+            touched.update(before[interval_id][1] for interval_id in before if interval_id not in kept)
+            for interval_id, start, end, cents in new:
+                if interval_id is None:
+                    inserted.append((car_id, start, end, cents))
+                    touched.add(start)
+                elif before[interval_id] != (interval_id, start, end, cents):
+                    updated.append((start, end, cents, interval_id))
+                    touched.update((start, before[interval_id][1]))
+            if new[-1][2] is None and (not old or old[-1][3] != new[-1][3]):
+                current.append((car_id, new[-1][3] / 100, day_date(new[-1][1])))
+        
+        cursor.executemany('DELETE FROM price_history WHERE id = ?', deleted)
+        cursor.executemany('UPDATE price_history SET start_day = ?, end_day = ?, price_cents = ? WHERE id = ?',
+                           updated)
+        cursor.executemany('''
+        INSERT INTO price_history (car_id, start_day, end_day, price_cents) VALUES (?, ?, ?, ?)
+        ''', inserted)
+        cursor.executemany('''
+        INSERT INTO latest_prices (car_id, price, date)
+        VALUES (?, ?, ?)
+        ON CONFLICT (car_id) DO UPDATE SET
+            previous_price = latest_prices.price,
+            previous_date = latest_prices.date,
+            price = excluded.price,
+            date = excluded.date
+        ''', current)
+        # A listing seen after it was marked delisted was still up then
+        cursor.executemany('''
+        UPDATE cars SET
+            first_seen = MIN(first_seen, ?),
+            last_seen = MAX(COALESCE(last_seen, ?), ?),
+            active = CASE WHEN delisted <= ? THEN 1 ELSE active END,
+            missed_runs = CASE WHEN delisted <= ? THEN 0 ELSE missed_runs END,
+            delisted = CASE WHEN delisted <= ? THEN NULL ELSE delisted END
+        WHERE id = ?
+        ''', [(day, day, day, day, day, day, known[url][0]) for url in last])
+        if last:
+            bump_generation(cursor)
+        # Exported prices on those days are rebuilt on the next export. New
+        # intervals count too: ids freed by the deletes can be reused below
+        # the export watermark.
+        if self.analytics:
+            self.analytics.invalidate(day_date(day) for day in touched)
+        return results
+    
+    def reparse(self, start, end=None, sites=None, workers=None):
+        """Re-extract the archived pages fetched from start to end and backfill them
+        
+        start and end are dates (or 'YYYY-MM-DD'), inclusive. Pages are
+        parsed by worker processes straight from the archive, without
+        touching the network, and each day is merged into cars and prices in
+        one transaction, oldest first (see backfill_listings). Duplicates
+        and deals pick the changes up on the next daily job, and so does the
+        analytics export, which rebuilds the partitions of the days whose
+        prices were backfilled.
+        Returns {site: (new_listings, updated_prices)}.
+        """
+        sites = list(sites or self.sites)
+        totals = {site: (0, 0) for site in sites}
+        if not self.archive:
+            logger.error("Reparse needs the page archive, which is disabled")
+            return totals
+        captures = self.archive.captures(start, end, sites)
+        logger.info(f"Reparsing {len(captures)} archived pages from {start} to {end or start}")
+        
+        conn = sqlite3.connect(self.db_path)
+        try:
+            parsed = parse_captures(self.archive, captures, self.sites,
+                                    self.parse_workers if workers is None else workers)
+            for day, pages in groupby(parsed, key=lambda item: item[0][0]):
+                listings = [listing for _, page_listings in pages for listing in page_listings if listing.url]
+                with self.metrics.timer('db_transaction_seconds', operation='backfill'):
+                    results = self.backfill_listings(conn, listings, day_date(day))
+                    conn.commit()
+                for listing, result in zip(listings, results):
+                    new_listings, updated_prices = totals[listing.website]
+                    totals[listing.website] = (new_listings + (result == 'new'),
+                                               updated_prices + (result == 'updated'))
+                logger.info(f"Reparsed {day_date(day)}: {len(listings)} listings, "
+                            f"{results.count('new')} new, {results.count('updated')} with prices backfilled")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error reparsing archived pages: {e}")
+        finally:
+            conn.close()
+        return totals
+    
+    def get_price_changes(self, days=1):
+        """Get cars with price changes in the last X days"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return price_changes(conn, days)
+        finally:
+            conn.close()
     
     def get_average_prices(self, make=None, model=None):
-        """Get average prices by make and model"""
+        """Get average prices by make and model
+        
+        Only live listings are included. A car listed on several sites is
+        counted once, at the price of its first live listing. make and model
+        can be spelled any way (see normalize.py).
+        """
         conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        try:
+            return average_prices(conn, *self.canonical(make, model))
+        finally:
+            conn.close()
+    
+    def get_days_on_market(self, make=None, model=None):
+        """Days on market by make and model
         
-        query = '''
-        SELECT c.make, c.model, c.year, 
-               AVG(p.price) as avg_price, 
-               MIN(p.price) as min_price, 
-               MAX(p.price) as max_price,
-               COUNT(*) as count
-        FROM cars c
-        JOIN (
-            SELECT car_id, MAX(date) as max_date
-            FROM prices
-            GROUP BY car_id
-        ) latest ON c.id = latest.car_id
-        JOIN prices p ON latest.car_id = p.car_id AND latest.max_date = p.date
-        '''
-        
-        params = []
-        if make:
-            query += ' WHERE c.make = ?'
-            params.append(make)
-            if model:
-                query += ' AND c.model = ?'
-                params.append(model)
-        
-        query += ' GROUP BY c.make, c.model, c.year ORDER BY c.make, c.model, c.year'
-        
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        conn.close()
+        For delisted listings this is first seen to delisted; listings still
+        live are reported separately with how long they've been listed so far.
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return days_on_market(conn, *self.canonical(make, model))
+        finally:
+            conn.close()
+    
+    def canonical(self, make, model=None):
+        """Canonical (make, model) of a make and model as a user typed them; None stays None"""
+        if not make:
+            return make, model
+        return self.normalizer.canonical(make, model)
+    
+    def export_analytics(self):
+        """Append new cars and prices to the columnar analytics store"""
+        if not self.analytics:
+            return 0, 0
+        try:
+            return self.analytics.export(self.db_path)
+        except Exception as e:
+            logger.error(f"Error exporting analytics: {e}")
+            return 0, 0
+    
+    def market_stats(self, start=None, end=None):
+        """Market statistics over the exported history between start and end"""
+        return MarketStats(self.analytics, start, end)
+    
+    def resolve_duplicates(self):
+        """Link listings added since the last run to the same car on other sites"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            resolved, linked = self.duplicate_resolver.resolve(conn)
+            if linked:
+                # Live listing counts skip the linked copies from now on
+                bump_generation(conn)
+                conn.commit()
+            return resolved, linked
+        except Exception as e:
+            logger.error(f"Error detecting duplicate listings: {e}")
+            return 0, 0
+        finally:
+            conn.close()
+    
+    def score_deals(self, force=False):
+        """Refit the deal model for segments with new prices; returns segments refit"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            refit = self.deal_scorer.update(conn, force=force)
+            if refit:
+                bump_generation(conn)
+                conn.commit()
+            return refit
+        except Exception as e:
+            logger.error(f"Error scoring deals: {e}")
+            return 0
+        finally:
+            conn.close()
+    
+    def maintenance_due(self, task, every_days):
+        """Whether a periodic task last ran every_days or more ago (or never)"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            row = conn.execute('SELECT last_run FROM maintenance WHERE task = ?', (task,)).fetchone()
+        finally:
+            conn.close()
+        return not row or (datetime.now().date() - date.fromisoformat(row[0])).days >= every_days
+    
+    def _maintenance_done(self, conn, task):
+        conn.execute('INSERT OR REPLACE INTO maintenance (task, last_run) VALUES (?, ?)',
+                     (task, datetime.now().date()))
+    
+    def compact_history(self, force=False):
+        """Downsample the price history of delisted listings
+        
+        Runs at most every COMPACT_EVERY_DAYS days unless forced, and not at
+        all without retention tiers. The analytics price partitions of the
+        days touched are invalidated. Returns the number of rows removed.
+        """
+        if not self.retention_tiers:
+            return 0
+        if not force and not self.maintenance_due('compact_history', COMPACT_EVERY_DAYS):
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        try:
+            touched = set()
+            removed = compact_history(conn, datetime.now().date(), self.retention_tiers, touched)
+            self._maintenance_done(conn, 'compact_history')
+            # Exported prices dated on the touched days are rebuilt on the next export
+            if self.analytics:
+                self.analytics.invalidate(day_date(day) for day in touched)
+            if removed:
+                bump_generation(conn)
+            conn.commit()
+            return removed
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error compacting price history: {e}")
+            return 0
+        finally:
+            conn.close()
+    
+    def get_deals(self, limit=20, max_score=DEAL_THRESHOLD):
+        """Listings priced furthest below similar cars, best deals first"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return best_deals(conn, max_score, limit=limit)
+        finally:
+            conn.close()
+    
+    def load_saved_searches(self):
+        """Rebuild the saved search index, e.g. after searches were added elsewhere"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return self.alerts.load(conn)
+        finally:
+            conn.close()
+    
+    def add_saved_search(self, email, name=None, make=None, model=None, year_min=None, year_max=None,
+                         max_price=None, location=None, min_drop_percent=None):
+        """Save a search; matching new listings and price drops are emailed to email
         
-        return [dict(row) for row in results]
+        Unset criteria match anything. With min_drop_percent, price drops
+        smaller than that are not alerted. Returns the search id.
+        """
+        # Matched against the canonical names listings are stored under
+        make, model = self.canonical(make, model)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            search_id = conn.execute('''
+            INSERT INTO saved_searches (email, name, make, model, year_min, year_max, max_price, location,
+                                        min_drop_percent, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (email, name, make, model, year_min, year_max, max_price, location, min_drop_percent,
+                  datetime.now().date())).lastrowid
+            conn.commit()
+            self.alerts.load(conn)
+            return search_id
+        finally:
+            conn.close()
+    
+    def remove_saved_search(self, search_id):
+        """Delete a saved search and its alerts"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute('DELETE FROM alerts WHERE search_id = ?', (search_id,))
+            conn.execute('DELETE FROM saved_searches WHERE id = ?', (search_id,))
+            conn.commit()
+            self.alerts.load(conn)
+        finally:
+            conn.close()
+    
+    def send_alert_digests(self):
+        """Email each user their pending saved-search alerts; returns digests sent"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return self.alerts.send_digests(conn, self.mailer)
+        except Exception as e:
+            logger.error(f"Error sending alert digests: {e}")
+            return 0
+        finally:
+            conn.close()
     
     def send_email_notification(self, to_email, subject, message):
         """Send email notification"""
-        # Configure with your email settings
-        from_email = "your_email@gmail.com"
-        password = "your_app_password"  # Use app password for Gmail
-        
         try:
-            msg = MIMEText(message, 'html')
-            msg['Subject'] = subject
-            msg['From'] = from_email
-            msg['To'] = to_email
-            
-            server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-            server.login(from_email, password)
-            server.send_message(msg)
-            server.quit()
+            self.mailer.send(to_email, subject, message)
             logger.info(f"Email notification sent to {to_email}")
             return True
         except Exception as e:
             logger.error(f"Failed to send email: {e}")
             return False
     
-    def generate_report(self, output_file='car_prices_report.html'):
-        """Generate an HTML report of current data"""
+    def generate_report(self, output_file='car_prices_report.html', pages_dir=None, page_size=500):
+        """Generate the HTML report: an index page plus per-make inventory pages
+        
+        Sub-pages go to pages_dir (by default next to output_file). Make pages
+        whose data hasn't changed since the last report are not rewritten.
+        """
         conn = sqlite3.connect(self.db_path)
         conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Get statistics
-        cursor.execute("SELECT COUNT(*) as count FROM cars")
-        total_cars = cursor.fetchone()['count']
-        
-        cursor.execute("""
-        SELECT COUNT(*) as count FROM (
-            SELECT DISTINCT car_id FROM prices 
-            GROUP BY car_id 
-            HAVING COUNT(*) > 1
-        )
-        """)
-        cars_with_price_changes = cursor.fetchone()['count']
-        
-        # Get top makes
-        cursor.execute("""
-        SELECT make, COUNT(*) as count 
-        FROM cars 
-        GROUP BY make 
-        ORDER BY count DESC 
-        LIMIT 10
-        """)
-        top_makes = cursor.fetchall()
-        
-        # Get recent price drops
-        cursor.execute("""
-        SELECT c.make || ' ' || c.model || ' ' || c.year as car,
-               p_old.price as old_price,
-               p_new.price as new_price,
-               ((p_new.price - p_old.price) / p_old.price * 100) as change_percent,
-               c.url
-        FROM cars c
-        JOIN prices p_new ON c.id = p_new.car_id
-        JOIN (
-            SELECT car_id, MAX(date) as max_date
-            FROM prices
-            GROUP BY car_id
-        ) latest ON p_new.car_id = latest.car_id AND p_new.date = latest.max_date
-        JOIN (
-            SELECT p.car_id, p.price
-            FROM prices p
-            JOIN (
-                SELECT car_id, MAX(date) as max_date
-                FROM prices
-                WHERE date < (SELECT MAX(date) FROM prices GROUP BY car_id HAVING car_id = p.car_id)
-                GROUP BY car_id
-            ) previous ON p.car_id = previous.car_id AND p.date = previous.max_date
-        ) p_old ON c.id = p_old.car_id
-        WHERE p_new.price < p_old.price
-        ORDER BY change_percent
-        LIMIT 10
-        """)
-        recent_price_drops = cursor.fetchall()
+        try:
+            builder = ReportBuilder(conn, output_file, pages_dir=pages_dir, page_size=page_size)
+            builder.build()
+        finally:
+            conn.close()
         
-        conn.close()
+        logger.info(f"Report generated: {output_file}")
+        return output_file
+    
+    def crawl_plan(self, budget=None, now=None):
+        """{site: [pages]} to fetch now to keep up with each page's rate of change
         
-        # Generate HTML report
-        html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Used Car Price Report</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; margin: 20px; }}
-                h1, h2 {{ color: #333; }}
-                table {{ border-collapse: collapse; width: 100%; margin-bottom: 20px; }}
-                th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
-                th {{ background-color: #f2f2f2; }}
-                tr:nth-child(even) {{ background-color: #f9f9f9; }}
-                .summary {{ display: flex; gap: 20px; margin-bottom: 20px; }}
-                .summary-card {{ background-color: #f2f2f2; padding: 15px; border-radius: 5px; flex: 1; }}
-                .price-drop {{ color: green; }}
-            </style>
-        </head>
-        <body>
-            <h1>Used Car Price Report</h1>
-            <p>Generated on {datetime.now().strftime('%Y-%m-%d %H:%M')}</p>
-            
-            <div class="summary">
-                <div class="summary-card">
-                    <h3>Total Listings</h3>
-                    <p>{total_cars}</p>
-                </div>
-                <div class="summary-card">
-                    <h3>Cars with Price Changes</h3>
-                    <p>{cars_with_price_changes}</p>
-                </div>
-            </div>
-            
-            <h2>Top Car Makes</h2>
-            <table>
-                <tr>
-                    <th>Make</th>
-                    <th>Count</th>
-                </tr>
+        Rates come from the last HISTORY_DAYS of page_crawls (older crawls are
+        pruned); the requests made in the last 24 hours, failed ones included,
+        count against the daily budget (crawl_budget by default). See
+        scheduler.CrawlPlanner.
         """
+        now = time.time() if now is None else now
+        conn = sqlite3.connect(self.db_path)
+        try:
+            prune_crawls(conn, now - HISTORY_DAYS * 86400)
+            conn.commit()
+            crawls = load_crawls(conn, now - HISTORY_DAYS * 86400)
+        finally:
+            conn.close()
+        rates = ChangeRates().fit(crawls)
+        spent = sum(1 for crawl in crawls if crawl.crawled > now - 86400)
+        planner = CrawlPlanner(self.sites, budget or self.crawl_budget or DAILY_BUDGET, CRAWL_TICK_MINUTES / 60)
+        plan = planner.plan(rates, now, planner.allowance(spent))
+        logger.info(f"Crawl plan: {sum(len(pages) for pages in plan.values())} pages "
+                    f"({spent} requests in the last 24 hours)")
+        return plan
+    
+    def run_scheduled_crawl(self, budget=None):
+        """Fetch the pages due now (see crawl_plan) and send the alerts they raise
         
-        for make in top_makes:
-            html += f"""
-                <tr>
-                    <td>{make['make']}</td>
-                    <td>{make['count']}</td>
-                </tr>
-            """
+        Run every CRAWL_TICK_MINUTES in daemon mode with a crawl budget; the
+        daily job still sweeps, counts missed runs, resolves duplicates,
+        scores deals and reports.
+        Returns {site: (new_listings, updated_prices)}.
+        """
+        try:
+            plan = self.crawl_plan(budget)
+            if not plan:
+                return {}
+            totals = self.scrape_sites(plan, lifecycle=False)
+            with self.mailer:
+                self.send_alert_digests()
+        except Exception as e:
+            logger.error(f"Error in scheduled crawl: {e}")
+            return {}
+        logger.info(f"Scheduled crawl: {sum(new for new, _ in totals.values())} new listings, "
+                    f"{sum(updated for _, updated in totals.values())} price updates")
+        return totals
+    
+    def simulate_crawls(self, days=28, budget=None):
+        """Replay the last days of page_crawls against the crawl policies (see scheduler.compare_policies)
         
-        html += """
-            </table>
-            
-            <h2>Recent Price Drops</h2>
-            <table>
-                <tr>
-                    <th>Car</th>
-                    <th>Old Price ($)</th>
-                    <th>New Price ($)</th>
-                    <th>Change (%)</th>
-                </tr>
+        Returns (budget, results), the budget defaulting to what the fixed
+        daily crawl spends.
         """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            crawls = load_crawls(conn, time.time() - days * 86400)
+        finally:
+            conn.close()
+        return compare_policies(crawls, budget, CRAWL_TICK_MINUTES / 60)
+    
+    @contextmanager
+    def _step(self, steps, name, run_id=None):
+        """Time one step of the daily job into steps and the job_step_seconds gauge
         
-        for drop in recent_price_drops:
-            html += f"""
-                <tr>
-                    <td><a href="{drop['url']}" target="_blank">{drop['car']}</a></td>
-                    <td>{drop['old_price']:.2f}</td>
-                    <td>{drop['new_price']:.2f}</td>
-                    <td class="price-drop">{drop['change_percent']:.2f}%</td>
-                </tr>
-            """
-        
-        html += """
-            </table>
-        </body>
-        </html>
+        With a run_id, the step is checkpointed as done once it succeeds.
         """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            steps[name] = time.perf_counter() - start
+            self.metrics.set('job_step_seconds', steps[name], step=name)
+        if run_id is not None:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                step_done(conn, run_id, name)
+                conn.commit()
+            finally:
+                conn.close()
+    
+    def _record_run(self, started, duration, status, steps, before):
+        """Log where the run's time went, and write the metrics file and run summary"""
+        self.metrics.inc('runs_total', status=status)
+        self.metrics.set('run_duration_seconds', duration)
+        self.metrics.set('run_timestamp_seconds', time.time())
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(html)
+        timings = ', '.join(f"{name} {seconds:.1f}s" for name, seconds in steps.items())
+        logger.info(f"Daily job {status} in {duration:.1f}s: {timings}")
         
-        logger.info(f"Report generated: {output_file}")
-        return output_file
+        self.last_run = {
+            'started': started.isoformat(timespec='seconds'),
+            'duration': round(duration, 3),
+            'status': status,
+            'steps': {name: round(seconds, 3) for name, seconds in steps.items()},
+            'pipeline': self.pipeline_stats,
+            'cache': dict(self.cache.stats) if self.cache else None,
+            'metrics': self.metrics.summary(since=before),
+        }
+        try:
+            if self.metrics_file:
+                self.metrics.write(self.metrics_file)
+            if self.run_log:
+                append_run_summary(self.run_log, self.last_run)
+        except OSError as e:
+            logger.error(f"Error writing run metrics: {e}")
     
-    def run_daily_job(self, email=None):
-        """Run daily scraping job and send notification"""
-        logger.info("Starting daily scraping job")
+    def run_daily_job(self, email=None, max_pages=DAILY_MAX_PAGES, stop_fraction=DAILY_STOP_FRACTION,
+                      report_file='car_prices_report.html', profile=None, profiler='sample', sweep=None,
+                      resume=True):
+        """Run daily scraping job and send notification
+        
+        Each site is paged through until stop_fraction of a page is already
+        known (or max_pages is reached); pass stop_fraction=None to always
+        fetch max_pages pages.
+        
+        Every SWEEP_EVERY_DAYS days the run is a sweep instead: each site is
+        paged through to the end (up to SWEEP_MAX_PAGES pages), which is what
+        finds sold and delisted listings. Pass sweep=True or False to force
+        or skip one.
         
-        # Scrape websites
-        new_pt, updated_pt = self.scrape_patiotuerca()
-        new_olx, updated_olx = self.scrape_olx()
+        With a crawl_budget, the scrape step fetches the pages due by the
+        crawl plan instead of paging through each site (see crawl_plan).
         
-        total_new = new_pt + new_olx
-        total_updated = updated_pt + updated_olx
+        Each run is checkpointed as it goes (see checkpoints.py). With resume
+        set, a run that died part way is picked up instead: with the options
+        it was started with, skipping the steps and pages it already did.
+        A failed run is left to be resumed the same way.
+        
+        The duration of each step and the run's counters are logged, written
+        to the metrics file and appended to the run log. With profile set to
+        a path, the run is profiled into it ('sample' or 'cprofile', see
+        metrics.profiled).
+        """
+        unfinished = self.unfinished_run() if resume else None
+        conn = sqlite3.connect(self.db_path)
+        try:
+            if unfinished:
+                run_id, options, done = unfinished
+                logger.info(f"Resuming daily run {run_id} (steps done: {', '.join(done) or 'none'})")
+                resume_run(conn, run_id)
+                email, max_pages, stop_fraction, report_file, sweep = (
+                    options['email'], options['max_pages'], options['stop_fraction'],
+                    options['report_file'], options['sweep'])
+            else:
+                logger.info("Starting daily scraping job")
+                if sweep is None:
+                    sweep = self.maintenance_due('sweep', SWEEP_EVERY_DAYS)
+                # The seen listings of an abandoned run don't carry over
+                self.reset_seen()
+                run_id, done = start_run(conn, {'email': email, 'max_pages': max_pages,
+                                                'stop_fraction': stop_fraction, 'report_file': report_file,
+                                                'sweep': sweep}), []
+        finally:
+            conn.close()
+        
+        started = datetime.now()
+        before = self.metrics.snapshot()
+        steps = {}
+        status = 'failed'
+        start = time.perf_counter()
+        try:
+            with profiled(profile, profiler) if profile else nullcontext():
+                result = self._daily_job(steps, run_id, done, email, max_pages, stop_fraction, report_file, sweep)
+            conn = sqlite3.connect(self.db_path)
+            try:
+                finish_run(conn, run_id)
+            finally:
+                conn.close()
+            status = 'ok'
+            return result
+        finally:
+            self._record_run(started, time.perf_counter() - start, status, steps, before)
+    
+    def _daily_job(self, steps, run_id, done, email, max_pages, stop_fraction, report_file, sweep):
+        if self.cache:
+            self.cache.reset_stats()
+        
+        # Scrape all registered websites in parallel
+        sites = {site: SWEEP_MAX_PAGES if sweep else max_pages for site in self.sites}
+        if 'scrape' in done:
+            totals = self.run_totals(run_id, sites)
+        else:
+            with self._step(steps, 'scrape', run_id):
+                if sweep:
+                    logger.info("Sweeping every site to its last page")
+                    totals = self.scrape_sites(sites, sweep=True, run_id=run_id)
+                    conn = sqlite3.connect(self.db_path)
+                    try:
+                        self._maintenance_done(conn, 'sweep')
+                        conn.commit()
+                    finally:
+                        conn.close()
+                elif self.crawl_budget:
+                    totals = self.scrape_sites(self.crawl_plan(), run_id=run_id)
+                else:
+                    totals = self.scrape_sites(sites, stop_fraction, run_id=run_id)
+        
+        total_new = sum(new for new, _ in totals.values())
+        total_updated = sum(updated for _, updated in totals.values())
         
         logger.info(f"Scraping completed: {total_new} new listings, {total_updated} price updates")
         
+        cache_summary = ""
+        if self.cache:
+            stats = self.cache.stats
+            hits = stats['not_modified'] + stats['unchanged']
+            cache_summary = (f"{hits} unchanged pages skipped ({stats['not_modified']} not modified, "
+                             f"{stats['unchanged']} same content), {stats['misses']} pages fetched, "
+                             f"{stats['bytes_saved'] / 1024:.0f} KB not downloaded")
+            logger.info(f"Response cache: {cache_summary}")
+        
+        if 'duplicates' not in done:
+            with self._step(steps, 'duplicates', run_id):
+                self.resolve_duplicates()
+        if 'analytics' not in done:
+            with self._step(steps, 'analytics', run_id):
+                self.export_analytics()
+        if 'deals' not in done:
+            with self._step(steps, 'deals', run_id):
+                self.score_deals()
+        if 'retention' not in done:
+            with self._step(steps, 'retention', run_id):
+                self.compact_history()
+        
         # Generate report
-        report_file = self.generate_report()
-        
-        # Send email notification if requested
-        if email:
-            subject = f"Daily Car Price Report - {datetime.now().strftime('%Y-%m-%d')}"
-            message = f"""
-            <p>Daily car price scraping has completed:</p>
-            <ul>
-                <li>{total_new} new listings added</li>
-                <li>{total_updated} price updates detected</li>
-            </ul>
-            <p>See attached report for details.</p>
-            """
+        if 'report' not in done:
+            with self._step(steps, 'report', run_id):
+                report_file = self.generate_report(report_file)
+        
+        # Alert digests and the summary email share one SMTP connection
+        with self.mailer:
+            if 'alerts' not in done:
+                with self._step(steps, 'alerts', run_id):
+                    self.send_alert_digests()
             
-            self.send_email_notification(email, subject, message)
+            # Send email notification if requested
+            if email and 'email' not in done:
+                subject = f"Daily Car Price Report - {datetime.now().strftime('%Y-%m-%d')}"
+                message = f"""
+                <p>Daily car price scraping has completed:</p>
+                <ul>
+                    <li>{total_new} new listings added</li>
+                    <li>{total_updated} price updates detected</li>
+                    {f'<li>Response cache: {cache_summary}</li>' if cache_summary else ''}
+                </ul>
+                <p>See attached report for details.</p>
+                """
+                
+                with self._step(steps, 'email', run_id):
+                    self.send_email_notification(email, subject, message)
         
         return total_new, total_updated
 
 # Main execution
 if __name__ == "__main__":
-    tracker = CarPriceTracker()
+    parser = argparse.ArgumentParser(description="Track used car prices in Ecuador; runs the daily job without a command")
+    commands = parser.add_subparsers(dest='command')
+    reparse = commands.add_parser('reparse', help='re-extract archived pages and backfill cars and prices')
+    reparse.add_argument('start', help='first day, YYYY-MM-DD')
+    reparse.add_argument('end', nargs='?', help='last day, YYYY-MM-DD (defaults to start)')
+    reparse.add_argument('--site', action='append', help='only this site (repeatable)')
+    reparse.add_argument('--workers', type=int, default=None, help='parse worker processes')
+    simulate = commands.add_parser('simulate', help='replay the recorded crawls against the crawl policies')
+    simulate.add_argument('--days', type=int, default=28, help='days of crawl history to replay')
+    simulate.add_argument('--budget', type=int, default=None,
+                          help='requests per day (defaults to what the daily crawl spent)')
+    parser.add_argument('--crawl-budget', type=int, default=None,
+                        help=f'crawl adaptively every {CRAWL_TICK_MINUTES} minutes within this many requests a day')
+    args = parser.parse_args()
     
-    # Schedule daily job
-    schedule.every().day.at("07:00").do(tracker.run_daily_job, email="your_email@example.com")
+    tracker = CarPriceTracker(crawl_budget=args.crawl_budget)
     
-    # Initial run
-    tracker.run_daily_job()
-    
-    # Keep the script running
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
\ No newline at end of file
+    if args.command == 'reparse':
+        totals = tracker.reparse(args.start, args.end, args.site, args.workers)
+        for site, (new_listings, updated_prices) in totals.items():
+            print(f"{site}: {new_listings} new listings, {updated_prices} listings with prices backfilled")
+    elif args.command == 'simulate':
+        budget, results = tracker.simulate_crawls(args.days, args.budget)
+        print(f"Replaying {args.days} days of crawls, {budget} requests a day for the budgeted policies")
+        for result in results:
+            print(f"{result['policy']:>12}: {result['requests_per_day']:.0f} requests/day, "
+                  f"{result['changes']:.0f} changes ({result['fresh_per_request']:.3f} fresh per request), "
+                  f"found after {result['avg_delay_hours']:.1f}h on average")
+    else:
+        # Expose run metrics for Prometheus while the daemon is up
+        try:
+            tracker.metrics.serve(METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Error starting metrics endpoint on port {METRICS_PORT}: {e}")
+        
+        # Schedule daily job
+        schedule.every().day.at("07:00").do(tracker.run_daily_job, email="your_email@example.com")
+        if tracker.crawl_budget:
+            schedule.every(CRAWL_TICK_MINUTES).minutes.do(tracker.run_scheduled_crawl)
+        
+        # Initial run; a run that died part way (say, with the machine) is
+        # resumed now rather than waiting for the next 07:00
+        unfinished = tracker.unfinished_run()
+        if unfinished:
+            logger.info(f"Found unfinished daily run {unfinished[0]}, resuming it at startup")
+        tracker.run_daily_job()
+        
+        # Keep the script running
+        while True:
+            schedule.run_pending()
+            time.sleep(60)
\ No newline at end of file
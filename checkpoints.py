@@ -0,0 +1,154 @@
+"""Checkpoints of daily runs, so a run that died can pick up where it stopped
+
+A daily run is a row in job_runs with the options it was started with and
+the steps of the job it has finished. While it scrapes, every page that is
+done is recorded in run_pages in the same transaction as its listings, so
+a page is checkpointed exactly when its data is in the database:
+
+    run_id  site         page  status     stop  new_listings  updated_prices
+    12      PatioTuerca  1     stored     NULL  3             1
+    12      PatioTuerca  2     stored     known 0             0     # stopped paging here
+    12      OLX          1     unchanged  NULL  0             0
+
+A resumed run skips the steps and pages already done, doesn't page sites
+that already stopped, and keeps the run's seen_urls, so the result is the
+same as if it had never been interrupted.
+"""
+import json
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger('CarTracker')
+
+# Runs older than this, or resumed this many times, are given up on
+RESUME_WITHIN_HOURS = 20
+MAX_RUN_ATTEMPTS = 3
+
+# A page whose listings were stored (or at least recorded as seen), and
+# one skipped as unchanged without its listings being seen
+PAGE_STORED = 'stored'
+PAGE_UNCHANGED = 'unchanged'
+
+# Why a page stopped its site
+STOP_END = 'end'
+STOP_KNOWN = 'known'
+STOP_UNCHANGED = 'unchanged'
+
+
+def start_run(conn, options):
+    """Record a new run; returns its id"""
+    run_id = conn.execute('''
+    INSERT INTO job_runs (started, status, options) VALUES (?, 'running', ?)
+    ''', (datetime.now().isoformat(timespec='seconds'), json.dumps(options))).lastrowid
+    conn.commit()
+    return run_id
+
+
+def unfinished_run(conn, now=None):
+    """(run_id, options, steps done) of the run to resume, or None
+
+    Runs that are too old or were already resumed MAX_RUN_ATTEMPTS times
+    are marked abandoned instead.
+    """
+    now = now or datetime.now()
+    row = conn.execute('''
+    SELECT id, started, attempts, options, steps FROM job_runs
+    WHERE status = 'running'
+    ORDER BY id DESC LIMIT 1
+    ''').fetchone()
+    if row is None:
+        return None
+    run_id, started, attempts, options, steps = row
+    if attempts >= MAX_RUN_ATTEMPTS or datetime.fromisoformat(started) < now - timedelta(hours=RESUME_WITHIN_HOURS):
+        logger.info(f"Abandoning run {run_id} started {started} after {attempts} attempts")
+        finish_run(conn, run_id, 'abandoned')
+        return None
+    return run_id, json.loads(options), json.loads(steps)
+
+
+def resume_run(conn, run_id):
+    conn.execute('UPDATE job_runs SET attempts = attempts + 1 WHERE id = ?', (run_id,))
+    conn.commit()
+
+
+def step_done(conn, run_id, step):
+    """Record a step of the run as done, in the connection's current transaction"""
+    conn.execute('''
+    UPDATE job_runs SET steps = json_insert(steps, '$[#]', ?)
+    WHERE id = ? AND NOT EXISTS (SELECT 1 FROM json_each(steps) WHERE value = ?)
+    ''', (step, run_id, step))
+
+
+def finish_run(conn, run_id, status='ok'):
+    """Close a run; its page checkpoints are no longer needed"""
+    conn.execute('''
+    UPDATE job_runs SET status = ?, finished = ? WHERE id = ?
+    ''', (status, datetime.now().isoformat(timespec='seconds'), run_id))
+    conn.execute('DELETE FROM run_pages WHERE run_id = ?', (run_id,))
+    conn.commit()
+
+
+def record_pages(conn, run_id, pages):
+    """Checkpoint (site, page, status, stop, new_listings, updated_prices) rows
+
+    Runs in the connection's current transaction, which should be the one
+    that wrote the pages' listings.
+    """
+    conn.executemany('''
+    INSERT OR REPLACE INTO run_pages (run_id, site, page, status, stop, new_listings, updated_prices)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(run_id,) + tuple(page) for page in pages])
+
+
+def run_totals(conn, run_id):
+    """{site: (new_listings, updated_prices)} over every attempt of the run"""
+    return {site: (new, updated) for site, new, updated in conn.execute('''
+    SELECT site, SUM(new_listings), SUM(updated_prices) FROM run_pages WHERE run_id = ? GROUP BY site
+    ''', (run_id,))}
+
+
+class ResumeState:
+    """What earlier attempts of a run already did, as the scrape runners need it"""
+
+    def __init__(self, conn=None, run_id=None, sites=()):
+        # site -> pages done
+        self.done = {site: set() for site in sites}
+        # Sites that already stopped paging, and those that reached the end
+        self.stopped = set()
+        self.ended = set()
+        # Sites with pages whose listings weren't seen
+        self.incomplete = set()
+        # site -> hashes of the URLs seen so far, for end-of-results detection
+        self.seen = {site: set() for site in sites}
+        if conn is None or run_id is None:
+            return
+
+        rows = conn.execute('SELECT site, page, status, stop FROM run_pages WHERE run_id = ?', (run_id,))
+        for site, page, status, stop in rows:
+            if site not in self.done:
+                continue
+            self.done[site].add(page)
+            if status == PAGE_UNCHANGED:
+                self.incomplete.add(site)
+            if stop:
+                self.stopped.add(site)
+            if stop == STOP_END:
+                self.ended.add(site)
+
+        if any(self.done.values()):
+            for site, url in conn.execute('SELECT c.website, s.url FROM seen_urls s JOIN cars c ON c.url = s.url'):
+                if site in self.seen:
+                    self.seen[site].add(hash(url))
+            pages = sum(len(pages) for pages in self.done.values())
+            logger.info(f"Resuming run {run_id}: {pages} pages already done, "
+                        f"{len(self.stopped)} sites already stopped")
+
+    def pages(self, site, pages):
+        """The pages of 1..pages, or of a list of pages, not done yet"""
+        if isinstance(pages, int):
+            pages = range(1, pages + 1)
+        return [page for page in sorted(pages) if page not in self.done[site]]
+
+    def next_page(self, site):
+        """First page past everything done"""
+        return max(self.done[site], default=0) + 1
@@ -0,0 +1,183 @@
+"""Deal scoring: how cheap a listing is for what it is
+
+A price model log(price) ~ 1 + age + mileage is fitted per make/model
+segment, and every listing is scored by its residual in units of its
+segment's residual spread. A score of -2 means priced two standard
+deviations below similar cars. All segments are fitted at once from
+grouped sums of the normal equations, so there is no per-listing Python.
+"""
+import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('CarTracker')
+
+# Listings a segment needs before its model is trusted
+MIN_SEGMENT_LISTINGS = 8
+# Small penalty on the age and mileage coefficients, so tiny or degenerate
+# segments (e.g. no mileage data at all) still have a unique fit
+RIDGE = 1e-3
+# Listings scoring at or below this are flagged as deals
+DEAL_THRESHOLD = -1.5
+
+
+def prepare_features(listings, year=None):
+    """Design matrix [1, age, mileage in 10,000 km] and target log(price)
+
+    A year or mileage of 0 means the site didn't list it; those are filled
+    in with the segment median, or the overall median for segments that
+    never list it.
+    """
+    year = year or datetime.now().year
+    segments = listings.groupby(['make', 'model'], sort=False).ngroup()
+
+    def impute(column):
+        known = listings[column].where(listings[column] > 0)
+        filled = known.fillna(known.groupby(segments).transform('median'))
+        return filled.fillna(known.median()).fillna(0).to_numpy(dtype=float)
+
+    age = np.maximum(year - impute('year'), 0)
+    km = impute('mileage') / 10000
+    X = np.column_stack([np.ones(len(listings)), age, km])
+    return segments.to_numpy(), X, np.log(listings['price'].to_numpy(dtype=float))
+
+
+def fit_segments(listings, min_listings=MIN_SEGMENT_LISTINGS, ridge=RIDGE):
+    """Fit every segment and score its listings
+
+    listings needs car_id, make, model, year, mileage and price columns,
+    with price > 0. Returns (segments, scores): one row per make/model
+    with its coefficients and residual spread, and one row per listing of
+    a segment with at least min_listings listings.
+    """
+    codes, X, y = prepare_features(listings)
+    count = np.bincount(codes)
+    groups = len(count)
+    n_features = X.shape[1]
+
+    # Per-segment X'X and X'y via weighted bincounts
+    xtx = np.empty((groups, n_features, n_features))
+    xty = np.empty((groups, n_features))
+    for i in range(n_features):
+        xty[:, i] = np.bincount(codes, X[:, i] * y, minlength=groups)
+        for j in range(i, n_features):
+            xtx[:, i, j] = xtx[:, j, i] = np.bincount(codes, X[:, i] * X[:, j], minlength=groups)
+    xtx[:, 1:, 1:] += ridge * np.eye(n_features - 1)
+    coef = np.linalg.solve(xtx, xty[..., None])[..., 0]
+
+    predicted = (X * coef[codes]).sum(axis=1)
+    residual = y - predicted
+    dof = np.maximum(count - n_features, 1)
+    spread = np.sqrt(np.bincount(codes, residual ** 2, minlength=groups) / dof)
+
+    keys = listings.groupby(['make', 'model'], sort=False).size().reset_index()
+    segments = pd.DataFrame({
+        'make': keys['make'],
+        'model': keys['model'],
+        'listings': count,
+        'intercept': coef[:, 0],
+        'age_coef': coef[:, 1],
+        'km_coef': coef[:, 2],
+        'resid_std': spread,
+    })
+
+    trusted = (count >= min_listings) & (spread > 0)
+    scored = trusted[codes]
+    scores = pd.DataFrame({
+        'car_id': listings['car_id'].to_numpy()[scored],
+        'score': (residual / np.where(spread > 0, spread, 1)[codes])[scored],
+        'expected_price': np.exp(predicted[scored]),
+    })
+    return segments, scores
+
+
+class DealScorer:
+    """Keeps the deal_scores and deal_segments tables up to date
+
+    Segments are refit only when one of their listings got a new price
+    row since the last run. The highest price_history.id seen at fit time
+    is the watermark.
+    """
+
+    def __init__(self, min_listings=MIN_SEGMENT_LISTINGS, ridge=RIDGE):
+        self.min_listings = min_listings
+        self.ridge = ridge
+
+    def stale_segments(self, conn):
+        """Make/model pairs with new prices since the last fit, or None for all"""
+        watermark = conn.execute('SELECT MAX(price_id) FROM deal_segments').fetchone()[0]
+        if watermark is None:
+            return None
+        return conn.execute('''
+        SELECT DISTINCT c.make, c.model
+        FROM price_history p
+        JOIN cars c ON c.id = p.car_id
+        WHERE p.id > ?
+        ''', (watermark,)).fetchall()
+
+    def load_listings(self, conn, segments=None):
+        """Current price of every listing, optionally only in the given segments"""
+        query = '''
+        SELECT c.id as car_id, c.make, c.model, c.year, c.mileage, lp.price
+        FROM cars c
+        JOIN latest_prices lp ON lp.car_id = c.id
+        '''
+        if segments is not None:
+            query += 'JOIN temp.stale_segments s ON s.make = c.make AND s.model = c.model\n'
+        query += 'WHERE lp.price > 0'
+        return pd.read_sql_query(query, conn)
+
+    def update(self, conn, force=False):
+        """Refit the stale segments and rewrite their scores; returns how many were refit"""
+        cursor = conn.cursor()
+        price_id = cursor.execute('SELECT COALESCE(MAX(id), 0) FROM price_history').fetchone()[0]
+        segments = None if force else self.stale_segments(conn)
+        if segments is not None and not segments:
+            return 0
+
+        cursor.execute('BEGIN')
+        try:
+            if segments is None:
+                listings = self.load_listings(conn)
+                cursor.execute('DELETE FROM deal_scores')
+                cursor.execute('DELETE FROM deal_segments')
+            else:
+                cursor.execute('CREATE TEMP TABLE IF NOT EXISTS stale_segments (make TEXT, model TEXT)')
+                cursor.execute('DELETE FROM temp.stale_segments')
+                cursor.executemany('INSERT INTO temp.stale_segments VALUES (?, ?)', segments)
+                listings = self.load_listings(conn, segments)
+                cursor.execute('''
+                DELETE FROM deal_scores WHERE car_id IN (
+                    SELECT c.id FROM cars c
+                    JOIN temp.stale_segments s ON s.make = c.make AND s.model = c.model
+                )''')
+                cursor.execute('''
+                DELETE FROM deal_segments WHERE (make, model) IN (
+                    SELECT make, model FROM temp.stale_segments
+                )''')
+
+            refit = 0
+            if not listings.empty:
+                fitted, scores = fit_segments(listings, self.min_listings, self.ridge)
+                fitted['price_id'] = price_id
+                cursor.executemany('''
+                INSERT INTO deal_segments (make, model, listings, intercept, age_coef, km_coef, resid_std, price_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', fitted.itertuples(index=False, name=None))
+                cursor.executemany('''
+                INSERT INTO deal_scores (car_id, score, expected_price)
+                VALUES (?, ?, ?)
+                ''', scores.itertuples(index=False, name=None))
+                refit = len(fitted)
+
+            # Segments without new data are up to date as of this run too
+            cursor.execute('UPDATE deal_segments SET price_id = ?', (price_id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        logger.info(f"Deal scores: refit {refit} segments ({len(listings)} listings)")
+        return refit
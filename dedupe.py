@@ -0,0 +1,201 @@
+"""Cross-site duplicate detection
+
+The same car is often listed on several marketplaces. Listings are linked
+into entities (one per physical car) by comparing make, model, year,
+mileage, location and price. Candidates come from a blocking index on
+make + year + mileage band, and within a block by price, so each new
+listing is compared with a handful of plausible matches instead of every
+known listing.
+"""
+import bisect
+import logging
+import re
+
+logger = logging.getLogger('CarTracker')
+
+# Listings at least this similar are considered the same car
+MATCH_THRESHOLD = 0.75
+# Width of a mileage block; neighbouring bands are searched too
+BAND_KM = 10000
+# Relative price difference at which prices stop counting as similar
+MAX_PRICE_DIFF = 0.2
+MAX_MILEAGE_DIFF = 15000
+
+WEIGHTS = {'model': 0.35, 'price': 0.3, 'mileage': 0.2, 'location': 0.15}
+
+
+def normalize(text):
+    return re.sub(r'[^\w]+', ' ', (text or '').casefold()).strip()
+
+
+def mileage_band(mileage, band_km=BAND_KM):
+    """Block of a mileage, or None when the site didn't list it"""
+    return mileage // band_km if mileage else None
+
+
+def similarity(a, b):
+    """Score from 0 to 1 of how likely two listings are the same car
+
+    a and b are listing dicts as built by DuplicateResolver, with the model
+    tokens and location already normalized. Missing mileage counts as half
+    a match, so listings from sites that never show it can still be linked
+    on the other fields.
+    """
+    tokens_a = a['model_tokens']
+    tokens_b = b['model_tokens']
+    # Containment rather than Jaccard: 'Aveo' matches 'Aveo Family'
+    model = len(tokens_a & tokens_b) / min(len(tokens_a), len(tokens_b)) if tokens_a and tokens_b else 0.0
+
+    if a['price'] and b['price']:
+        diff = abs(a['price'] - b['price']) / max(a['price'], b['price'])
+        price = max(0.0, 1 - diff / MAX_PRICE_DIFF)
+    else:
+        price = 0.0
+
+    if a['mileage'] and b['mileage']:
+        mileage = max(0.0, 1 - abs(a['mileage'] - b['mileage']) / MAX_MILEAGE_DIFF)
+    else:
+        mileage = 0.5
+
+    location = 1.0 if a['location'] and a['location'] == b['location'] else 0.0
+
+    return (WEIGHTS['model'] * model + WEIGHTS['price'] * price +
+            WEIGHTS['mileage'] * mileage + WEIGHTS['location'] * location)
+
+
+class DuplicateResolver:
+    """Incrementally links new listings to the entities of earlier ones
+
+    Every car gets a row in listing_entities. Its entity_id is the id of
+    the first listing of that car, so a car listed once is its own entity.
+    Only cars added since the last run are compared, against the
+    already-resolved cars in their blocks.
+    """
+
+    def __init__(self, threshold=MATCH_THRESHOLD, band_km=BAND_KM):
+        self.threshold = threshold
+        self.band_km = band_km
+
+    def _listing(self, row):
+        car_id, entity_id, website, make, model, year, mileage, location, price = row
+        return {
+            'car_id': car_id,
+            'entity_id': entity_id,
+            'website': website,
+            'make_key': normalize(make),
+            'model_tokens': frozenset(normalize(model).split()),
+            'year': year or 0,
+            'mileage': mileage or 0,
+            'band': mileage_band(mileage, self.band_km),
+            'location': normalize(location),
+            'price': price or 0.0,
+        }
+
+    def _add(self, blocks, listing):
+        if not (listing['make_key'] and listing['year'] and listing['price']):
+            return
+        bands = blocks.setdefault((listing['make_key'], listing['year']), {})
+        bisect.insort(bands.setdefault(listing['band'], []), (listing['price'], listing['car_id'], listing))
+
+    def _candidates(self, blocks, listing):
+        """Resolved listings from other sites that could score above the threshold
+
+        Those are in the same make/year block, a neighbouring mileage band
+        (any band if either mileage is unknown), and within MAX_PRICE_DIFF
+        of the price: further apart, the other fields can't make up for it.
+        """
+        bands = blocks.get((listing['make_key'], listing['year']))
+        if not bands or not listing['price']:
+            return
+        band = listing['band']
+        if band is None:
+            searched = list(bands)
+        else:
+            searched = [band - 1, band, band + 1, None]
+
+        low = listing['price'] * (1 - MAX_PRICE_DIFF)
+        high = listing['price'] / (1 - MAX_PRICE_DIFF)
+        for key in searched:
+            entries = bands.get(key, ())
+            for i in range(bisect.bisect_left(entries, (low,)), len(entries)):
+                price, _, candidate = entries[i]
+                if price > high:
+                    break
+                if candidate['website'] != listing['website']:
+                    yield candidate
+
+    def resolve(self, conn):
+        """Link the cars added since the last run; returns (resolved, linked)"""
+        cursor = conn.cursor()
+        watermark = cursor.execute('SELECT COALESCE(MAX(car_id), 0) FROM listing_entities').fetchone()[0]
+        new_rows = cursor.execute('''
+        SELECT c.id, NULL, c.website, c.make, c.model, c.year, c.mileage, COALESCE(l.name, c.location), lp.price
+        FROM cars c
+        LEFT JOIN locations l ON l.id = c.location_id
+        LEFT JOIN latest_prices lp ON lp.car_id = c.id
+        WHERE c.id > ?
+        ORDER BY c.id
+        ''', (watermark,)).fetchall()
+        if not new_rows:
+            return 0, 0
+        new_listings = [self._listing(row) for row in new_rows]
+
+        cursor.execute('BEGIN')
+        try:
+            # Load the resolved listings in the blocks the new ones fall in
+            cursor.execute('CREATE TEMP TABLE IF NOT EXISTS new_blocks (make_key TEXT, year INTEGER)')
+            cursor.execute('DELETE FROM temp.new_blocks')
+            keys = {(listing['make_key'], listing['year']) for listing in new_listings
+                    if listing['make_key'] and listing['year']}
+            cursor.executemany('INSERT INTO temp.new_blocks VALUES (?, ?)', keys)
+            cursor.execute('''
+            SELECT le.car_id, le.entity_id, c.website, c.make, c.model, c.year, c.mileage,
+                   COALESCE(l.name, c.location), lp.price
+            FROM listing_entities le
+            JOIN temp.new_blocks b ON b.make_key = le.make_key AND b.year = le.year
+            JOIN cars c ON c.id = le.car_id
+            LEFT JOIN locations l ON l.id = c.location_id
+            LEFT JOIN latest_prices lp ON lp.car_id = le.car_id
+            ''')
+            blocks = {}
+            entity_sites = {}
+            for row in cursor.fetchall():
+                listing = self._listing(row)
+                self._add(blocks, listing)
+                entity_sites.setdefault(listing['entity_id'], set()).add(listing['website'])
+
+            rows = []
+            linked = 0
+            for listing in new_listings:
+                best, best_score = None, self.threshold
+                for candidate in self._candidates(blocks, listing):
+                    # An entity holds at most one listing per site
+                    if listing['website'] in entity_sites[candidate['entity_id']]:
+                        continue
+                    score = similarity(listing, candidate)
+                    if score >= best_score:
+                        best, best_score = candidate, score
+
+                if best is not None:
+                    listing['entity_id'] = best['entity_id']
+                    linked += 1
+                else:
+                    listing['entity_id'] = listing['car_id']
+                entity_sites.setdefault(listing['entity_id'], set()).add(listing['website'])
+
+                # Later listings in this batch can match this one
+                self._add(blocks, listing)
+                rows.append((listing['car_id'], listing['entity_id'], listing['make_key'], listing['year'],
+                             listing['band'], best_score if best is not None else None))
+
+            cursor.executemany('''
+            INSERT INTO listing_entities (car_id, entity_id, make_key, year, mileage_band, similarity)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        logger.info(f"Duplicate detection: {len(rows)} new listings, {linked} linked to a listing on another site")
+        return len(rows), linked
@@ -0,0 +1,645 @@
+"""Distributed scraping: a durable job queue shared by worker processes
+
+The coordinator enqueues (site, page) jobs in a SQLite queue. Worker
+processes, on this host or on others sharing the queue file, claim jobs
+under a lease, fetch and parse the page and hand the listings back through
+the queue. The coordinator is the only writer to the listings database.
+
+    coordinator  enqueues pages, writes results, decides when to stop paging
+    workers      claim -> fetch -> parse -> complete, any number of them
+
+A job whose worker dies is claimed again once its lease expires. Host
+politeness is enforced in the claim itself: each host's next allowed
+request start and its leased job count live in the queue, so the
+HostPolicy limits hold across all workers rather than per process.
+
+Run extra workers with:
+
+    python distributed.py worker --queue jobs.db
+
+Pages are checkpointed by the coordinator as it writes them, exactly as in
+the in-process pipeline, so a coordinator that died can be resumed with
+the same daily run.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+from urllib.parse import urlsplit
+
+from archive import PageArchive
+from checkpoints import PAGE_STORED, PAGE_UNCHANGED, STOP_END, STOP_KNOWN, STOP_UNCHANGED, record_pages
+from fetcher import (CACHE_NOT_MODIFIED, CACHE_UNCHANGED, DEFAULT_HEADERS, FetchEngine, FetchJob, HostPolicy,
+                     ResponseCache)
+from pipeline import StageStats
+from scheduler import CRAWL_FAILED, record_crawls
+from sites import SITE_ADAPTERS, ExtractionEngine, Listing
+
+logger = logging.getLogger('CarTracker')
+
+# Seconds a worker has to finish a job before others may claim it again
+LEASE_SECONDS = 120
+# Claims (including expired leases) before a job is given up on
+MAX_ATTEMPTS = 3
+# Seconds an idle worker or coordinator waits before looking again
+POLL_INTERVAL = 0.2
+
+
+class JobQueue:
+    """SQLite-backed queue of page jobs, results and host limits
+
+    Every process opens its own connection. Claims and completions run in
+    IMMEDIATE transactions, so two workers can never lease the same job.
+    """
+
+    def __init__(self, path='jobs.db', lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Rollback journal rather than WAL, so the file can also be shared
+        # by workers on other hosts over a filesystem with working locks
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            started REAL,
+            finished REAL
+        );
+        CREATE TABLE IF NOT EXISTS hosts (
+            host TEXT PRIMARY KEY,
+            min_interval REAL,
+            max_concurrency INTEGER,
+            next_start REAL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            run_id INTEGER,
+            site TEXT,
+            page INTEGER,
+            url TEXT,
+            host TEXT,
+            state TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            worker TEXT,
+            lease_expires REAL,
+            UNIQUE (run_id, site, page)
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, host);
+        CREATE TABLE IF NOT EXISTS results (
+            job_id INTEGER PRIMARY KEY,
+            run_id INTEGER,
+            site TEXT,
+            page INTEGER,
+            status_code INTEGER,
+            cache_status TEXT,
+            error TEXT,
+            elapsed REAL,
+            bytes INTEGER,
+            parse_seconds REAL,
+            failed INTEGER,
+            listings TEXT,
+            consumed INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 1
+        );
+        CREATE INDEX IF NOT EXISTS idx_results_pending ON results (run_id, consumed);
+        ''')
+        # Requests a job took, failed ones included; added to older queue files
+        if 'attempts' not in {row[1] for row in self.conn.execute('PRAGMA table_info(results)')}:
+            self.conn.execute('ALTER TABLE results ADD COLUMN attempts INTEGER DEFAULT 1')
+
+    def _transaction(self, func, *args):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(*args)
+            self.conn.execute('COMMIT')
+            return result
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def start_run(self, policies):
+        """Open a run; policies maps host to its HostPolicy
+
+        There is one coordinator at a time, so runs still open were left by
+        one that died; they are closed first.
+        """
+        def start():
+            for (run_id,) in self.conn.execute('SELECT id FROM runs WHERE finished IS NULL').fetchall():
+                logger.info(f"Closing job queue run {run_id} left open by an earlier coordinator")
+                self._finish(run_id)
+            self.conn.executemany('''
+            INSERT INTO hosts (host, min_interval, max_concurrency) VALUES (?, ?, ?)
+            ON CONFLICT (host) DO UPDATE SET min_interval = excluded.min_interval,
+                                             max_concurrency = excluded.max_concurrency
+            ''', [(host, policy.min_interval, policy.max_concurrency) for host, policy in policies.items()])
+            return self.conn.execute('INSERT INTO runs (started) VALUES (?)', (time.time(),)).lastrowid
+        return self._transaction(start)
+
+    def finish_run(self, run_id):
+        """Close a run, dropping its jobs and results"""
+        self._transaction(self._finish, run_id)
+
+    def _finish(self, run_id):
+        self.conn.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), run_id))
+        self.conn.execute('DELETE FROM jobs WHERE run_id = ?', (run_id,))
+        self.conn.execute('DELETE FROM results WHERE run_id = ?', (run_id,))
+
+    def active_runs(self):
+        return self.conn.execute('SELECT COUNT(*) FROM runs WHERE finished IS NULL').fetchone()[0]
+
+    def enqueue(self, run_id, jobs):
+        """Add FetchJobs to a run; pages already queued are ignored"""
+        self._transaction(lambda: self.conn.executemany('''
+        INSERT OR IGNORE INTO jobs (run_id, site, page, url, host) VALUES (?, ?, ?, ?, ?)
+        ''', [(run_id, job.site, job.page, job.url, urlsplit(job.url).netloc) for job in jobs]))
+
+    def cancel(self, run_id, site):
+        """Drop the pending jobs of a site, e.g. once it has stopped paging"""
+        self._transaction(lambda: self.conn.execute('''
+        UPDATE jobs SET state = 'cancelled' WHERE run_id = ? AND site = ? AND state = 'pending'
+        ''', (run_id, site)))
+
+    def claim(self, worker):
+        """Lease the next job whose host has a free slot
+
+        Returns (job_id, FetchJob), or (None, seconds to wait) when nothing
+        can be claimed yet. Jobs out of attempts are failed instead.
+        """
+        def claim():
+            now = time.time()
+            while True:
+                row = self.conn.execute('''
+                SELECT j.id, j.site, j.page, j.url, j.host, j.attempts, j.run_id
+                FROM jobs j
+                JOIN hosts h ON h.host = j.host
+                WHERE (j.state = 'pending' OR (j.state = 'leased' AND j.lease_expires < :now))
+                  AND h.next_start <= :now
+                  AND (SELECT COUNT(*) FROM jobs l
+                       WHERE l.host = j.host AND l.state = 'leased' AND l.lease_expires >= :now) < h.max_concurrency
+                ORDER BY h.next_start, j.id
+                LIMIT 1
+                ''', {'now': now}).fetchone()
+                if row is None:
+                    return None, self._wait(now)
+
+                job_id, site, page, url, host, attempts, run_id = row
+                if attempts >= self.max_attempts:
+                    self.conn.execute("UPDATE jobs SET state = 'failed' WHERE id = ?", (job_id,))
+                    self._insert_result(job_id, run_id, site, page,
+                                        error=f"lease expired {attempts} times", attempts=attempts)
+                    continue
+
+                self.conn.execute('''
+                UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE id = ?
+                ''', (worker, now + self.lease_seconds, job_id))
+                self.conn.execute('''
+                UPDATE hosts SET next_start = MAX(next_start, ?) + min_interval WHERE host = ?
+                ''', (now, host))
+                return job_id, FetchJob(site, page, url)
+        return self._transaction(claim)
+
+    def _wait(self, now):
+        row = self.conn.execute('''
+        SELECT MIN(h.next_start) FROM hosts h
+        WHERE EXISTS (SELECT 1 FROM jobs j WHERE j.host = h.host AND j.state = 'pending')
+        ''').fetchone()
+        if row[0] is None or row[0] <= now:
+            return POLL_INTERVAL
+        return min(row[0] - now, POLL_INTERVAL * 5)
+
+    def _insert_result(self, job_id, run_id, site, page, status_code=None, cache_status=None, error=None,
+                       elapsed=None, size=None, parse_seconds=None, failed=0, listings=None, attempts=1):
+        self.conn.execute('''
+        INSERT OR IGNORE INTO results (job_id, run_id, site, page, status_code, cache_status, error,
+                                       elapsed, bytes, parse_seconds, failed, listings, attempts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (job_id, run_id, site, page, status_code, cache_status, error, elapsed, size, parse_seconds,
+              failed, json.dumps(listings) if listings is not None else None, attempts))
+
+    def complete(self, job_id, worker, retry=False, **result):
+        """Hand back a leased job's result; returns False if the lease was lost
+
+        With retry set, the job goes back to pending instead, unless it is
+        out of attempts.
+        """
+        def complete():
+            row = self.conn.execute('''
+            SELECT run_id, site, page, attempts FROM jobs WHERE id = ? AND state = 'leased' AND worker = ?
+            ''', (job_id, worker)).fetchone()
+            if row is None:
+                return False
+            run_id, site, page, attempts = row
+            if retry and attempts < self.max_attempts:
+                self.conn.execute("UPDATE jobs SET state = 'pending', worker = NULL WHERE id = ?", (job_id,))
+                return True
+            self.conn.execute("UPDATE jobs SET state = 'done' WHERE id = ?", (job_id,))
+            self._insert_result(job_id, run_id, site, page, attempts=attempts, **result)
+            return True
+        return self._transaction(complete)
+
+    def results(self, run_id, limit=100):
+        """Results not yet written by the coordinator, oldest first; attempts is the requests the job took"""
+        rows = self.conn.execute('''
+        SELECT job_id, site, page, status_code, cache_status, error, elapsed, bytes, parse_seconds, failed, attempts,
+               listings
+        FROM results WHERE run_id = ? AND consumed = 0
+        ORDER BY job_id LIMIT ?
+        ''', (run_id, limit)).fetchall()
+        return [row[:-1] + ([Listing(*values) for values in json.loads(row[-1])] if row[-1] is not None else None,)
+                for row in rows]
+
+    def consume(self, job_ids):
+        self._transaction(lambda: self.conn.executemany(
+            'UPDATE results SET consumed = 1 WHERE job_id = ?', [(job_id,) for job_id in job_ids]))
+
+    def outstanding(self, run_id):
+        """Jobs of the run still pending or leased"""
+        return self.conn.execute('''
+        SELECT COUNT(*) FROM jobs WHERE run_id = ? AND state IN ('pending', 'leased')
+        ''', (run_id,)).fetchone()[0]
+
+    def counts(self):
+        """Jobs per state across open runs"""
+        return dict(self.conn.execute('''
+        SELECT state, COUNT(*) FROM jobs
+        WHERE run_id IN (SELECT id FROM runs WHERE finished IS NULL)
+        GROUP BY state
+        ''').fetchall())
+
+    def close(self):
+        self.conn.close()
+
+
+def run_worker(queue_path, adapters=None, headers=None, cache_path=None, idle_exit=False, timeout=30,
+               archive_path=None):
+    """Claim, fetch and parse jobs until stopped
+
+    With idle_exit set the worker returns once no run is open, which is
+    how the coordinator's local workers shut down. Returns the number of
+    jobs completed.
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    queue = JobQueue(queue_path)
+    engines = {name: ExtractionEngine(adapter) for name, adapter in (adapters or SITE_ADAPTERS).items()}
+    cache = ResponseCache(cache_path) if cache_path else None
+    archive = PageArchive(archive_path) if archive_path else None
+    # Spacing and concurrency are already enforced by the queue
+    fetcher = FetchEngine(headers=headers or DEFAULT_HEADERS, default_policy=HostPolicy(0.0, 1), timeout=timeout,
+                          cache=cache, archive=archive)
+    done = 0
+    try:
+        while True:
+            job_id, job = queue.claim(worker)
+            if job_id is None:
+                if idle_exit and not queue.active_runs():
+                    return done
+                time.sleep(job)
+                continue
+
+            result = fetcher.fetch(job)
+            if result.error is not None or (result.status_code or 0) >= 500 or result.status_code == 429:
+                error = str(result.error) if result.error is not None else None
+                queue.complete(job_id, worker, retry=True, status_code=result.status_code, error=error,
+                               elapsed=result.elapsed)
+                continue
+
+            size = len(result.text.encode('utf-8')) if result.text else 0
+            text = result.text if result.status_code == 200 else None
+            if result.cache_status in (CACHE_NOT_MODIFIED, CACHE_UNCHANGED):
+                # Unchanged pages are parsed from the cache too, so the
+                # coordinator knows their listings are still up
+                text = result.text or cache.get(job.url)
+            listings, failed, parse_seconds = None, 0, None
+            if text is not None:
+                start = time.perf_counter()
+                try:
+                    listings, failed = engines[job.site].extract_page(text)
+                except Exception as e:
+                    logger.error(f"Error parsing page {job.page} from {job.site}: {e}")
+                    queue.complete(job_id, worker, status_code=result.status_code, error=f"parse failed: {e}",
+                                   elapsed=result.elapsed, size=size)
+                    continue
+                parse_seconds = time.perf_counter() - start
+
+            queue.complete(job_id, worker, status_code=result.status_code, cache_status=result.cache_status,
+                           elapsed=result.elapsed, size=size, parse_seconds=parse_seconds, failed=failed,
+                           listings=[list(listing) for listing in listings] if listings is not None else None)
+            done += 1
+    finally:
+        fetcher.close()
+        queue.close()
+
+
+class Coordinator:
+    """One scraping run through the job queue, with this process as the single writer
+
+    Follows the same paging rules as Pipeline: with stop_fraction set, each
+    site keeps as many pages queued as its host allows and stops at the
+    first page that is mostly known already, failed or unchanged. Workers
+    parse unchanged pages from their cache as well; their listings are only
+    recorded as seen, not written again.
+    """
+
+    def __init__(self, tracker, queue_path='jobs.db', workers=4, batch_size=500):
+        self.tracker = tracker
+        self.queue_path = queue_path
+        # Local worker processes to start; 0 relies on workers started elsewhere
+        self.workers = workers
+        self.batch_size = batch_size
+        self.stats = {name: StageStats(name) for name in ('fetch', 'parse', 'store')}
+        self.wall = 0.0
+
+    def run(self, max_pages, stop_fraction=None, sweep=False, run_id=None, lifecycle=True):
+        """Scrape the sites in max_pages; see CarPriceTracker.scrape_sites"""
+        self.max_pages = max_pages
+        self.known = self.tracker.load_known_listings() if stop_fraction is not None else None
+        self.stop_fraction = stop_fraction
+        self.sweep = sweep
+        self.paging = stop_fraction is not None or sweep
+        self.lifecycle = lifecycle
+        # The daily run being checkpointed; self.run_id is the queue's own run
+        self.job_run = run_id
+        self.resume = self.tracker.resume_state(run_id, max_pages)
+        self.stopped = set(self.resume.stopped)
+        self.seen = self.resume.seen
+        self.ended = set(self.resume.ended)
+        self.incomplete = set(self.resume.incomplete)
+        self.next_page = {}
+        self.totals = {site: (0, 0) for site in max_pages}
+        # Failed requests, logged in page_crawls with the next batch
+        self.failures = []
+
+        queue = JobQueue(self.queue_path)
+        fetcher = self.tracker.fetcher
+        hosts = {urlsplit(self.tracker.site_urls[site]).netloc for site in max_pages}
+        self.run_id = queue.start_run({host: fetcher.policies.get(host, fetcher.default_policy) for host in hosts})
+        queue.enqueue(self.run_id, self._initial_jobs())
+
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=run_worker,
+                                     args=(self.queue_path, self.tracker.sites, self.tracker.headers,
+                                           self.tracker.cache.path if self.tracker.cache else None, True, 30,
+                                           self.tracker.archive.path if self.tracker.archive else None),
+                                     daemon=True)
+                     for _ in range(self.workers)]
+        for process in processes:
+            process.start()
+
+        start = time.perf_counter()
+        conn = sqlite3.connect(self.tracker.db_path)
+        try:
+            while True:
+                # Outstanding jobs first: a job completed between the two reads
+                # is then still in the results, not dropped by finish_run
+                outstanding = queue.outstanding(self.run_id)
+                results = queue.results(self.run_id, self.batch_size)
+                if results:
+                    self._write(conn, queue, results)
+                    continue
+                if not outstanding:
+                    break
+                if processes and not any(process.is_alive() for process in processes):
+                    logger.error(f"All local workers exited with {outstanding} jobs left")
+                    break
+                time.sleep(POLL_INTERVAL)
+            self._flush_failures(conn)
+        finally:
+            conn.close()
+            queue.finish_run(self.run_id)
+            queue.close()
+            for process in processes:
+                process.join(timeout=30)
+            self.wall = time.perf_counter() - start
+
+        for name, summary in self.summary().items():
+            logger.info(f"Workers {name}: {summary['processed']} done, {summary['failed']} failed, "
+                        f"{summary['per_sec']:.1f}/s, avg {summary['avg_latency'] * 1000:.0f}ms")
+        return self.totals
+
+    def summary(self):
+        return {name: stats.summary(self.wall) for name, stats in self.stats.items()}
+
+    def _checkpoints(self, pages, results):
+        """Checkpoint and page_crawls rows of stored pages"""
+        rows = []
+        crawls = []
+        i = 0
+        for site, page, listings, stop in pages:
+            page_results = results[i:i + len(listings)]
+            i += len(listings)
+            new_listings, updated_prices = page_results.count('new'), page_results.count('updated')
+            rows.append((site, page, PAGE_STORED, stop, new_listings, updated_prices))
+            crawls.append((site, page, PAGE_STORED, len(listings), new_listings, updated_prices))
+        return rows, crawls
+
+    def complete_sites(self):
+        """Sites whose every listing was seen by the last run"""
+        return self.ended - self.incomplete
+
+    def _job(self, site, page):
+        return FetchJob(site, page, self.tracker.site_urls[site].format(page=page))
+
+    def _initial_jobs(self):
+        if not self.paging:
+            return [self._job(site, page)
+                    for site, pages in self.max_pages.items()
+                    for page in self.resume.pages(site, pages)]
+
+        jobs = []
+        fetcher = self.tracker.fetcher
+        for site, cap in self.max_pages.items():
+            if site in self.stopped:
+                continue
+            start = self.resume.next_page(site)
+            host = urlsplit(self.tracker.site_urls[site]).netloc
+            window = fetcher.policies.get(host, fetcher.default_policy).max_concurrency
+            last = start + window - 1 if cap is None else min(start + window - 1, cap)
+            jobs.extend(self._job(site, page) for page in self.resume.pages(site, start - 1))
+            jobs.extend(self._job(site, page) for page in range(start, last + 1))
+            self.next_page[site] = last + 1
+        return jobs
+
+    def _stop(self, queue, site, reason):
+        if self.paging and site not in self.stopped:
+            self.stopped.add(site)
+            queue.cancel(self.run_id, site)
+            logger.info(f"Stopped paging {site}: {reason}")
+
+    def _lost(self, queue, site, reason):
+        self.incomplete.add(site)
+        self._stop(queue, site, reason)
+
+    def _seen(self, queue, site, page, listings):
+        """Record a page's listings as seen, stopping the site past its last page
+
+        Returns STOP_END if it did.
+        """
+        urls = {hash(listing.url) for listing in listings}
+        ended = urls <= self.seen[site]
+        if ended:
+            self.ended.add(site)
+            self._stop(queue, site, f"page {page} is past the last page")
+        self.seen[site] |= urls
+        return STOP_END if ended else None
+
+    def _follow(self, site):
+        if not self.paging or site in self.stopped:
+            return []
+        cap = self.max_pages[site]
+        if cap is not None and self.next_page[site] > cap:
+            return []
+        page = self.next_page[site]
+        self.next_page[site] += 1
+        return [self._job(site, page)]
+
+    def _write(self, conn, queue, results):
+        """Write a batch of results in one transaction and queue the pages that follow"""
+        metrics = self.tracker.metrics
+        pages = []
+        # Unchanged pages: seen, but nothing to write
+        unchanged = []
+        # Checkpoints of the unchanged pages
+        marks = []
+        follow = []
+        for (job_id, site, page, status_code, cache_status, error, elapsed, size, parse_seconds, failed, attempts,
+             listings) in results:
+            if elapsed is not None:
+                self.stats['fetch'].record(elapsed, failed=error is not None and status_code is None)
+                metrics.observe('http_request_seconds', elapsed, site=site)
+            if size:
+                metrics.inc('http_bytes_total', size, site=site)
+            if status_code is not None:
+                metrics.inc('http_responses_total', site=site, status=status_code)
+
+            # Every request the job made that didn't get its page, retries included
+            unchanged_page = cache_status in (CACHE_NOT_MODIFIED, CACHE_UNCHANGED)
+            lost = error is not None or (not unchanged_page and status_code != 200)
+            self._failed(site, page, attempts if lost else attempts - 1)
+
+            if error is not None:
+                logger.error(f"Error fetching page {page} from {site}: {error}")
+                metrics.inc('pages_failed_total', site=site, stage='fetch')
+                self._lost(queue, site, f"page {page} failed")
+            elif unchanged_page:
+                logger.info(f"Page {page} from {site} unchanged since last run")
+                metrics.inc('http_cache_total', site=site, status=cache_status)
+                if listings is None:
+                    marks.append((site, page, PAGE_UNCHANGED, STOP_UNCHANGED if self.paging else None, 0, 0))
+                    self._lost(queue, site, f"page {page} unchanged since last run")
+                else:
+                    listings = [listing for listing in listings if listing.url]
+                    stop = self._seen(queue, site, page, listings)
+                    unchanged.extend(listings)
+                    if not self.sweep:
+                        self._stop(queue, site, f"page {page} unchanged since last run")
+                        stop = stop or STOP_UNCHANGED
+                    marks.append((site, page, PAGE_STORED, stop, 0, 0))
+            elif status_code != 200:
+                logger.error(f"Failed to get page {page} from {site}. Status code: {status_code}")
+                metrics.inc('pages_failed_total', site=site, stage='fetch')
+                self._lost(queue, site, f"page {page} returned {status_code}")
+            else:
+                self.stats['parse'].record(parse_seconds or 0.0)
+                metrics.observe('parse_page_seconds', parse_seconds or 0.0, site=site)
+                metrics.inc('listings_parsed_total', len(listings), site=site)
+                if failed:
+                    metrics.inc('listings_failed_total', failed, site=site)
+
+                listings = [listing for listing in listings if listing.url]
+                stop = self._seen(queue, site, page, listings)
+                if self.known is not None:
+                    fraction = self.known.unchanged_fraction(listings)
+                    if listings and fraction >= self.stop_fraction:
+                        self._stop(queue, site, f"{fraction:.0%} of page {page} already known")
+                        stop = stop or STOP_KNOWN
+                    self.known.update(listings)
+                pages.append((site, page, listings, stop))
+            follow.extend(self._follow(site))
+
+        self._store(conn, pages, unchanged, marks)
+        queue.consume([row[0] for row in results])
+        if follow:
+            queue.enqueue(self.run_id, follow)
+
+    def _failed(self, site, page, requests):
+        """Log requests that didn't store their page, so they still count against the crawl budget"""
+        self.failures.extend([(site, page, CRAWL_FAILED, None, 0, 0)] * requests)
+
+    def _flush_failures(self, conn):
+        if not self.failures:
+            return
+        try:
+            record_crawls(conn, self.failures)
+            conn.commit()
+            self.failures = []
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Database error logging {len(self.failures)} failed requests: {e}")
+
+    def _store(self, conn, pages, unchanged=(), marks=()):
+        stats = self.stats['store']
+        start = time.perf_counter()
+        failures = list(self.failures)
+        try:
+            batch = [listing for _, _, listings, _ in pages for listing in listings]
+            results = self.tracker.write_listings(conn, batch)
+            self.tracker.record_seen(conn, batch + list(unchanged), self.lifecycle)
+            rows, crawls = self._checkpoints(pages, results)
+            record_crawls(conn, crawls + [(site, page, status, None, 0, 0) for site, page, status, _, _, _ in marks]
+                          + failures)
+            if self.job_run is not None:
+                record_pages(conn, self.job_run, rows + list(marks))
+            conn.commit()
+            del self.failures[:len(failures)]
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Database error writing {len(pages)} pages: {e}")
+            for site, page, *_ in list(pages) + list(marks):
+                self._failed(site, page, 1)
+            self.incomplete.update(site for site, _, _, _ in pages)
+            self.incomplete.update(listing.website for listing in unchanged)
+            stats.record(time.perf_counter() - start, failed=True)
+            return
+        elapsed = time.perf_counter() - start
+        stats.record(elapsed)
+        self.tracker.metrics.observe('db_transaction_seconds', elapsed, operation='store')
+        for listing, result in zip(batch, results):
+            new_listings, updated_prices = self.totals[listing.website]
+            self.totals[listing.website] = (new_listings + (result == 'new'),
+                                            updated_prices + (result == 'updated'))
+            if result == 'new':
+                self.tracker.metrics.inc('listings_new_total', site=listing.website)
+            elif result == 'updated':
+                self.tracker.metrics.inc('price_updates_total', site=listing.website)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    worker = sub.add_parser('worker', help='claim and scrape jobs until interrupted')
+    worker.add_argument('--queue', default='jobs.db')
+    worker.add_argument('--cache', default=None, help='response cache database (shared or per host)')
+    worker.add_argument('--archive', default=None, help='page archive directory (shared)')
+    worker.add_argument('--idle-exit', action='store_true', help='exit once no run is open')
+    status = sub.add_parser('status', help='print job counts of the open runs')
+    status.add_argument('--queue', default='jobs.db')
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        done = run_worker(args.queue, cache_path=args.cache, idle_exit=args.idle_exit, archive_path=args.archive)
+        print(f"{done} jobs completed")
+    else:
+        queue = JobQueue(args.queue)
+        print(json.dumps({'open_runs': queue.active_runs(), 'jobs': queue.counts()}))
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""Concurrent page fetching with per-host politeness"""
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('CarTracker')
+
+FetchJob = namedtuple('FetchJob', ['site', 'page', 'url'])
+FetchResult = namedtuple('FetchResult', ['site', 'page', 'url', 'status_code', 'text', 'elapsed', 'error',
+                                         'cache_status'], defaults=(None,))
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept-Language': 'es-ES,es;q=0.9,en;q=0.8'
+}
+
+# cache_status values for pages that need no parsing or storage
+CACHE_NOT_MODIFIED = 'not_modified'
+CACHE_UNCHANGED = 'unchanged'
+CACHE_MISS = 'miss'
+
+# Seconds between checks of a crawl's feed for new jobs while fetches are in flight
+FEED_POLL_INTERVAL = 0.05
+
+
+class HostPolicy:
+    """Politeness settings for one host"""
+
+    def __init__(self, min_interval=2.0, max_concurrency=2):
+        # Minimum number of seconds between two request starts to the host
+        self.min_interval = min_interval
+        # Maximum number of requests in flight to the host at once
+        self.max_concurrency = max_concurrency
+
+
+class ResponseCache:
+    """On-disk HTTP response cache keyed by URL
+
+    Stores each page's ETag/Last-Modified validators, a hash of the body and
+    the compressed body itself. Entries are evicted least recently used first
+    once the compressed bodies take up more than max_bytes.
+    """
+
+    def __init__(self, path='http_cache.db', max_bytes=100 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            body_hash TEXT,
+            body BLOB,
+            size INTEGER,
+            stored INTEGER,
+            last_used REAL
+        )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)')
+        self.conn.commit()
+        self.stored_bytes = self.conn.execute('SELECT COALESCE(SUM(stored), 0) FROM responses').fetchone()[0]
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Start counting hits and misses from zero, e.g. at the start of a run"""
+        with self.lock:
+            self.stats = {'not_modified': 0, 'unchanged': 0, 'misses': 0, 'bytes_saved': 0}
+
+    def request_headers(self, url):
+        """Conditional request headers for a cached URL"""
+        with self.lock:
+            row = self.conn.execute('SELECT etag, last_modified FROM responses WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row:
+            etag, last_modified = row
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def get(self, url):
+        """Return the cached body for a URL, or None"""
+        with self.lock:
+            row = self.conn.execute('SELECT body FROM responses WHERE url = ?', (url,)).fetchone()
+        return zlib.decompress(row[0]).decode('utf-8') if row else None
+
+    def not_modified(self, url):
+        """Record a 304 for a cached URL"""
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self.conn.execute('UPDATE responses SET last_used = ? WHERE url = ?', (time.time(), url))
+            self.conn.commit()
+            self.stats['not_modified'] += 1
+            self.stats['bytes_saved'] += row[0] if row else 0
+
+    def store(self, url, response):
+        """Cache a 200 response; returns CACHE_UNCHANGED if the body is the same as last time"""
+        body = response.content
+        body_hash = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            row = self.conn.execute('SELECT body_hash, stored FROM responses WHERE url = ?', (url,)).fetchone()
+            status = CACHE_UNCHANGED if row and row[0] == body_hash else CACHE_MISS
+            self.stats['unchanged' if status == CACHE_UNCHANGED else 'misses'] += 1
+
+            if status == CACHE_UNCHANGED:
+                self.conn.execute('''
+                UPDATE responses SET etag = ?, last_modified = ?, last_used = ? WHERE url = ?
+                ''', (response.headers.get('ETag'), response.headers.get('Last-Modified'), time.time(), url))
+            else:
+                compressed = zlib.compress(body)
+                self.conn.execute('''
+                INSERT OR REPLACE INTO responses (url, etag, last_modified, body_hash, body, size, stored, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (url, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                      body_hash, compressed, len(body), len(compressed), time.time()))
+                self.stored_bytes += len(compressed) - (row[1] if row else 0)
+                self._evict()
+            self.conn.commit()
+        return status
+
+    def _evict(self):
+        if self.stored_bytes <= self.max_bytes:
+            return
+        evicted = 0
+        for url, stored in self.conn.execute('SELECT url, stored FROM responses ORDER BY last_used').fetchall():
+            if self.stored_bytes <= self.max_bytes:
+                break
+            self.conn.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self.stored_bytes -= stored
+            evicted += 1
+        logger.info(f"Evicted {evicted} pages from the response cache")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class _HostState:
+    """Rate limiter, concurrency cap and pooled session for one host"""
+
+    def __init__(self, policy, headers):
+        self.policy = policy
+        self.slots = threading.BoundedSemaphore(policy.max_concurrency)
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+        # One keep-alive pool per host, sized to the concurrency cap
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=policy.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def wait_turn(self):
+        """Block until the rate limit allows another request to start"""
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.policy.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class FetchEngine:
+    """Thread pool that fetches pages from several hosts in parallel
+
+    Each host gets its own requests.Session and is held to its HostPolicy,
+    so different marketplaces are fetched side by side while any single
+    site sees no more than the configured request rate.
+    """
+
+    def __init__(self, headers=None, policies=None, default_policy=None, max_workers=8, timeout=30, cache=None,
+                 metrics=None, archive=None):
+        self.headers = headers or {}
+        # Optional ResponseCache for conditional requests
+        self.cache = cache
+        # Optional PageArchive that keeps every page fetched
+        self.archive = archive
+        # Optional MetricsRegistry for latency, status and byte counts per site
+        self.metrics = metrics
+        self.policies = policies or {}
+        self.default_policy = default_policy or HostPolicy()
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts:
+                policy = self.policies.get(host, self.default_policy)
+                self._hosts[host] = _HostState(policy, self.headers)
+            return self._hosts[host]
+
+    def fetch(self, job):
+        """Fetch a single job, honouring the host's limits"""
+        state = self._host(job.url)
+        with state.slots:
+            state.wait_turn()
+            start = time.perf_counter()
+            try:
+                headers = self.cache.request_headers(job.url) if self.cache else None
+                response = state.session.get(job.url, headers=headers, timeout=self.timeout)
+                elapsed = time.perf_counter() - start
+
+                cache_status = None
+                if self.cache and response.status_code == 304:
+                    self.cache.not_modified(job.url)
+                    cache_status = CACHE_NOT_MODIFIED
+                elif self.cache and response.status_code == 200:
+                    cache_status = self.cache.store(job.url, response)
+                self._record(job, elapsed, response, cache_status)
+                if self.archive and response.status_code in (200, 304):
+                    self._archive(job, response)
+
+                if cache_status == CACHE_NOT_MODIFIED:
+                    return FetchResult(job.site, job.page, job.url, response.status_code,
+                                       None, elapsed, None, CACHE_NOT_MODIFIED)
+                return FetchResult(job.site, job.page, job.url, response.status_code,
+                                   response.text, elapsed, None, cache_status)
+            except requests.RequestException as e:
+                elapsed = time.perf_counter() - start
+                self._record(job, elapsed)
+                return FetchResult(job.site, job.page, job.url, None, None, elapsed, e)
+
+    def _archive(self, job, response):
+        """Keep the page in the archive; a 304 is recorded with the body last archived or cached"""
+        try:
+            body = response.content if response.status_code == 200 else None
+            status = self.archive.capture(job.site, job.page, job.url, body)
+            if status is None and self.cache:
+                text = self.cache.get(job.url)
+                if text is not None:
+                    status = self.archive.capture(job.site, job.page, job.url, text.encode('utf-8'))
+        except Exception as e:
+            logger.error(f"Error archiving page {job.page} from {job.site}: {e}")
+            return
+        if self.metrics and status:
+            self.metrics.inc('pages_archived_total', site=job.site, body=status)
+
+    def _record(self, job, elapsed, response=None, cache_status=None):
+        if not self.metrics:
+            return
+        self.metrics.observe('http_request_seconds', elapsed, site=job.site)
+        if response is None:
+            self.metrics.inc('http_errors_total', site=job.site)
+            return
+        self.metrics.inc('http_responses_total', site=job.site, status=response.status_code)
+        self.metrics.inc('http_bytes_total', len(response.content), site=job.site)
+        if cache_status:
+            self.metrics.inc('http_cache_total', site=job.site, status=cache_status)
+
+    def fetch_all(self, jobs):
+        """Fetch all jobs concurrently, yielding results as they complete
+
+        The caller can parse and store each result while the remaining
+        fetches are still in flight.
+        """
+        yield from self.crawl(jobs)
+
+    def crawl(self, jobs, feed=None):
+        """Like fetch_all, but the job list can grow as results come in
+
+        Other threads can add jobs through feed, a queue.Queue, so
+        pagination can depend on what earlier pages held without the caller
+        waiting for it. The crawl then runs until None comes through the
+        feed and the fetches in flight are done.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = {pool.submit(self.fetch, job) for job in self._interleave(jobs)}
+            feeding = feed is not None
+            while pending or feeding:
+                # Only block on the feed when there is nothing else to wait for
+                while feeding:
+                    try:
+                        job = feed.get(block=not pending)
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        feeding = False
+                    else:
+                        pending.add(pool.submit(self.fetch, job))
+                if not pending:
+                    continue
+                done, pending = wait(pending, timeout=FEED_POLL_INTERVAL if feeding else None,
+                                     return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def _interleave(self, jobs):
+        """Order jobs round-robin by host so one host's queue doesn't tie up every worker"""
+        by_host = {}
+        for job in jobs:
+            by_host.setdefault(urlsplit(job.url).netloc, []).append(job)
+        ordered = []
+        queues = list(by_host.values())
+        while queues:
+            ordered.extend(queue.pop(0) for queue in queues)
+            queues = [queue for queue in queues if queue]
+        return ordered
+
+    def close(self):
+        """Close all pooled connections, the cache and the archive"""
+        if self.cache:
+            self.cache.close()
+        if self.archive:
+            self.archive.close()
+        with self._hosts_lock:
+            for state in self._hosts.values():
+                state.session.close()
+            self._hosts.clear()
@@ -0,0 +1,179 @@
+"""Compact price history: one row per price interval
+
+Prices are stored in price_history as integer cents over a range of day
+numbers (days since 1970-01-01):
+
+    car_id  start_day  end_day  price_cents
+    17      19850      19901    1250000      # $12,500 from 2024-05-07
+    17      19901      NULL     1190000      # $11,900 since 2024-06-27, current
+
+A price is written only when it changes, and end_day is the day the next
+price took over, so a price that holds for months is still a single row.
+The old prices table is a view over it.
+
+Intervals of sold and delisted listings can be downsampled in retention
+tiers: past each tier's age, consecutive intervals are merged to
+at most one per bucket of days, keeping the price the bucket ended on.
+
+Prices re-extracted from archived pages are merged in afterwards with
+merge_observation: a price seen on a past day splits the interval it
+falls in, and runs until the car's next recorded price only when it was
+the car's latest sighting.
+"""
+import logging
+from datetime import date, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+logger = logging.getLogger('CarTracker')
+
+EPOCH = date(1970, 1, 1)
+
+# (age in days, bucket in days): intervals that started more than age days
+# ago keep at most one price per bucket. Coarsest tier last.
+RETENTION_TIERS = ((90, 7), (365, 30))
+# Compaction runs at most this often
+COMPACT_EVERY_DAYS = 7
+
+
+def day_number(day):
+    """Days since 1970-01-01 of a date or 'YYYY-MM-DD' string"""
+    if isinstance(day, str):
+        day = date.fromisoformat(day[:10])
+    return (day - EPOCH).days
+
+
+def day_date(number):
+    return EPOCH + timedelta(days=number)
+
+
+def to_cents(price):
+    return int(round((price or 0) * 100))
+
+
+def downsample(intervals, today, tiers=RETENTION_TIERS):
+    """Merge one car's intervals according to the retention tiers
+
+    intervals are (id, start_day, end_day, price_cents) tuples in history
+    order. Returns the intervals to keep, with merged ones stretched over
+    the days of the intervals they absorb. The last (current) interval is
+    never merged.
+    """
+    if len(intervals) < 2:
+        return list(intervals)
+
+    def bucket(start_day):
+        age = today - start_day
+        size = None
+        for min_age, days in tiers:
+            if age > min_age:
+                size = days
+        return (size, start_day // size) if size else None
+
+    kept = []
+    group_key = None
+    for interval in intervals[:-1]:
+        key = bucket(interval[1])
+        if key is not None and key == group_key:
+            # Same bucket: the later interval wins, starting where the group did
+            first = kept[-1]
+            kept[-1] = (interval[0], first[1], interval[2], interval[3])
+        else:
+            kept.append(interval)
+        group_key = key
+    kept.append(intervals[-1])
+    return kept
+
+
+def compact_history(conn, today=None, tiers=RETENTION_TIERS, touched=None):
+    """Downsample the history of delisted listings; returns the rows removed
+
+    Runs in the connection's current transaction. The kept row of a merged
+    group is the newest one, so the highest price_history id, which other
+    parts use as a watermark, never changes. The start days of the rows
+    moved or removed are added to the touched set, if given.
+    """
+    today = day_number(today or date.today())
+    cursor = conn.cursor()
+    rows = cursor.execute('''
+    SELECT ph.car_id, ph.id, ph.start_day, ph.end_day, ph.price_cents
+    FROM cars c
+    JOIN price_history ph ON ph.car_id = c.id
+    WHERE c.active = 0
+    ORDER BY ph.car_id, ph.start_day, ph.id
+    ''')
+
+    removed = []
+    updated = []
+    cars = 0
+    for _, group in groupby(rows, key=itemgetter(0)):
+        intervals = [row[1:] for row in group]
+        kept = downsample(intervals, today, tiers)
+        if len(kept) == len(intervals):
+            continue
+        cars += 1
+        original = {interval[0]: interval for interval in intervals}
+        kept_ids = {interval[0] for interval in kept}
+        moved = [interval for interval in kept if interval != original[interval[0]]]
+        dropped = [interval for interval in intervals if interval[0] not in kept_ids]
+        removed.extend((interval[0],) for interval in dropped)
+        updated.extend((interval[1], interval[0]) for interval in moved)
+        if touched is not None:
+            touched.update(interval[1] for interval in dropped)
+            touched.update(day for interval in moved for day in (interval[1], original[interval[0]][1]))
+
+    cursor.executemany('UPDATE price_history SET start_day = ? WHERE id = ?', updated)
+    cursor.executemany('DELETE FROM price_history WHERE id = ?', removed)
+    logger.info(f"Price history retention: merged away {len(removed)} intervals of {cars} delisted listings")
+    return len(removed)
+
+
+def merge_observation(intervals, day, cents, latest=False):
+    """One car's intervals with a price seen on a past day merged in
+
+    intervals are (id, start_day, end_day, price_cents) tuples in history
+    order; new intervals get None for an id. A price that differs from the
+    one recorded for that day holds for just that day, or from then on if
+    latest is set (nothing was seen of the car since). Neighbouring
+    intervals left at the same price are joined, keeping the newer id.
+    """
+    if not intervals:
+        return [(None, day, None, cents)]
+
+    for i, (interval_id, start, end, price) in enumerate(intervals):
+        if start <= day and (end is None or day < end):
+            break
+    else:
+        # Seen before the car's first recorded price (or in a gap), which
+        # it held until the next one
+        later = [interval for interval in intervals if interval[1] > day]
+        pieces = ([interval for interval in intervals if interval[1] <= day]
+                  + [(None, day, later[0][1] if later else None, cents)] + later)
+        return _join(pieces)
+
+    if price == cents:
+        return list(intervals)
+    pieces = list(intervals[:i])
+    if start < day:
+        pieces.append((interval_id, start, day, price))
+        interval_id = None
+    if latest and end is None:
+        pieces.append((None, day, None, cents))
+    else:
+        pieces.append((None, day, day + 1, cents))
+        if end is None or end > day + 1:
+            pieces.append((interval_id, day + 1, end, price))
+    return _join(pieces + list(intervals[i + 1:]))
+
+
+def _join(pieces):
+    """Join neighbouring intervals at the same price"""
+    merged = [pieces[0]]
+    for piece in pieces[1:]:
+        last = merged[-1]
+        if piece[3] == last[3] and last[2] == piece[1]:
+            ids = [i for i in (last[0], piece[0]) if i is not None]
+            merged[-1] = (max(ids) if ids else None, last[1], piece[2], piece[3])
+        else:
+            merged.append(piece)
+    return merged
@@ -0,0 +1,292 @@
+"""Run metrics: counters, latency histograms and profiling hooks
+
+A MetricsRegistry collects what scraping runs did and where their time
+went: HTTP latency and bytes per site, parse time per page, listings
+parsed and failed, database transaction time and the duration of every
+step of the daily job. Values are cumulative for the life of the process,
+like Prometheus counters; summary(since) gives the change since a
+snapshot, which is how a single run is reported.
+"""
+import copy
+import cProfile
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('CarTracker')
+
+PREFIX = 'car_tracker_'
+
+# Seconds; covers quick cache hits up to slow pages hitting the timeout
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> (type, help); every metric the tracker records is declared here
+METRICS = {
+    'http_request_seconds': ('histogram', 'HTTP request latency per site'),
+    'http_responses_total': ('counter', 'HTTP responses per site and status code'),
+    'http_errors_total': ('counter', 'HTTP requests that failed without a response'),
+    'http_bytes_total': ('counter', 'Response body bytes downloaded per site'),
+    'http_cache_total': ('counter', 'Cached pages per site and outcome (not_modified, unchanged, miss)'),
+    'pages_archived_total': ('counter', 'Pages archived per site, by whether the body was new or a duplicate'),
+    'parse_page_seconds': ('histogram', 'Time to extract the listings of one page'),
+    'pages_failed_total': ('counter', 'Pages dropped per site and pipeline stage'),
+    'listings_parsed_total': ('counter', 'Listings extracted per site'),
+    'listings_failed_total': ('counter', 'Listing cards that could not be extracted per site'),
+    'listings_new_total': ('counter', 'New listings stored per site'),
+    'price_updates_total': ('counter', 'Price changes stored per site'),
+    'listings_delisted_total': ('counter', 'Listings marked sold or delisted per site'),
+    'alerts_queued_total': ('counter', 'Saved-search alerts raised by stored changes'),
+    'alert_digests_total': ('counter', 'Alert digest emails sent'),
+    'db_transaction_seconds': ('histogram', 'Database write transaction time per operation'),
+    'job_step_seconds': ('gauge', 'Duration of each step of the last daily job'),
+    'run_duration_seconds': ('gauge', 'Duration of the last daily job'),
+    'run_timestamp_seconds': ('gauge', 'Unix time the last daily job finished'),
+    'runs_total': ('counter', 'Daily jobs run, by outcome'),
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _label_text(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Thread-safe counters, gauges and histograms keyed by name and labels"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # (name, label key) -> value or Histogram
+        self.values = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, _label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the block took, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return copy.deepcopy(self.values)
+
+    def summary(self, since=None):
+        """Values as nested dicts, minus those in the since snapshot
+
+        Counters and histograms are reported as the change since the
+        snapshot; gauges as their current value. Histograms become
+        count/sum/avg.
+        """
+        since = since or {}
+        result = {}
+        for (name, key), value in sorted(self.snapshot().items(), key=lambda item: item[0]):
+            kind = METRICS.get(name, ('gauge', ''))[0]
+            before = since.get((name, key))
+            if kind == 'histogram':
+                count = value.count - (before.count if before else 0)
+                total = value.sum - (before.sum if before else 0.0)
+                if not count:
+                    continue
+                value = {'count': count, 'sum': round(total, 6), 'avg': round(total / count, 6)}
+            elif kind == 'counter':
+                value -= before or 0
+                if not value:
+                    continue
+            label = ','.join(f'{label}={label_value}' for label, label_value in key) or 'total'
+            result.setdefault(name, {})[label] = value
+        return result
+
+    def render(self):
+        """Prometheus text exposition format"""
+        by_name = {}
+        for (name, key), value in self.snapshot().items():
+            by_name.setdefault(name, []).append((key, value))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text = METRICS.get(name, ('gauge', ''))
+            metric = PREFIX + name
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for key, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{metric}{_label_text(key)} {value}')
+                    continue
+                for bound, count in zip(value.buckets, value.counts):
+                    lines.append(f'{metric}_bucket{_label_text(key, [("le", str(bound))])} {count}')
+                lines.append(f'{metric}_bucket{_label_text(key, [("le", "+Inf")])} {value.count}')
+                lines.append(f'{metric}_sum{_label_text(key)} {value.sum}')
+                lines.append(f'{metric}_count{_label_text(key)} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics file atomically, e.g. for node_exporter's textfile collector"""
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port, host=''):
+        """Serve /metrics over HTTP from a daemon thread; returns the server"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics on port {server.server_address[1]}")
+        return server
+
+
+def append_run_summary(path, summary):
+    """Append one run's summary as a line of JSON"""
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(summary, default=str) + '\n')
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread in the process at a fixed interval
+
+    Unlike cProfile, which only sees the thread that started it, this also
+    catches time spent in the pipeline's fetch, parse and store threads.
+    Parse worker processes are not sampled. Stacks are written in the
+    collapsed format flame graph tools read ('outer;inner count').
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def top(self, limit=15):
+        """Functions by share of samples spent in them (self time)"""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [(frame, count / total) for frame, count in leaves.most_common(limit)]
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+@contextmanager
+def profiled(path, mode='sample'):
+    """Profile the block into path
+
+    mode 'sample' uses SamplingProfiler across all threads; 'cprofile'
+    runs cProfile on the calling thread and writes pstats data, for
+    snakeviz or python -m pstats.
+    """
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+            out = pstats.Stats(profiler).sort_stats('cumulative')
+            top = [f"{func[2]} ({os.path.basename(func[0])}) {stat[3]:.2f}s"
+                   for func, stat in sorted(out.stats.items(), key=lambda item: -item[1][3])[:10]]
+            logger.info(f"Profile written to {path}; top cumulative: {', '.join(top)}")
+        return
+
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        profiler.write(path)
+        top = ', '.join(f"{frame} {share:.0%}" for frame, share in profiler.top(10))
+        logger.info(f"Profile written to {path} ({profiler.samples} samples); top: {top}")
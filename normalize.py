@@ -0,0 +1,237 @@
+"""Canonical makes, models and locations, and their integer ids
+
+Listing titles are free text: "Chevrolet Aveo", "CHEVROLET aveo family"
+and "Chevrolet-Aveo" are the same car, and OLX writes "Quito, Quito"
+where PatioTuerca writes "Quito". The Normalizer maps them onto a
+canonical dictionary, trying in order:
+
+    exact     folded tokens (no case, accents or punctuation) or an alias
+    joined    tokens run together, so "CX5", "CX 5" and "CX-5" all match
+    fuzzy     difflib against the known names, for typos like "Toyta"
+
+Titles and locations repeat across pages and days, so results are kept in
+an LRU memo and a repeated title costs a dict lookup. Unknown makes and
+models are kept, cleaned up and title-cased, rather than dropped.
+
+Dimensions gives each canonical make, model and location a small integer
+id (tables makes, models and locations), which cars reference, so the
+aggregate queries group on integers instead of text.
+"""
+import difflib
+import logging
+import re
+import unicodedata
+from functools import lru_cache
+
+logger = logging.getLogger('CarTracker')
+
+# Entries kept in each memo; distinct titles seen in a year fit easily
+CACHE_SIZE = 65536
+# difflib ratio a name must reach to count as a typo of a known one
+FUZZY_CUTOFF = 0.85
+
+# Makes sold in Ecuador and their common models
+CANONICAL_MODELS = {
+    'Audi': ['A3', 'A4', 'Q3', 'Q5', 'Q7'],
+    'BMW': ['Serie 1', 'Serie 3', 'Serie 5', 'X1', 'X3', 'X5'],
+    'BYD': ['F0', 'F3', 'Song', 'Tang', 'Yuan'],
+    'Changan': ['Alsvin', 'CS15', 'CS35', 'CS55'],
+    'Chery': ['Arrizo', 'QQ', 'Tiggo', 'Tiggo 2', 'Tiggo 4', 'Tiggo 7', 'Tiggo 8'],
+    'Chevrolet': ['Aveo', 'Aveo Emotion', 'Aveo Family', 'Beat', 'Blazer', 'Captiva', 'Colorado', 'Corsa',
+                  'Cruze', 'D-Max', 'Equinox', 'Grand Vitara', 'Groove', 'Joy', 'Luv', 'Luv D-Max', 'N300',
+                  'Onix', 'Optra', 'Sail', 'Silverado', 'Spark', 'Spark GT', 'Tahoe', 'Tracker', 'Trailblazer',
+                  'Vitara'],
+    'Citroen': ['Berlingo', 'C-Elysee', 'C3', 'C4'],
+    'DFSK': ['C31', 'Glory 580', 'K01'],
+    'Dodge': ['Durango', 'Journey', 'Ram'],
+    'Fiat': ['Argo', 'Fiorino', 'Mobi', 'Palio', 'Strada', 'Uno'],
+    'Ford': ['Ecosport', 'Edge', 'Escape', 'Expedition', 'Explorer', 'F-150', 'Fiesta', 'Focus', 'Mustang',
+             'Ranger', 'Territory'],
+    'Geely': ['Azkarra', 'Coolray', 'Emgrand'],
+    'Great Wall': ['Haval H6', 'M4', 'Poer', 'Voleex', 'Wingle'],
+    'Honda': ['Accord', 'City', 'Civic', 'CR-V', 'Fit', 'HR-V', 'Pilot', 'WR-V'],
+    'Hyundai': ['Accent', 'Creta', 'Elantra', 'Getz', 'Grand i10', 'H1', 'i10', 'Kona', 'Santa Fe', 'Sonata',
+                'Tucson', 'Venue'],
+    'Isuzu': ['D-Max', 'Rodeo', 'Trooper'],
+    'JAC': ['JS2', 'JS4', 'S2', 'S3', 'T6', 'T8'],
+    'Jeep': ['Cherokee', 'Compass', 'Grand Cherokee', 'Renegade', 'Wrangler'],
+    'Kia': ['Carnival', 'Cerato', 'K2700', 'Picanto', 'Rio', 'Seltos', 'Sonet', 'Sorento', 'Soluto', 'Soul',
+            'Sportage', 'Stonic'],
+    'Mazda': ['2', '3', '6', 'BT-50', 'CX-3', 'CX-30', 'CX-5', 'CX-9'],
+    'Mercedes-Benz': ['Clase A', 'Clase C', 'Clase E', 'GLA', 'GLC', 'Sprinter'],
+    'Mitsubishi': ['ASX', 'L200', 'Lancer', 'Mirage', 'Montero', 'Montero Sport', 'Outlander', 'Xpander'],
+    'Nissan': ['Almera', 'Frontier', 'Kicks', 'March', 'Navara', 'NP300', 'Pathfinder', 'Patrol', 'Qashqai',
+               'Sentra', 'Tiida', 'Versa', 'X-Trail'],
+    'Peugeot': ['206', '207', '208', '2008', '301', '3008', '5008', 'Partner'],
+    'Renault': ['Captur', 'Clio', 'Duster', 'Koleos', 'Kwid', 'Logan', 'Oroch', 'Sandero', 'Stepway'],
+    'Skoda': ['Fabia', 'Octavia', 'Superb'],
+    'Subaru': ['Forester', 'Impreza', 'Outback', 'XV'],
+    'Suzuki': ['Baleno', 'Celerio', 'Dzire', 'Ertiga', 'Forsa', 'Grand Vitara', 'Jimny', 'S-Presso', 'Swift',
+               'SX4', 'Vitara'],
+    'Toyota': ['4Runner', 'C-HR', 'Camry', 'Corolla', 'Etios', 'Fortuner', 'Hilux', 'Land Cruiser', 'Prado',
+               'Prius', 'Raize', 'RAV4', 'Rush', 'Yaris'],
+    'Volkswagen': ['Amarok', 'Escarabajo', 'Gol', 'Golf', 'Jetta', 'Passat', 'Polo', 'Saveiro', 'T-Cross',
+                   'Tiguan', 'Virtus'],
+}
+
+# Other ways sellers write a make
+MAKE_ALIASES = {
+    'chevy': 'Chevrolet',
+    'vw': 'Volkswagen',
+    'mercedes': 'Mercedes-Benz',
+    'benz': 'Mercedes-Benz',
+    'gwm': 'Great Wall',
+}
+
+# Cities listings are located in; "Cumbayá, Quito" is Cumbayá
+LOCATIONS = [
+    'Ambato', 'Azogues', 'Babahoyo', 'Cuenca', 'Cumbayá', 'Daule', 'Durán', 'El Coca', 'Esmeraldas', 'Guaranda',
+    'Guayaquil', 'Ibarra', 'La Libertad', 'Lago Agrio', 'Latacunga', 'Loja', 'Macas', 'Machala', 'Manta',
+    'Milagro', 'Otavalo', 'Portoviejo', 'Puyo', 'Quevedo', 'Quito', 'Riobamba', 'Salinas', 'Samborondón',
+    'Sangolquí', 'Santo Domingo', 'Tena', 'Tulcán', 'Tumbaco', 'Zamora',
+]
+
+
+def fold(text):
+    """Lowercase words without accents or punctuation: 'Cumbayá, QUITO' -> 'cumbaya quito'"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r'[\W_]+', ' ', text.casefold()).strip()
+
+
+def _clean(tokens):
+    """An unknown name, title-cased from its folded tokens"""
+    return ' '.join(token.upper() if any(c.isdigit() for c in token) else token.capitalize() for token in tokens)
+
+
+class Normalizer:
+    """Maps listing titles and locations onto canonical names, memoized"""
+
+    def __init__(self, models=CANONICAL_MODELS, aliases=MAKE_ALIASES, locations=LOCATIONS,
+                 cache_size=CACHE_SIZE, cutoff=FUZZY_CUTOFF):
+        self.cutoff = cutoff
+        self.makes = {fold(make): make for make in models}
+        self.makes.update((fold(alias), make) for alias, make in aliases.items())
+        # Makes of more than one word are matched before single words
+        self.make_words = max(len(key.split()) for key in self.makes)
+        # make -> joined model tokens -> model, e.g. 'cx5' -> 'CX-5'
+        self.models = {make: {fold(model).replace(' ', ''): model for model in names}
+                       for make, names in models.items()}
+        self.model_words = {make: max((len(fold(model).split()) for model in names), default=0)
+                            for make, names in models.items()}
+        self.locations = {fold(location): location for location in locations}
+        self.location_words = max(len(key.split()) for key in self.locations)
+
+        self.title = lru_cache(cache_size)(self._title)
+        self.location = lru_cache(cache_size)(self._location)
+
+    def _fuzzy(self, key, names):
+        match = difflib.get_close_matches(key, names, n=1, cutoff=self.cutoff)
+        return names[match[0]] if match else None
+
+    def _title(self, title):
+        """(make, model) of a listing title"""
+        tokens = fold(title).split()
+        if not tokens:
+            return '', ''
+
+        make = None
+        for words in range(min(self.make_words, len(tokens)), 0, -1):
+            key = ' '.join(tokens[:words])
+            make = self.makes.get(key) or self.makes.get(key.replace(' ', ''))
+            if make:
+                break
+        if make is None:
+            words = 1
+            make = self._fuzzy(tokens[0], self.makes)
+        rest = tokens[words:]
+        if make is None:
+            return _clean(tokens[:1]), _clean(rest[:1])
+        if not rest:
+            return make, ''
+
+        models = self.models.get(make, {})
+        for words in range(min(self.model_words.get(make, 0), len(rest)), 0, -1):
+            model = models.get(''.join(rest[:words]))
+            if model:
+                return make, model
+        # Unknown models are grouped by their first word, leaving out trims
+        return make, self._fuzzy(rest[0], models) or _clean(rest[:1])
+
+    def _location(self, location):
+        """Canonical city of a location, e.g. 'Quito, Quito' -> 'Quito'"""
+        parts = [fold(part) for part in (location or '').split(',')]
+        parts = [part for part in parts if part]
+        if not parts:
+            return ''
+        # The most specific part, usually the first, that names a known city
+        for part in parts:
+            tokens = part.split()
+            for words in range(min(self.location_words, len(tokens)), 0, -1):
+                for start in range(len(tokens) - words + 1):
+                    city = self.locations.get(' '.join(tokens[start:start + words]))
+                    if city:
+                        return city
+        return self._fuzzy(parts[0], self.locations) or _clean(parts[0].split())
+
+    def canonical(self, make, model=None):
+        """Canonical (make, model) of a make and optional model given separately"""
+        canonical_make, canonical_model = self.title(f"{make or ''} {model or ''}")
+        return canonical_make, canonical_model if model else model
+
+    def cache_info(self):
+        return {'title': self.title.cache_info(), 'location': self.location.cache_info()}
+
+
+class Dimensions:
+    """Integer ids of the canonical makes, models and locations
+
+    Ids are cached in memory once read or assigned. Every batch re-asserts
+    the rows of the ids it uses, so an id assigned in a transaction that
+    was rolled back is written again rather than left dangling.
+    """
+
+    def __init__(self):
+        self.makes = {}
+        self.models = {}
+        self.locations = {}
+
+    def load(self, conn):
+        self.makes = dict(conn.execute('SELECT name, id FROM makes'))
+        self.models = {(make_id, name): model_id for model_id, make_id, name in
+                       conn.execute('SELECT id, make_id, name FROM models')}
+        self.locations = dict(conn.execute('SELECT name, id FROM locations'))
+
+    def ids(self, cursor, names):
+        """(make_id, model_id, location_id) for (make, model, location) names, in the cursor's transaction
+
+        Empty names get None.
+        """
+        makes = {make for make, _, _ in names if make}
+        self._assign(cursor, 'makes', self.makes, makes,
+                     'INSERT OR IGNORE INTO makes (name) VALUES (?)', 'SELECT id FROM makes WHERE name = ?')
+        models = {(self.makes[make], model) for make, model, _ in names if make and model}
+        self._assign(cursor, 'models', self.models, models,
+                     'INSERT OR IGNORE INTO models (make_id, name) VALUES (?, ?)',
+                     'SELECT id FROM models WHERE make_id = ? AND name = ?')
+        locations = {location for _, _, location in names if location}
+        self._assign(cursor, 'locations', self.locations, locations,
+                     'INSERT OR IGNORE INTO locations (name) VALUES (?)', 'SELECT id FROM locations WHERE name = ?')
+
+        return [(self.makes.get(make) if make else None,
+                 self.models.get((self.makes.get(make), model)) if make and model else None,
+                 self.locations.get(location) if location else None)
+                for make, model, location in names]
+
+    def _assign(self, cursor, table, ids, keys, insert, select):
+        known = [(ids[key],) + (key if isinstance(key, tuple) else (key,)) for key in keys if key in ids]
+        if known:
+            columns = '(id, make_id, name)' if table == 'models' else '(id, name)'
+            placeholders = ', '.join('?' * len(known[0]))
+            cursor.executemany(f'INSERT OR IGNORE INTO {table} {columns} VALUES ({placeholders})', known)
+        for key in keys:
+            if key in ids:
+                continue
+            params = key if isinstance(key, tuple) else (key,)
+            cursor.execute(insert, params)
+            ids[key] = cursor.execute(select, params).fetchone()[0]
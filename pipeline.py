@@ -0,0 +1,485 @@
+"""Staged scraping pipeline: fetch -> parse -> normalize -> store
+
+Each stage runs on its own and hands work to the next through a bounded
+queue, so network waits, parsing and database writes overlap instead of
+taking turns. A full queue blocks the stage feeding it (backpressure), which
+keeps memory flat when one stage falls behind.
+
+    fetch      FetchEngine threads, per-host rate limits
+    parse      process pool, since extraction is CPU-bound (threads for small runs)
+    normalize  one thread: validates listings, decides when to stop paging
+    store      one writer thread, batching many pages per transaction
+
+A site is complete once paging reaches the end of its results: a page with
+no listings, or one that only repeats listings already seen this run (some
+sites serve their last page again past the end). Only complete sites are
+used to tell which listings have disappeared.
+
+With a run_id, every page stored is checkpointed in the same transaction
+(see checkpoints.py), and pages an earlier attempt of the run finished are
+skipped.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from checkpoints import PAGE_STORED, PAGE_UNCHANGED, STOP_END, STOP_KNOWN, STOP_UNCHANGED, record_pages
+from fetcher import CACHE_NOT_MODIFIED, CACHE_UNCHANGED, FetchJob
+from scheduler import CRAWL_FAILED, record_crawls
+from sites import ExtractionEngine
+
+logger = logging.getLogger('CarTracker')
+
+_DONE = object()
+
+# Fewest pages a run can fetch for its parsing to go to a process pool;
+# below that, spawning the workers costs more than parsing in threads
+PARSE_POOL_MIN_PAGES = 50
+
+# Extraction engines of a parse worker process, built once per process
+_engines = {}
+
+
+def _init_parse_worker(adapters):
+    for name, adapter in adapters.items():
+        _engines[name] = ExtractionEngine(adapter)
+
+
+def parse_page(site, html):
+    """Extract the listings on one page and count failed cards (runs in a parse worker)"""
+    return _engines[site].extract_page(html)
+
+
+class StageStats:
+    """Throughput and latency counters for one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.max_latency = 0.0
+        # Time spent waiting for room in the next stage's queue
+        self.blocked = 0.0
+
+    def record(self, elapsed, failed=False):
+        with self.lock:
+            self.processed += 1
+            self.failed += failed
+            self.busy += elapsed
+            self.max_latency = max(self.max_latency, elapsed)
+
+    def put(self, q, item):
+        """Put an item on the next stage's queue, counting time blocked"""
+        start = time.perf_counter()
+        q.put(item)
+        blocked = time.perf_counter() - start
+        with self.lock:
+            self.blocked += blocked
+
+    def summary(self, wall):
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'per_sec': self.processed / wall if wall else 0.0,
+            'avg_latency': self.busy / self.processed if self.processed else 0.0,
+            'max_latency': self.max_latency,
+            'blocked': self.blocked,
+        }
+
+
+class Pipeline:
+    """One scraping run through the fetch, parse, normalize and store stages"""
+
+    def __init__(self, tracker, parse_workers=None, queue_size=16, batch_size=500, batch_interval=0.5):
+        self.tracker = tracker
+        # 0 parses in-process on the parse threads, without a process pool
+        self.parse_workers = min(4, os.cpu_count() or 1) if parse_workers is None else parse_workers
+        self.queue_size = queue_size
+        # The writer commits once it has batch_size listings, or when no
+        # page has arrived for batch_interval seconds
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.stats = {name: StageStats(name) for name in ('fetch', 'parse', 'normalize', 'store')}
+        self.metrics = tracker.metrics
+
+    def run(self, max_pages, stop_fraction=None, sweep=False, run_id=None, lifecycle=True):
+        """Scrape the sites in max_pages; see CarPriceTracker.scrape_sites"""
+        self.max_pages = max_pages
+        self.stop_fraction = stop_fraction
+        self.sweep = sweep
+        self.lifecycle = lifecycle
+        # Follow pages one at a time rather than queueing max_pages up front
+        self.paging = stop_fraction is not None or sweep
+        self.known = self.tracker.load_known_listings() if stop_fraction is not None else None
+        self.run_id = run_id
+        self.resume = self.tracker.resume_state(run_id, max_pages)
+        self.stopped = set(self.resume.stopped)
+        # Hashes of the URLs each site listed this run
+        self.seen = self.resume.seen
+        self.ended = set(self.resume.ended)
+        # Sites with pages that were skipped or lost, so some listings weren't seen
+        self.incomplete = set(self.resume.incomplete)
+        # Checkpoints of pages with nothing to store, and pages lost to an
+        # error (logged in page_crawls only), written with the next batch
+        self.marks = []
+        self.failures = []
+        self.marks_lock = threading.Lock()
+        self.next_page = {}
+        # In paging mode, pages fetched whose stop decision is still to come;
+        # each decision queues the site's next page on the fetch feed, and
+        # the feed closes once none are left
+        self.undecided = set()
+        self.paging_lock = threading.Lock()
+        self.feed = queue.Queue() if self.paging else None
+        self.totals = {site: (0, 0) for site in max_pages}
+
+        parse_queue = queue.Queue(self.queue_size)
+        normalize_queue = queue.Queue(self.queue_size)
+        store_queue = queue.Queue(self.queue_size)
+        parse_threads = max(1, self.parse_workers)
+
+        pool = None
+        self.pool_broken = False
+        pages = sum(float('inf') if cap is None else len(cap) if isinstance(cap, list) else cap
+                    for cap in max_pages.values())
+        if self.parse_workers and pages >= PARSE_POOL_MIN_PAGES:
+            # Spawned rather than forked: the fetch threads are already running
+            pool = ProcessPoolExecutor(self.parse_workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_parse_worker, initargs=(self.tracker.sites,))
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._fetch_stage, args=(parse_queue, parse_threads))]
+        threads += [threading.Thread(target=self._parse_stage, args=(parse_queue, normalize_queue, pool))
+                    for _ in range(parse_threads)]
+        threads.append(threading.Thread(target=self._normalize_stage,
+                                        args=(normalize_queue, store_queue, parse_threads)))
+        threads.append(threading.Thread(target=self._store_stage, args=(store_queue,)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if pool:
+            pool.shutdown()
+        self.wall = time.perf_counter() - start
+
+        for name, summary in self.summary().items():
+            logger.info(f"Pipeline {name}: {summary['processed']} done, {summary['failed']} failed, "
+                        f"{summary['per_sec']:.1f}/s, avg {summary['avg_latency'] * 1000:.0f}ms, "
+                        f"max {summary['max_latency'] * 1000:.0f}ms, blocked {summary['blocked']:.2f}s")
+        return self.totals
+
+    def summary(self):
+        """Per-stage counters of the last run"""
+        return {name: stats.summary(self.wall) for name, stats in self.stats.items()}
+
+    def complete_sites(self):
+        """Sites whose every listing was seen by the last run"""
+        return self.ended - self.incomplete
+
+    def _job(self, site, page):
+        if self.paging:
+            self.undecided.add((site, page))
+        return FetchJob(site, page, self.tracker.site_urls[site].format(page=page))
+
+    def _initial_jobs(self):
+        if not self.paging:
+            return [self._job(site, page)
+                    for site, pages in self.max_pages.items()
+                    for page in self.resume.pages(site, pages)]
+
+        # Keep as many pages in flight per site as its host allows, after
+        # any left undone by an earlier attempt
+        jobs = []
+        for site, cap in self.max_pages.items():
+            if site in self.stopped:
+                continue
+            start = self.resume.next_page(site)
+            window = self.tracker.sites[site].host_policy.max_concurrency
+            last = start + window - 1 if cap is None else min(start + window - 1, cap)
+            jobs.extend(self._job(site, page) for page in self.resume.pages(site, start - 1))
+            jobs.extend(self._job(site, page) for page in range(start, last + 1))
+            self.next_page[site] = last + 1
+        if not self.undecided:
+            self.feed.put(None)
+        return jobs
+
+    def _stop(self, site, reason):
+        if self.paging and site not in self.stopped:
+            self.stopped.add(site)
+            logger.info(f"Stopped paging {site}: {reason}")
+
+    def _lost(self, site, page, reason):
+        """A page whose listings won't be seen: stop the site and leave it incomplete"""
+        self.incomplete.add(site)
+        self._stop(site, reason)
+        self._decide(site, page)
+
+    def _decide(self, site, page):
+        """Queue the site's next page once a page's stop decision is made
+
+        Paging doesn't run ahead of the decisions, or a site that should
+        have stopped keeps getting fetched while its pages wait to be parsed.
+        """
+        if not self.paging:
+            return
+        with self.paging_lock:
+            if (site, page) not in self.undecided:
+                return
+            self.undecided.remove((site, page))
+            cap = self.max_pages[site]
+            if site not in self.stopped and (cap is None or self.next_page[site] <= cap):
+                self.feed.put(self._job(site, self.next_page[site]))
+                self.next_page[site] += 1
+            if not self.undecided:
+                self.feed.put(None)
+
+    def _fetch_stage(self, parse_queue, consumers):
+        stats = self.stats['fetch']
+        try:
+            for result in self.tracker.fetcher.crawl(self._initial_jobs(), self.feed):
+                if result.error is not None:
+                    logger.error(f"Error fetching page {result.page} from {result.site}: {result.error}")
+                    stats.record(result.elapsed, failed=True)
+                    self.metrics.inc('pages_failed_total', site=result.site, stage='fetch')
+                    self._failed(result.site, result.page)
+                    self._lost(result.site, result.page, f"page {result.page} failed")
+                    continue
+
+                if result.cache_status in (CACHE_NOT_MODIFIED, CACHE_UNCHANGED):
+                    logger.info(f"Page {result.page} from {result.site} unchanged since last run")
+                    text = (result.text or self.tracker.cache.get(result.url)) if self.sweep else None
+                    if text is None:
+                        stats.record(result.elapsed)
+                        self._mark(result.site, result.page, STOP_UNCHANGED if self.paging else None)
+                        self._lost(result.site, result.page, f"page {result.page} unchanged since last run")
+                        continue
+                    # A sweep still needs to see the listings on unchanged pages
+                    result = result._replace(status_code=200, text=text)
+
+                if result.status_code != 200:
+                    logger.error(f"Failed to get page {result.page} from {result.site}. Status code: {result.status_code}")
+                    stats.record(result.elapsed, failed=True)
+                    self.metrics.inc('pages_failed_total', site=result.site, stage='fetch')
+                    self._failed(result.site, result.page)
+                    self._lost(result.site, result.page, f"page {result.page} returned {result.status_code}")
+                    continue
+
+                stats.record(result.elapsed)
+                stats.put(parse_queue, result)
+        except Exception as e:
+            logger.error(f"Error in fetch stage: {e}")
+        finally:
+            for _ in range(consumers):
+                parse_queue.put(_DONE)
+
+    def _parse_stage(self, parse_queue, normalize_queue, pool):
+        stats = self.stats['parse']
+        while True:
+            result = parse_queue.get()
+            if result is _DONE:
+                normalize_queue.put(_DONE)
+                return
+
+            start = time.perf_counter()
+            try:
+                parsed = None
+                if pool and not self.pool_broken:
+                    try:
+                        parsed = pool.submit(parse_page, result.site, result.text).result()
+                    except BrokenProcessPool as e:
+                        if not self.pool_broken:
+                            logger.error(f"Parse worker pool failed, parsing in-process instead: {e}")
+                        self.pool_broken = True
+                if parsed is None:
+                    parsed = self.tracker.extractors[result.site].extract_page(result.text)
+                listings, failed = parsed
+            except Exception as e:
+                logger.error(f"Error parsing page {result.page} from {result.site}: {e}")
+                stats.record(time.perf_counter() - start, failed=True)
+                self.metrics.inc('pages_failed_total', site=result.site, stage='parse')
+                self._failed(result.site, result.page)
+                self._lost(result.site, result.page, f"page {result.page} could not be parsed")
+                continue
+            elapsed = time.perf_counter() - start
+            stats.record(elapsed)
+            self.metrics.observe('parse_page_seconds', elapsed, site=result.site)
+            self.metrics.inc('listings_parsed_total', len(listings), site=result.site)
+            if failed:
+                self.metrics.inc('listings_failed_total', failed, site=result.site)
+            stats.put(normalize_queue, (result.site, result.page, listings))
+
+    def _normalize_stage(self, normalize_queue, store_queue, producers):
+        stats = self.stats['normalize']
+        remaining = producers
+        while remaining:
+            item = normalize_queue.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+
+            site, page, listings = item
+            start = time.perf_counter()
+            try:
+                # A listing without a URL can't be told apart from others
+                listings = [listing for listing in listings if listing.url]
+
+                stop = None
+                if self._end_of_results(site, listings):
+                    self.ended.add(site)
+                    self._stop(site, f"page {page} is past the last page")
+                    stop = STOP_END
+                if self.known is not None:
+                    fraction = self.known.unchanged_fraction(listings)
+                    if listings and fraction >= self.stop_fraction:
+                        self._stop(site, f"{fraction:.0%} of page {page} already known")
+                        stop = stop or STOP_KNOWN
+                    self.known.update(listings)
+            except Exception as e:
+                logger.error(f"Error normalizing page {page} from {site}: {e}")
+                stats.record(time.perf_counter() - start, failed=True)
+                self.metrics.inc('pages_failed_total', site=site, stage='normalize')
+                self._failed(site, page)
+                self.incomplete.add(site)
+                continue
+            finally:
+                self._decide(site, page)
+            stats.record(time.perf_counter() - start)
+            stats.put(store_queue, (site, page, listings, stop))
+        store_queue.put(_DONE)
+
+    def _end_of_results(self, site, listings):
+        """Whether a page is past the site's last page; records its listings as seen"""
+        urls = {hash(listing.url) for listing in listings}
+        seen = self.seen[site]
+        ended = urls <= seen
+        seen |= urls
+        return ended
+
+    def _store_stage(self, store_queue):
+        conn = sqlite3.connect(self.tracker.db_path)
+        pages = []
+        size = 0
+        done = False
+        try:
+            while not done:
+                try:
+                    item = store_queue.get(timeout=self.batch_interval)
+                except queue.Empty:
+                    item = None
+                if item is _DONE:
+                    done = True
+                elif item is not None:
+                    pages.append(item)
+                    size += len(item[2])
+
+                if pages and (done or item is None or size >= self.batch_size):
+                    self._flush(conn, pages)
+                    pages = []
+                    size = 0
+            if self.marks or self.failures:
+                marks = self._checkpoint(conn, [], [])
+                conn.commit()
+                self._committed(marks)
+        finally:
+            conn.close()
+
+    def _flush(self, conn, pages):
+        """Write the pending pages in one transaction, falling back to one per page"""
+        stats = self.stats['store']
+        start = time.perf_counter()
+        try:
+            batch = [listing for _, _, listings, _ in pages for listing in listings]
+            results = self.tracker.write_listings(conn, batch)
+            self.tracker.record_seen(conn, batch, self.lifecycle)
+            marks = self._checkpoint(conn, pages, results)
+            conn.commit()
+            self._committed(marks)
+            self._count(batch, results)
+            elapsed = time.perf_counter() - start
+            stats.record(elapsed)
+            self.metrics.observe('db_transaction_seconds', elapsed, operation='store')
+            return
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Database error writing {len(pages)} pages, retrying page by page: {e}")
+
+        # Isolate the page that broke the batch
+        for site, page, listings, stop in pages:
+            start = time.perf_counter()
+            try:
+                results = self.tracker.write_listings(conn, listings)
+                self.tracker.record_seen(conn, listings, self.lifecycle)
+                marks = self._checkpoint(conn, [(site, page, listings, stop)], results)
+                conn.commit()
+                self._committed(marks)
+                self._count(listings, results)
+                elapsed = time.perf_counter() - start
+                stats.record(elapsed)
+                self.metrics.observe('db_transaction_seconds', elapsed, operation='store')
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Database error storing page {page} from {site}: {e}")
+                self._failed(site, page)
+                self.incomplete.add(site)
+                stats.record(time.perf_counter() - start, failed=True)
+                self.metrics.inc('pages_failed_total', site=site, stage='store')
+
+    def _mark(self, site, page, stop):
+        """Checkpoint a page that had nothing to store"""
+        with self.marks_lock:
+            self.marks.append((site, page, PAGE_UNCHANGED, stop, 0, 0))
+
+    def _failed(self, site, page):
+        """Log a fetch that didn't store its page, so it still counts against the crawl budget"""
+        with self.marks_lock:
+            self.failures.append((site, page, CRAWL_FAILED, None, 0, 0))
+
+    def _checkpoint(self, conn, pages, results):
+        """Record the pages as crawled, and done if in a run, in the transaction that stored them
+
+        The pending marks and failures are recorded too, but stay pending
+        until the transaction commits (see _committed), so a rollback doesn't
+        lose them. Returns how many of each were recorded.
+        """
+        rows = []
+        crawls = []
+        i = 0
+        for site, page, listings, stop in pages:
+            page_results = results[i:i + len(listings)]
+            i += len(listings)
+            new_listings, updated_prices = page_results.count('new'), page_results.count('updated')
+            rows.append((site, page, PAGE_STORED, stop, new_listings, updated_prices))
+            crawls.append((site, page, PAGE_STORED, len(listings), new_listings, updated_prices))
+        with self.marks_lock:
+            marks = list(self.marks)
+            failures = list(self.failures)
+        record_crawls(conn, crawls + [(site, page, status, None, 0, 0) for site, page, status, _, _, _ in marks]
+                      + failures)
+        if self.run_id is not None:
+            record_pages(conn, self.run_id, rows + marks)
+        return len(marks), len(failures)
+
+    def _committed(self, recorded):
+        """Drop the marks and failures recorded by a checkpoint that committed"""
+        marks, failures = recorded
+        with self.marks_lock:
+            del self.marks[:marks]
+            del self.failures[:failures]
+
+    def _count(self, listings, results):
+        for listing, result in zip(listings, results):
+            new_listings, updated_prices = self.totals[listing.website]
+            self.totals[listing.website] = (new_listings + (result == 'new'),
+                                            updated_prices + (result == 'updated'))
+            if result == 'new':
+                self.metrics.inc('listings_new_total', site=listing.website)
+            elif result == 'updated':
+                self.metrics.inc('price_updates_total', site=listing.website)
@@ -0,0 +1,179 @@
+"""Read queries over the tracker database, shared by CarPriceTracker and the query API
+
+Each query takes an open connection and returns a list of dicts. Large
+results are paged with keyset cursors: after is the sort key of the last
+row of the previous page (see PAGE_KEYS), so a deep page costs the same as
+the first and rows written in between don't shift the pages that follow.
+
+Makes and models are taken as canonical names (see normalize.py); callers
+normalize what users typed first.
+
+The generation counter is bumped by every transaction that changes what
+these queries return, so a cached result is good until it moves.
+"""
+from datetime import datetime
+
+from report import LIVE_CARS
+
+# Sort key standing in for a NULL percentage, which sorts first
+NULL_FIRST = float('-inf')
+
+
+def bump_generation(cursor):
+    """Mark the data as changed, in the cursor's transaction"""
+    cursor.execute('UPDATE generation SET value = value + 1')
+
+
+def read_generation(conn):
+    return conn.execute('SELECT value FROM generation').fetchone()[0]
+
+
+def dimension_filter(make, model):
+    """SQL restricting cars c to a make and optional model, by id, and its parameters"""
+    if not make:
+        return '', []
+    if not model:
+        return ' AND c.make_id = (SELECT id FROM makes WHERE name = ?)', [make]
+    return (' AND c.make_id = (SELECT id FROM makes WHERE name = ?)'
+            ' AND c.model_id = (SELECT id FROM models WHERE make_id = c.make_id AND name = ?)', [make, model])
+
+
+def _page(query, params, keys, after, limit):
+    """Add a keyset condition on keys past after, and a LIMIT"""
+    if after is not None:
+        query += f" AND ({', '.join(keys)}) > ({', '.join('?' * len(keys))})"
+        params = params + list(after)
+    query += f" ORDER BY {', '.join(keys)}"
+    if limit is not None:
+        query += ' LIMIT ?'
+        params = params + [limit]
+    return query, params
+
+
+def _rows(conn, query, params):
+    cursor = conn.execute(query, params)
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def price_changes(conn, days=1, after=None, limit=None):
+    """Cars repriced in the last days, biggest drops first"""
+    query, params = _page('''
+    SELECT c.id, c.title, c.make, c.model, c.year, c.url,
+           lp.price as current_price,
+           lp.previous_price as previous_price,
+           ((lp.price - lp.previous_price) / lp.previous_price * 100) as price_change_percent
+    FROM latest_prices lp
+    JOIN cars c ON c.id = lp.car_id
+    WHERE lp.date >= date(?, ?)
+    AND lp.previous_price IS NOT NULL
+    AND lp.price != lp.previous_price
+    ''', [datetime.now().date(), f'-{days} days'],
+        ['COALESCE((lp.price - lp.previous_price) / lp.previous_price * 100, -9e999)', 'c.id'], after, limit)
+    return _rows(conn, query, params)
+
+
+def average_prices(conn, make=None, model=None, after=None, limit=None):
+    """Average, lowest and highest current price per make, model and year
+
+    Only live listings are included. A car listed on several sites is
+    counted once, at the price of its first live listing. Groups are formed
+    on the integer ids, and the names joined in per group.
+    """
+    where, params = dimension_filter(make, model)
+    query, params = _page(f'''
+    SELECT COALESCE(mk.name, '') as make, COALESCE(md.name, '') as model, g.year,
+           g.avg_price, g.min_price, g.max_price, g.count
+    FROM (
+        SELECT c.make_id, c.model_id, c.year,
+               AVG(p.price) as avg_price,
+               MIN(p.price) as min_price,
+               MAX(p.price) as max_price,
+               COUNT(*) as count
+        FROM cars c
+        JOIN latest_prices p ON c.id = p.car_id
+        LEFT JOIN listing_entities le ON le.car_id = c.id
+        WHERE {LIVE_CARS}{where}
+        GROUP BY c.make_id, c.model_id, c.year
+    ) g
+    LEFT JOIN makes mk ON mk.id = g.make_id
+    LEFT JOIN models md ON md.id = g.model_id
+    WHERE 1 = 1
+    ''', params, ["COALESCE(mk.name, '')", "COALESCE(md.name, '')", 'COALESCE(g.year, -1)'], after, limit)
+    return _rows(conn, query, params)
+
+
+def days_on_market(conn, make=None, model=None, after=None, limit=None):
+    """Days on market per make and model
+
+    For delisted listings this is first seen to delisted; listings still
+    live are reported separately with how long they've been listed so far.
+    """
+    where, params = dimension_filter(make, model)
+    query, params = _page(f'''
+    SELECT COALESCE(mk.name, '') as make, COALESCE(md.name, '') as model,
+           g.delisted, g.avg_days_on_market, g.max_days_on_market, g.active, g.avg_days_listed
+    FROM (
+        SELECT c.make_id, c.model_id,
+               SUM(c.active = 0) as delisted,
+               AVG(CASE WHEN c.active = 0 THEN julianday(c.delisted) - julianday(c.first_seen) END) as avg_days_on_market,
+               MAX(CASE WHEN c.active = 0 THEN julianday(c.delisted) - julianday(c.first_seen) END) as max_days_on_market,
+               SUM(c.active = 1) as active,
+               AVG(CASE WHEN c.active = 1 THEN julianday(?) - julianday(c.first_seen) END) as avg_days_listed
+        FROM cars c
+        WHERE 1 = 1{where}
+        GROUP BY c.make_id, c.model_id
+    ) g
+    LEFT JOIN makes mk ON mk.id = g.make_id
+    LEFT JOIN models md ON md.id = g.model_id
+    WHERE 1 = 1
+    ''', [datetime.now().date()] + params, ["COALESCE(mk.name, '')", "COALESCE(md.name, '')"], after, limit)
+    return _rows(conn, query, params)
+
+
+def best_deals(conn, max_score, after=None, limit=None):
+    """Live listings priced furthest below similar cars, best deals first"""
+    query, params = _page('''
+    SELECT c.id, c.make, c.model, c.year, c.mileage, c.title, c.website, c.url,
+           lp.price, d.expected_price, d.score,
+           ((lp.price - d.expected_price) / d.expected_price * 100) as discount_percent
+    FROM deal_scores d
+    JOIN cars c ON c.id = d.car_id
+    JOIN latest_prices lp ON lp.car_id = d.car_id
+    WHERE d.score <= ? AND c.active = 1
+    ''', [max_score], ['d.score', 'c.id'], after, limit)
+    return _rows(conn, query, params)
+
+
+def listings(conn, make=None, model=None, year_min=None, year_max=None, max_price=None, location=None,
+             website=None, active=True, after=None, limit=None):
+    """Listings with their current price, oldest first
+
+    location is a canonical city; active=None returns delisted listings too.
+    """
+    where, params = dimension_filter(make, model)
+    for condition, value in (('c.year >= ?', year_min), ('c.year <= ?', year_max), ('lp.price <= ?', max_price),
+                             ('c.location_id = (SELECT id FROM locations WHERE name = ?)', location),
+                             ('c.website = ?', website), ('c.active = ?', None if active is None else int(active))):
+        if value is not None:
+            where += f' AND {condition}'
+            params.append(value)
+    query, params = _page(f'''
+    SELECT c.id, c.website, c.title, c.make, c.model, c.year, c.mileage, c.location, c.url, c.seller_type,
+           lp.price, lp.date as price_date, c.first_seen, c.last_seen, c.active, c.delisted
+    FROM cars c
+    LEFT JOIN latest_prices lp ON lp.car_id = c.id
+    WHERE 1 = 1{where}
+    ''', params, ['c.id'], after, limit)
+    return _rows(conn, query, params)
+
+
+# Sort key of a result row, to continue from with after=
+PAGE_KEYS = {
+    price_changes: lambda row: [NULL_FIRST if row['price_change_percent'] is None else row['price_change_percent'],
+                                row['id']],
+    average_prices: lambda row: [row['make'], row['model'], -1 if row['year'] is None else row['year']],
+    days_on_market: lambda row: [row['make'], row['model']],
+    best_deals: lambda row: [row['score'], row['id']],
+    listings: lambda row: [row['id']],
+}
@@ -0,0 +1,395 @@
+"""Streaming HTML report
+
+The report is an index page plus a page per make holding its full
+inventory, split into pages of page_size listings, and a page with every
+price drop. Rows are streamed from SQLite cursors straight into the output
+files through templates compiled once, so no page is ever built in memory.
+Only live listings are shown; sold and delisted ones are just counted.
+
+Each make's pages record a fingerprint of the data behind them. Pages
+whose fingerprint hasn't changed since the last report are left as they
+are, so a daily report only rewrites the makes that had new listings or
+price changes. The index is small and always rewritten.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import unicodedata
+import zlib
+from datetime import datetime
+from html import escape
+from string import Template
+
+from deals import DEAL_THRESHOLD
+
+logger = logging.getLogger('CarTracker')
+
+# Bump when the page layout changes, so every page is rebuilt once
+TEMPLATE_VERSION = 2
+
+STYLE = """
+        body { font-family: Arial, sans-serif; margin: 20px; }
+        h1, h2 { color: #333; }
+        table { border-collapse: collapse; width: 100%; margin-bottom: 20px; }
+        th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
+        th { background-color: #f2f2f2; }
+        tr:nth-child(even) { background-color: #f9f9f9; }
+        .summary { display: flex; gap: 20px; margin-bottom: 20px; }
+        .summary-card { background-color: #f2f2f2; padding: 15px; border-radius: 5px; flex: 1; }
+        .price-drop { color: green; }
+        .pager a { margin-right: 10px; }
+"""
+
+PAGE_HEAD = Template("""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>$title</title>
+    <style>$style</style>
+</head>
+<body>
+    <h1>$title</h1>
+    <p>Generated on $generated</p>
+""")
+
+PAGE_TAIL = """</body>
+</html>
+"""
+
+SUMMARY_CARD = Template("""        <div class="summary-card">
+            <h3>$label</h3>
+            <p>$value</p>
+        </div>
+""")
+
+
+def money(value):
+    return f"{value:.2f}" if value is not None else ""
+
+
+def percent(value):
+    return f"{value:.2f}%" if value is not None else ""
+
+
+def slugify(text):
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-') or 'unknown'
+
+
+def make_slug(make):
+    """Directory name of a make's pages; the hash keeps makes that slugify alike apart"""
+    return f"{slugify(make)}-{hashlib.sha1((make or '').encode('utf-8')).hexdigest()[:8]}"
+
+
+def row_hash(*values):
+    return zlib.crc32(repr(values).encode('utf-8'))
+
+
+def make_filter(make):
+    """SQL matching cars c of a make, where "" stands for no make"""
+    if make:
+        return 'c.make = ?', (make,)
+    return "(c.make IS NULL OR c.make = '')", ()
+
+
+class Table:
+    """HTML table rendered row by row from query results
+
+    cells turns a query row into the template's fields; they are escaped
+    before substitution.
+    """
+
+    def __init__(self, headers, row, cells):
+        self.head = ('    <table>\n        <tr>' +
+                     ''.join(f'<th>{escape(header)}</th>' for header in headers) + '</tr>\n')
+        self.row = Template(f'        <tr>{row}</tr>\n')
+        self.cells = cells
+
+    def render_row(self, row):
+        return self.row.substitute({key: escape(str(value)) for key, value in self.cells(row).items()})
+
+    def write(self, out, rows):
+        """Stream rows into out; returns how many were written"""
+        out.write(self.head)
+        count = 0
+        for row in rows:
+            out.write(self.render_row(row))
+            count += 1
+        out.write('    </table>\n')
+        return count
+
+
+TOP_MAKES = Table(
+    ['Make', 'Count'],
+    '<td><a href="$link">$make</a></td><td>$count</td>',
+    lambda row: {'link': row['link'], 'make': row['make'], 'count': row['count']},
+)
+
+PRICE_DROPS = Table(
+    ['Car', 'Old Price ($)', 'New Price ($)', 'Change (%)'],
+    '<td><a href="$url" target="_blank">$car</a></td><td>$old_price</td><td>$new_price</td>'
+    '<td class="price-drop">$change</td>',
+    lambda row: {'url': row['url'], 'car': row['car'], 'old_price': money(row['old_price']),
+                 'new_price': money(row['new_price']), 'change': percent(row['change_percent'])},
+)
+
+DEALS = Table(
+    ['Car', 'Price ($)', 'Expected Price ($)', 'Below Expected (%)'],
+    '<td><a href="$url" target="_blank">$car</a></td><td>$price</td><td>$expected</td>'
+    '<td class="price-drop">$discount</td>',
+    lambda row: {'url': row['url'], 'car': f"{row['make']} {row['model']} {row['year']}",
+                 'price': money(row['price']), 'expected': money(row['expected_price']),
+                 'discount': percent(row['discount_percent'])},
+)
+
+INVENTORY = Table(
+    ['Car', 'Year', 'Mileage (km)', 'Location', 'Site', 'Price ($)', 'Previous Price ($)', 'Deal Score'],
+    '<td><a href="$url" target="_blank">$title</a></td><td>$year</td><td>$mileage</td><td>$location</td>'
+    '<td>$website</td><td>$price</td><td>$previous_price</td><td>$score</td>',
+    lambda row: {'url': row['url'], 'title': row['title'] or f"{row['make']} {row['model']}",
+                 'year': row['year'] or "", 'mileage': row['mileage'] or "", 'location': row['location'],
+                 'website': row['website'], 'price': money(row['price']),
+                 'previous_price': money(row['previous_price']),
+                 'score': f"{row['score']:.2f}" if row['score'] is not None else ""},
+)
+
+# A car listed on several sites is shown once, as its first listing that is
+# still live
+DISTINCT_CARS = '''(le.entity_id IS NULL OR le.entity_id = c.id OR NOT EXISTS (
+    SELECT 1 FROM listing_entities o JOIN cars oc ON oc.id = o.car_id
+    WHERE o.entity_id = le.entity_id AND o.car_id < c.id AND oc.active = 1))'''
+# Live inventory only; matches the partial indexes on active cars
+LIVE_CARS = f'c.active = 1 AND {DISTINCT_CARS}'
+
+
+class ReportBuilder:
+    """Writes the report index and its sub-pages from one database connection"""
+
+    def __init__(self, conn, output_file, pages_dir=None, page_size=500, top=10, deal_threshold=DEAL_THRESHOLD):
+        # Rows must be sqlite3.Row
+        self.conn = conn
+        self.output_file = output_file
+        # Sub-pages go next to the index, e.g. car_prices_report_files/
+        self.pages_dir = pages_dir or os.path.splitext(output_file)[0] + '_files'
+        self.page_size = page_size
+        self.top = top
+        self.deal_threshold = deal_threshold
+        self.state_path = os.path.join(self.pages_dir, 'report_state.json')
+        self.generated = datetime.now().strftime('%Y-%m-%d %H:%M')
+
+    def _link(self, *parts):
+        """Link from the index to a sub-page"""
+        index_dir = os.path.dirname(os.path.abspath(self.output_file))
+        return os.path.relpath(os.path.join(self.pages_dir, *parts), index_dir).replace(os.sep, '/')
+
+    def _open(self, path, title):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        out = open(path + '.tmp', 'w', encoding='utf-8')
+        out.write(PAGE_HEAD.substitute(title=escape(title), style=STYLE, generated=self.generated))
+        return out
+
+    def _close(self, out, path):
+        out.write(PAGE_TAIL)
+        out.close()
+        # Readers never see a half-written page
+        os.replace(path + '.tmp', path)
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as f:
+            state = json.load(f)
+        return state if state.get('version') == TEMPLATE_VERSION else {}
+
+    def _save_state(self, state):
+        state['version'] = TEMPLATE_VERSION
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def make_fingerprints(self):
+        """Listing count and a hash of the data shown on each make's pages
+
+        Every column the pages show goes into the hash, one checksum per row
+        summed per make, so any edit to a listing rewrites its make's pages.
+        """
+        self.conn.create_function('row_hash', -1, row_hash, deterministic=True)
+        cursor = self.conn.execute(f'''
+        SELECT COALESCE(c.make, ''), COUNT(*),
+               SUM(row_hash(c.id, c.title, c.model, c.year, c.mileage, c.location, c.website, c.url,
+                            lp.price, lp.previous_price, d.score))
+        FROM cars c
+        JOIN latest_prices lp ON lp.car_id = c.id
+        LEFT JOIN deal_scores d ON d.car_id = c.id
+        LEFT JOIN listing_entities le ON le.car_id = c.id
+        WHERE {LIVE_CARS}
+        GROUP BY COALESCE(c.make, '')
+        ''')
+        fingerprints = {}
+        for make, count, checksum in cursor:
+            digest = hashlib.sha1(repr((count, checksum)).encode('utf-8')).hexdigest()
+            fingerprints[make] = (count, digest)
+        return fingerprints
+
+    def build(self):
+        """Write the report; returns (make pages written, makes skipped)"""
+        state = self._load_state()
+        previous = state.get('makes', {})
+        fingerprints = self.make_fingerprints()
+        written = skipped = 0
+
+        for make, (count, digest) in fingerprints.items():
+            slug = make_slug(make)
+            pages = max(1, math.ceil(count / self.page_size))
+            old = previous.get(make)
+            first_page = os.path.join(self.pages_dir, 'makes', slug, 'page-1.html')
+            if old and old['digest'] == digest and os.path.exists(first_page):
+                skipped += 1
+                continue
+            self.write_make(make, slug, pages)
+            # Drop pages left over from when the make had more listings
+            for page in range(pages + 1, (old['pages'] if old else 0) + 1):
+                stale = os.path.join(self.pages_dir, 'makes', slug, f'page-{page}.html')
+                if os.path.exists(stale):
+                    os.remove(stale)
+            written += pages
+
+        # Drop the pages of makes no longer listed
+        makes_dir = os.path.join(self.pages_dir, 'makes')
+        slugs = {make_slug(make) for make in fingerprints}
+        if os.path.isdir(makes_dir):
+            for name in os.listdir(makes_dir):
+                if name not in slugs:
+                    shutil.rmtree(os.path.join(makes_dir, name), ignore_errors=True)
+
+        # Price drops change only when some make's prices do
+        drops_digest = hashlib.sha1(repr(sorted(fingerprints.items())).encode('utf-8')).hexdigest()
+        drops_page = os.path.join(self.pages_dir, 'price_drops.html')
+        if state.get('price_drops') != drops_digest or not os.path.exists(drops_page):
+            self.write_price_drops()
+        state['price_drops'] = drops_digest
+        self.write_index(fingerprints)
+        state['makes'] = {make: {'digest': digest, 'pages': max(1, math.ceil(count / self.page_size))}
+                          for make, (count, digest) in fingerprints.items()}
+        self._save_state(state)
+        logger.info(f"Report pages: {written} written, {skipped} makes unchanged")
+        return written, skipped
+
+    def write_make(self, make, slug, pages):
+        """Stream a make's full inventory into page-1.html, page-2.html, ..."""
+        where, params = make_filter(make)
+        cursor = self.conn.execute(f'''
+        SELECT c.title, c.make, c.model, c.year, c.mileage, c.location, c.website, c.url,
+               lp.price, lp.previous_price, d.score
+        FROM cars c
+        JOIN latest_prices lp ON lp.car_id = c.id
+        LEFT JOIN deal_scores d ON d.car_id = c.id
+        LEFT JOIN listing_entities le ON le.car_id = c.id
+        WHERE {where} AND {LIVE_CARS}
+        ORDER BY c.model, c.year, c.id
+        ''', params)
+        for page in range(1, pages + 1):
+            path = os.path.join(self.pages_dir, 'makes', slug, f'page-{page}.html')
+            out = self._open(path, f"{make or 'Unknown make'} - page {page} of {pages}")
+            out.write(self._pager(path, page, pages))
+            INVENTORY.write(out, (row for _, row in zip(range(self.page_size), cursor)))
+            out.write(self._pager(path, page, pages))
+            self._close(out, path)
+
+    def _index_link(self, path):
+        """Link from a sub-page back to the index"""
+        link = os.path.relpath(os.path.abspath(self.output_file), os.path.dirname(os.path.abspath(path)))
+        return f'<a href="{escape(link.replace(os.sep, "/"))}">Index</a>'
+
+    def _pager(self, path, page, pages):
+        links = [self._index_link(path)]
+        if page > 1:
+            links.append(f'<a href="page-{page - 1}.html">Previous</a>')
+        if page < pages:
+            links.append(f'<a href="page-{page + 1}.html">Next</a>')
+        return f'    <p class="pager">{"".join(links)}</p>\n'
+
+    def _price_drops(self, limit=None):
+        query = f'''
+        SELECT c.make || ' ' || c.model || ' ' || c.year as car,
+               lp.previous_price as old_price,
+               lp.price as new_price,
+               ((lp.price - lp.previous_price) / lp.previous_price * 100) as change_percent,
+               c.url
+        FROM latest_prices lp
+        JOIN cars c ON c.id = lp.car_id
+        LEFT JOIN listing_entities le ON le.car_id = c.id
+        WHERE lp.price < lp.previous_price
+        AND lp.previous_price > 0
+        AND {LIVE_CARS}
+        ORDER BY change_percent
+        '''
+        if limit:
+            query += f'LIMIT {int(limit)}'
+        return self.conn.execute(query)
+
+    def write_price_drops(self):
+        path = os.path.join(self.pages_dir, 'price_drops.html')
+        out = self._open(path, "All Price Drops")
+        out.write(f'    <p class="pager">{self._index_link(path)}</p>\n')
+        PRICE_DROPS.write(out, self._price_drops())
+        self._close(out, path)
+
+    def write_index(self, fingerprints):
+        cursor = self.conn.execute(f'''
+        SELECT SUM(c.active = 1),
+               SUM(c.active = 1 AND NOT {DISTINCT_CARS}),
+               SUM(lp.previous_price IS NOT NULL AND {LIVE_CARS}),
+               SUM(c.active = 0)
+        FROM cars c
+        LEFT JOIN listing_entities le ON le.car_id = c.id
+        LEFT JOIN latest_prices lp ON lp.car_id = c.id
+        ''')
+        total, duplicates, changed, delisted = cursor.fetchone()
+        total = total or 0
+        duplicates = duplicates or 0
+
+        out = self._open(self.output_file, "Used Car Price Report")
+        out.write('    <div class="summary">\n')
+        for label, value in [("Unique Cars", total - duplicates), ("Cars with Price Changes", changed or 0),
+                             ("Cross-Site Duplicates", duplicates), ("Sold or Delisted", delisted or 0)]:
+            out.write(SUMMARY_CARD.substitute(label=label, value=value))
+        out.write('    </div>\n')
+
+        out.write('    <h2>Top Car Makes</h2>\n')
+        top_makes = sorted(fingerprints.items(), key=lambda item: item[1][0], reverse=True)[:self.top]
+        TOP_MAKES.write(out, ({'make': make or 'Unknown', 'count': count,
+                               'link': self._link('makes', make_slug(make), 'page-1.html')}
+                              for make, (count, _) in top_makes))
+
+        out.write(f'    <h2>Recent Price Drops</h2>\n'
+                  f'    <p><a href="{escape(self._link("price_drops.html"))}">All price drops</a></p>\n')
+        PRICE_DROPS.write(out, self._price_drops(self.top))
+
+        out.write('    <h2>Best Deals</h2>\n')
+        DEALS.write(out, self._deals())
+
+        out.write('    <h2>All Makes</h2>\n    <ul>\n')
+        for make, (count, _) in sorted(fingerprints.items()):
+            link = self._link('makes', make_slug(make), 'page-1.html')
+            out.write(f'        <li><a href="{escape(link)}">{escape(make or "Unknown")}</a> ({count})</li>\n')
+        out.write('    </ul>\n')
+        self._close(out, self.output_file)
+
+    def _deals(self):
+        return self.conn.execute(f'''
+        SELECT c.make, c.model, c.year, c.url, lp.price, d.expected_price,
+               ((lp.price - d.expected_price) / d.expected_price * 100) as discount_percent
+        FROM deal_scores d
+        JOIN cars c ON c.id = d.car_id
+        JOIN latest_prices lp ON lp.car_id = d.car_id
+        LEFT JOIN listing_entities le ON le.car_id = c.id
+        WHERE d.score <= ? AND {LIVE_CARS}
+        ORDER BY d.score
+        LIMIT ?
+        ''', (self.deal_threshold, self.top))
@@ -0,0 +1,364 @@
+"""Adaptive crawl scheduling: fetch each results page about as often as it changes
+
+Every page fetched is logged in page_crawls with how many new listings
+and price changes it turned up. On a marketplace sorted newest first,
+page 1 changes every hour while page 15 changes a few times a week, and
+one site churns faster than another, so a fixed daily crawl spends most
+of its requests on pages with nothing new and finds the hot pages' changes
+up to a day late.
+
+    ChangeRates   changes per hour of each (site, page), from its crawl
+                  history: recent crawls weigh more, and pages with little
+                  history lean on their site's overall rate
+    CrawlPlanner  each tick, spends its share of a daily request budget on
+                  the pages with the most changes expected to be waiting
+                  (rate x hours since the last fetch), weighted by how long
+                  they've been waiting; every page is still fetched at least
+                  every MAX_INTERVAL_HOURS
+
+simulate() replays a recorded crawl history against a policy, so policies
+can be compared offline at the same spend. Changes are assumed to have
+happened evenly between two recorded fetches of a page, so the replay is
+only as fine-grained as the history it comes from.
+"""
+import math
+import time
+from bisect import bisect_right
+from collections import namedtuple
+
+# Crawl history kept, and how fast old observations lose weight
+HISTORY_DAYS = 60
+HALF_LIFE_HOURS = 7 * 24
+# Hours of the site's overall rate a page's own history starts from
+PRIOR_HOURS = 24
+# Changes per hour assumed for a site that has never been fetched
+DEFAULT_RATE = 1.0
+# Pages per site tried before the crawl history says how deep results go
+DEFAULT_DEPTH = 5
+MAX_DEPTH = 20
+# No page goes unfetched longer than this, however quiet it has been
+MAX_INTERVAL_HOURS = 7 * 24
+# Expected changes a page must have waiting to be worth a request
+MIN_YIELD = 0.2
+# Requests per day across all sites, and how often the planner runs
+DAILY_BUDGET = 500
+TICK_HOURS = 1
+# Share of a tick's budget that can be carried over from quiet ticks
+BURST = 2
+# Changes count as caught fresh if fetched within this many hours
+FRESH_HOURS = 6
+
+# page_crawls status of a fetch that failed, or whose page couldn't be stored
+CRAWL_FAILED = 'failed'
+
+Crawl = namedtuple('Crawl', ['crawled', 'site', 'page', 'listings', 'changes', 'failed'], defaults=[False])
+
+
+def record_crawls(conn, rows, crawled=None):
+    """Log fetched pages, as (site, page, status, listings, new_listings, updated_prices) rows
+
+    Runs in the connection's current transaction, which should be the one
+    that stored the pages. listings is None for pages skipped as unchanged
+    and for failed requests (status CRAWL_FAILED), which are logged too:
+    they count against the budget like any other request.
+    """
+    crawled = time.time() if crawled is None else crawled
+    conn.executemany('''
+    INSERT INTO page_crawls (crawled, site, page, status, listings, new_listings, updated_prices)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(crawled,) + tuple(row) for row in rows])
+
+
+def load_crawls(conn, since):
+    """Crawls logged since a unix time, oldest first"""
+    return [Crawl(*row) for row in conn.execute('''
+    SELECT crawled, site, page, listings, new_listings + updated_prices, status = ? FROM page_crawls
+    WHERE crawled >= ? ORDER BY crawled, id
+    ''', (CRAWL_FAILED, since))]
+
+
+def prune_crawls(conn, before):
+    return conn.execute('DELETE FROM page_crawls WHERE crawled < ?', (before,)).rowcount
+
+
+class ChangeRates:
+    """Changes per hour of each results page, estimated from its fetches
+
+    Each pair of consecutive fetches of a page is one observation: so many
+    changes over so many hours. Changes and hours are summed with weights
+    halving every half_life_hours, per page and per site. Failed fetches
+    observe nothing, but still count as the page's last attempt, so a
+    failing page isn't retried every tick.
+    """
+
+    def __init__(self, half_life_hours=HALF_LIFE_HOURS, prior_hours=PRIOR_HOURS, default_rate=DEFAULT_RATE):
+        self.half_life = half_life_hours * 3600
+        self.prior_hours = prior_hours
+        self.default_rate = default_rate
+        # (site, page) or site -> [weighted changes, weighted hours, as of]
+        self.pages = {}
+        self.sites = {}
+        # (site, page) -> time of the last attempt, and of the last fetch that worked
+        self.last = {}
+        self.fetched = {}
+        # site -> deepest page that had listings
+        self.deepest = {}
+
+    def _add(self, totals, key, changes, hours, now):
+        total = totals.setdefault(key, [0.0, 0.0, now])
+        decay = 0.5 ** ((now - total[2]) / self.half_life)
+        total[0] = total[0] * decay + changes
+        total[1] = total[1] * decay + hours
+        total[2] = now
+
+    def observe(self, crawl):
+        key = (crawl.site, crawl.page)
+        self.last[key] = max(self.last.get(key, crawl.crawled), crawl.crawled)
+        if crawl.failed:
+            return
+        previous = self.fetched.get(key)
+        self.fetched[key] = crawl.crawled
+        if crawl.listings is None or crawl.listings > 0:
+            self.deepest[crawl.site] = max(self.deepest.get(crawl.site, 0), crawl.page)
+        if previous is None or crawl.crawled <= previous:
+            return
+        hours = (crawl.crawled - previous) / 3600
+        self._add(self.pages, key, crawl.changes, hours, crawl.crawled)
+        self._add(self.sites, crawl.site, crawl.changes, hours, crawl.crawled)
+
+    def fit(self, crawls):
+        for crawl in crawls:
+            self.observe(crawl)
+        return self
+
+    def site_rate(self, site):
+        total = self.sites.get(site)
+        if not total or not total[1]:
+            return self.default_rate
+        return total[0] / total[1]
+
+    def rate(self, site, page):
+        """Expected changes per hour on a page"""
+        prior = self.site_rate(site)
+        changes, hours, _ = self.pages.get((site, page), (0.0, 0.0, None))
+        return (changes + prior * self.prior_hours) / (hours + self.prior_hours)
+
+    def depth(self, site, max_depth=MAX_DEPTH):
+        """Pages of a site worth considering: one past the deepest that had listings"""
+        if site not in self.deepest:
+            return min(DEFAULT_DEPTH, max_depth)
+        return min(self.deepest[site] + 1, max_depth)
+
+
+class CrawlPlanner:
+    """Picks the pages to fetch each tick, within a daily request budget"""
+
+    def __init__(self, sites, budget=DAILY_BUDGET, tick_hours=TICK_HOURS, max_depth=MAX_DEPTH,
+                 max_interval_hours=MAX_INTERVAL_HOURS, min_yield=MIN_YIELD):
+        self.sites = list(sites)
+        self.budget = budget
+        self.tick_hours = tick_hours
+        self.max_depth = max_depth
+        self.max_interval_hours = max_interval_hours
+        self.min_yield = min_yield
+
+    def allowance(self, spent):
+        """Requests this tick may make, given those made in the last 24 hours"""
+        share = math.ceil(self.budget * self.tick_hours / 24 * BURST)
+        return max(0, min(self.budget - spent, share))
+
+    def plan(self, rates, now, requests):
+        """{site: [pages]} of the requests that cut the most hours of changes going unseen
+
+        A page changing at rate r, last fetched h hours ago, has r x h changes
+        waiting for h / 2 hours on average. Fetching the pages with the most
+        waiting change-hours (r x h^2) spaces each page's fetches by about
+        1 / sqrt(r): hot pages are fetched more often than quiet ones, but
+        not so much more that the quiet ones go stale.
+        """
+        candidates = []
+        for site in self.sites:
+            for page in range(1, rates.depth(site, self.max_depth) + 1):
+                last = rates.last.get((site, page))
+                hours = self.max_interval_hours if last is None else (now - last) / 3600
+                expected = rates.rate(site, page) * hours
+                overdue = hours >= self.max_interval_hours
+                if overdue or expected >= self.min_yield:
+                    candidates.append((not overdue, -expected * hours, page, site))
+        # Overdue pages first, then by change-hours waiting, shallowest first
+        candidates.sort()
+        plan = {}
+        for _, _, page, site in candidates[:requests]:
+            plan.setdefault(site, []).append(page)
+        return {site: sorted(pages) for site, pages in plan.items()}
+
+
+class ReplayHistory:
+    """Per-page change timelines rebuilt from a recorded crawl history
+
+    Each recorded fetch spreads its changes evenly over the hours since the
+    page's previous fetch.
+    """
+
+    def __init__(self, crawls):
+        # (site, page) -> interval starts, ends and changes, in time order
+        self.timelines = {}
+        self.listings = {}
+        last = {}
+        for crawl in crawls:
+            if crawl.failed:
+                continue
+            key = (crawl.site, crawl.page)
+            if crawl.listings is None or crawl.listings > 0:
+                self.listings[key] = crawl.listings or 1
+            else:
+                self.listings.setdefault(key, 0)
+            previous = last.get(key)
+            last[key] = crawl.crawled
+            if previous is not None and crawl.crawled > previous and crawl.changes:
+                starts, ends, changes = self.timelines.setdefault(key, ([], [], []))
+                starts.append(previous)
+                ends.append(crawl.crawled)
+                changes.append(crawl.changes)
+        self.sites = sorted({site for site, _ in last})
+        self.start = crawls[0].crawled if crawls else 0
+        self.end = crawls[-1].crawled if crawls else 0
+
+    def changes(self, key, since, now):
+        """(changes, fresh changes, summed delay in hours) that happened on a page between since and now"""
+        timeline = self.timelines.get(key)
+        if not timeline:
+            return 0.0, 0.0, 0.0
+        starts, ends, counts = timeline
+        total = fresh = delay = 0.0
+        fresh_from = now - FRESH_HOURS * 3600
+        for i in range(max(0, bisect_right(ends, since) - 1), len(starts)):
+            start, end = starts[i], ends[i]
+            if start >= now:
+                break
+            low, high = max(start, since), min(end, now)
+            if high <= low:
+                continue
+            share = counts[i] * (high - low) / (end - start)
+            total += share
+            delay += share * (now - (low + high) / 2) / 3600
+            if high > fresh_from:
+                fresh += counts[i] * (high - max(low, fresh_from)) / (end - start)
+        return total, fresh, delay
+
+
+class Simulation:
+    """One policy replayed over a history: its fetches, and what they caught"""
+
+    def __init__(self, history):
+        self.history = history
+        self.rates = ChangeRates()
+        # (site, page) -> time of the policy's last fetch
+        self.fetched = {}
+        self.requests = []
+        self.caught = self.fresh = self.delay = 0.0
+
+    def spent(self, now):
+        """Requests made in the 24 hours before now"""
+        return len(self.requests) - bisect_right(self.requests, now - 24 * 3600)
+
+    def fetch(self, site, page, now):
+        """Fetch a page at now; returns the changes it turns up"""
+        key = (site, page)
+        changes, fresh, delay = self.history.changes(key, self.fetched.get(key, self.history.start), now)
+        self.fetched[key] = now
+        self.requests.append(now)
+        self.caught += changes
+        self.fresh += fresh
+        self.delay += delay
+        self.rates.observe(Crawl(now, site, page, self.history.listings.get(key, 0), changes))
+        return changes
+
+
+class AdaptivePolicy:
+    """The CrawlPlanner, learning rates from its own fetches"""
+
+    name = 'adaptive'
+
+    def __init__(self, budget, **options):
+        self.budget = budget
+        self.options = options
+
+    def tick(self, sim, now):
+        planner = CrawlPlanner(sim.history.sites, self.budget, **self.options)
+        for site, pages in planner.plan(sim.rates, now, planner.allowance(sim.spent(now))).items():
+            for page in pages:
+                sim.fetch(site, page, now)
+
+
+class DailyPolicy:
+    """The fixed schedule: once a day, page through each site until a page turns up little new"""
+
+    name = 'daily'
+
+    def __init__(self, hour=7, stop_changes=1, max_depth=MAX_DEPTH):
+        self.hour = hour
+        self.stop_changes = stop_changes
+        self.max_depth = max_depth
+
+    def tick(self, sim, now):
+        if time.localtime(now).tm_hour != self.hour:
+            return
+        for site in sim.history.sites:
+            for page in range(1, self.max_depth + 1):
+                if sim.fetch(site, page, now) < self.stop_changes:
+                    break
+
+
+class RoundRobinPolicy:
+    """The same budget spread evenly: each tick fetches the pages fetched longest ago"""
+
+    name = 'round robin'
+
+    def __init__(self, budget, max_depth=MAX_DEPTH):
+        self.budget = budget
+        self.max_depth = max_depth
+
+    def tick(self, sim, now):
+        planner = CrawlPlanner(sim.history.sites, self.budget, max_depth=self.max_depth)
+        pages = [(sim.rates.last.get((site, page), 0), site, page) for site in sim.history.sites
+                 for page in range(1, sim.rates.depth(site, self.max_depth) + 1)]
+        for _, site, page in sorted(pages)[:planner.allowance(sim.spent(now))]:
+            sim.fetch(site, page, now)
+
+
+def simulate(history, policy, tick_hours=TICK_HOURS, start=None, end=None):
+    """Replay a policy over a ReplayHistory; returns its requests and the changes they caught"""
+    sim = Simulation(history)
+    start = history.start if start is None else start
+    end = history.end if end is None else end
+    # Ticks on the hour, like the scheduler
+    now = math.ceil(start / 3600) * 3600
+    while now <= end:
+        policy.tick(sim, now)
+        now += tick_hours * 3600
+    days = max((end - start) / 86400, 1e-9)
+    requests = len(sim.requests)
+    return {
+        'policy': policy.name,
+        'requests': requests,
+        'requests_per_day': requests / days,
+        'changes': sim.caught,
+        'fresh_changes': sim.fresh,
+        'changes_per_request': sim.caught / requests if requests else 0.0,
+        'fresh_per_request': sim.fresh / requests if requests else 0.0,
+        'avg_delay_hours': sim.delay / sim.caught if sim.caught else 0.0,
+    }
+
+
+def compare_policies(crawls, budget=None, tick_hours=TICK_HOURS):
+    """Replay the daily schedule, then the adaptive and round-robin policies at the same spend
+
+    budget defaults to what the daily schedule spent per day.
+    """
+    history = ReplayHistory(crawls)
+    results = [simulate(history, DailyPolicy(), tick_hours)]
+    budget = budget or max(1, round(results[0]['requests_per_day']))
+    results.append(simulate(history, AdaptivePolicy(budget, tick_hours=tick_hours), tick_hours))
+    results.append(simulate(history, RoundRobinPolicy(budget), tick_hours))
+    return budget, results
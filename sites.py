@@ -0,0 +1,283 @@
+"""Site adapters and the shared listing extraction engine
+
+Each marketplace is described declaratively by a SiteAdapter: where its
+results pages live, which element is a listing card, and how each listing
+field is found inside a card. ExtractionEngine turns an adapter into a
+compiled parser that yields Listing records.
+"""
+import logging
+import re
+from datetime import datetime
+from typing import NamedTuple
+
+import soupsieve
+from bs4 import BeautifulSoup, SoupStrainer
+
+from fetcher import HostPolicy
+
+logger = logging.getLogger('CarTracker')
+
+try:
+    import lxml.html
+    from lxml import etree
+    DEFAULT_BACKEND = 'lxml'
+    DEFAULT_FEATURES = 'lxml'
+except ImportError:
+    lxml = None
+    DEFAULT_BACKEND = 'bs4'
+    DEFAULT_FEATURES = 'html.parser'
+
+
+class Listing(NamedTuple):
+    """A parsed listing, ready to be stored"""
+    website: str
+    listing_id: str
+    title: str
+    make: str
+    model: str
+    year: int
+    mileage: int
+    location: str
+    url: str
+    seller_type: str
+    features: str
+    price: float
+
+
+def parse_text(text):
+    return text.strip()
+
+
+def parse_price(text):
+    """Remove currency symbol and commas"""
+    return float(''.join(c for c in text if c.isdigit() or c == '.') or 0)
+
+
+def parse_int(text):
+    text = text.strip()
+    return int(text) if text.isdigit() else 0
+
+
+def parse_digits(text):
+    """Keep only the digits, e.g. '120,000 km' -> 120000"""
+    digits = ''.join(c for c in text if c.isdigit())
+    return int(digits) if digits else 0
+
+
+def parse_year(text):
+    text = text.strip()
+    if text.isdigit() and 1950 <= int(text) <= datetime.now().year:
+        return int(text)
+    return 0
+
+
+def split_title(title):
+    """Split a title into make and model, e.g. 'Chevrolet Aveo Family'"""
+    if not title:
+        return "", ""
+    parts = title.split(' ', 1)
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+
+class Field:
+    """How to find one listing field inside a card
+
+    selector: CSS selector relative to the card, or None for the card itself
+    attr:     attribute to read instead of the element text
+    index:    which match to use; None tries every match in order and keeps
+              the first one that parses to a truthy value
+    parse:    converts the raw string to the field value
+    """
+
+    def __init__(self, selector=None, attr=None, index=0, parse=parse_text, default=""):
+        self.selector = selector
+        self.attr = attr
+        self.index = index
+        self.parse = parse
+        self.default = default
+
+
+class SiteAdapter:
+    """Declarative description of one marketplace"""
+
+    def __init__(self, name, page_url, base_url, card, fields, host_policy=None):
+        self.name = name
+        # Results page URL with a {page} placeholder
+        self.page_url = page_url
+        # Prefix for relative listing links
+        self.base_url = base_url
+        # (tag, class) of a listing card
+        self.card = card
+        self.fields = fields
+        self.host_policy = host_policy or HostPolicy()
+
+
+def css_to_xpath(selector, prefix='.//'):
+    """Translate a simple CSS selector (tags, classes, ids, descendants) to XPath"""
+    steps = []
+    for part in selector.split():
+        match = re.fullmatch(r'([\w-]*)((?:[.#][\w-]+)*)', part)
+        if not match or not part:
+            raise ValueError(f"Unsupported selector for the lxml backend: {selector!r}")
+        tag, qualifiers = match.groups()
+        conditions = []
+        for kind, name in re.findall(r'([.#])([\w-]+)', qualifiers):
+            if kind == '.':
+                conditions.append(f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')")
+            else:
+                conditions.append(f"@id = '{name}'")
+        steps.append((tag or '*') + ''.join(f'[{condition}]' for condition in conditions))
+    return prefix + '/descendant::'.join(steps)
+
+
+class ExtractionEngine:
+    """Compiled extractor for one site adapter
+
+    Selectors are compiled once per engine. With lxml available they become
+    XPath expressions run straight against the lxml tree. The 'bs4' backend
+    reads the page with BeautifulSoup instead, building only the listing
+    cards into a tree (via SoupStrainer) so the rest of the page is skipped.
+    """
+
+    def __init__(self, adapter, backend=DEFAULT_BACKEND, features=DEFAULT_FEATURES, strain=True):
+        self.adapter = adapter
+        self.backend = backend
+        self.features = features
+        tag, css_class = adapter.card
+        card = f'{tag}.{css_class}'
+
+        if backend == 'lxml':
+            self.card_selector = etree.XPath(css_to_xpath(card, prefix='//'))
+            compile_selector = lambda selector: etree.XPath(css_to_xpath(selector, prefix='.//'))
+        else:
+            self.strainer = SoupStrainer(tag, class_=css_class) if strain else None
+            self.card_selector = soupsieve.compile(card)
+            compile_selector = soupsieve.compile
+
+        self.fields = [
+            (name, field, compile_selector(field.selector) if field.selector else None)
+            for name, field in adapter.fields.items()
+        ]
+
+    def _cards(self, html):
+        if self.backend == 'lxml':
+            if not html.strip():
+                return []
+            return self.card_selector(lxml.html.fromstring(html))
+        soup = BeautifulSoup(html, self.features, parse_only=self.strainer)
+        return self.card_selector.select(soup)
+
+    def _value(self, card, field, selector):
+        if selector is None:
+            elems = [card]
+        elif self.backend == 'lxml':
+            elems = selector(card)
+        else:
+            elems = selector.select(card)
+        if field.index is not None:
+            elems = elems[field.index:][:1]
+
+        for elem in elems:
+            if field.attr:
+                raw = elem.get(field.attr)
+            elif self.backend == 'lxml':
+                raw = elem.text_content()
+            else:
+                raw = elem.get_text()
+            if raw is None:
+                continue
+            value = field.parse(raw)
+            if value or field.index is not None:
+                return value
+        return field.default
+
+    def _listing(self, card):
+        """Listing for one card, or None if it couldn't be read"""
+        try:
+            values = {name: self._value(card, field, selector)
+                      for name, field, selector in self.fields}
+            url = values.get('url', "")
+            if url and not url.startswith('http'):
+                url = self.adapter.base_url + url
+            make, model = split_title(values.get('title', ""))
+            return Listing(
+                website=self.adapter.name,
+                listing_id=values.get('listing_id', ""),
+                title=values.get('title', ""),
+                make=make,
+                model=model,
+                year=values.get('year', 0),
+                mileage=values.get('mileage', 0),
+                location=values.get('location', ""),
+                url=url,
+                seller_type=values.get('seller_type', 'Unknown'),
+                features=values.get('features', ""),
+                price=values.get('price', 0.0),
+            )
+        except Exception as e:
+            logger.error(f"Error processing {self.adapter.name} listing: {e}")
+            return None
+
+    def extract(self, html):
+        """Yield a Listing for every card on the page"""
+        for card in self._cards(html):
+            listing = self._listing(card)
+            if listing is not None:
+                yield listing
+
+    def extract_page(self, html):
+        """All listings on the page and how many cards failed to extract"""
+        listings = []
+        failed = 0
+        for card in self._cards(html):
+            listing = self._listing(card)
+            if listing is None:
+                failed += 1
+            else:
+                listings.append(listing)
+        return listings, failed
+
+
+SITE_ADAPTERS = {}
+
+
+def register_site(adapter):
+    """Add a site adapter to the registry"""
+    SITE_ADAPTERS[adapter.name] = adapter
+    return adapter
+
+
+register_site(SiteAdapter(
+    name='PatioTuerca',
+    page_url='https://ecuador.patiotuerca.com/usados?page={page}',
+    base_url='https://ecuador.patiotuerca.com',
+    card=('div', 'listing-card'),
+    fields={
+        'listing_id': Field(attr='id'),
+        'title': Field('h2.listing-card__title'),
+        'url': Field('a.listing-card__link', attr='href'),
+        'price': Field('span.listing-card__price', parse=parse_price, default=0.0),
+        'year': Field('span.listing-card__characteristics', index=0, parse=parse_int, default=0),
+        'mileage': Field('span.listing-card__characteristics', index=1, parse=parse_digits, default=0),
+        'location': Field('span.listing-card__characteristics', index=2),
+    },
+    host_policy=HostPolicy(min_interval=2.0, max_concurrency=2),
+))
+
+register_site(SiteAdapter(
+    name='OLX',
+    page_url='https://www.olx.com.ec/autos_c378?page={page}',
+    base_url='https://www.olx.com.ec',
+    card=('li', 'EIR5N'),
+    fields={
+        'listing_id': Field(attr='data-id'),
+        'title': Field('h2.fTGKY'),
+        'url': Field('a.fhlkh', attr='href'),
+        'price': Field('span.PXdHY', parse=parse_price, default=0.0),
+        # The year is whichever detail looks like one
+        'year': Field('span.zLvFQ', index=None, parse=parse_year, default=0),
+        # Location is usually the last detail
+        'location': Field('span.zLvFQ', index=-1),
+    },
+    host_policy=HostPolicy(min_interval=3.0, max_concurrency=2),
+))